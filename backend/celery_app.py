@@ -28,6 +28,14 @@ celery_app.conf.beat_schedule = {
     }
 }
 
+# URL ソースの定期再取得 (URL_REFRESH_INTERVAL_MIN 分ごと / 0 なら無効)
+URL_REFRESH_INTERVAL_MIN = int(os.getenv("URL_REFRESH_INTERVAL_MIN", "0"))
+if URL_REFRESH_INTERVAL_MIN > 0:
+    celery_app.conf.beat_schedule["refresh-url-sources"] = {
+        "task": "backend.tasks.refresh_url_sources",
+        "schedule": timedelta(minutes=URL_REFRESH_INTERVAL_MIN),
+    }
+
 print("="*80)
 print("CELERY APP INITIALIZED. REGISTERED TASKS:")
 if celery_app.tasks:  # tasks属性が存在するか確認
@@ -54,6 +62,12 @@ def worker_ready_handler(sender, **kwargs):
     queues_info = getattr(sender.app.amqp, 'queues', {})  # 安全にアクセス
     print(f"====== Worker {getattr(sender, 'hostname', 'N/A')} - Queues: {queues_info} ======")
     logger.info(f"====== Worker {getattr(sender, 'hostname', 'N/A')} - Queues: {queues_info} ======")
+    # --- URL 取り込み用の Chrome を事前起動 (SELENIUM_POOL_PREWARM 台) ---
+    prewarm = int(os.getenv("SELENIUM_POOL_PREWARM", "0"))
+    if prewarm > 0:
+        import threading
+        from backend.services.webdriver_pool import driver_pool
+        threading.Thread(target=driver_pool.prewarm, args=(prewarm,), daemon=True).start()
     # senderオブジェクトの内容を確認するために、他の属性も試してみる (デバッグ用)
     # print(f"====== Worker Sender Object Type: {type(sender)} ======")
     # print(f"====== Worker Sender Object Dir: {dir(sender)} ======")
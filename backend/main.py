@@ -13,7 +13,8 @@ logging.basicConfig(
 
 from flask import (
     Flask, request, jsonify, send_from_directory, url_for,
-    redirect, flash, render_template, session
+    redirect, flash, render_template, session,
+    Response, stream_with_context
 )
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
@@ -55,8 +56,15 @@ from backend.forms import RegistrationForm, LoginForm
 
 from backend.services import ingestion as ingestion_utils
 from backend.services import retriever
-from backend.services.chat import answer_question
+from backend.services.crawler import is_sitemap_url
+from backend.services.chat import ChatError, answer_question, stream_answer
+from backend.services import conversation
+from backend.services import slack_dedup
+from backend.services.answer_cache import get_answer_cache_stats, get_cache as get_answer_cache
+from backend.services.embedding import get_embedding_cache_stats, get_query_embedding_cache_stats
+from backend.services.upload import receive_upload, discard_upload, UploadTooLarge, MAX_UPLOAD_BYTES, UPLOAD_STAGING_DIR
 from backend.tasks import handle_slack_event  # celery async processing
+from backend.tasks import ingest_source  # URL / ファイル取り込みジョブ
 from backend.tasks import add as add_task  # addタスクをインポート
 
 # --- Google Cookies Blueprint ---
@@ -69,7 +77,8 @@ from backend.models import (
     User, ChatHistory, GoogleCookie,
     DEFAULT_ICON_URL, DEFAULT_PROMPT_ROLE, DEFAULT_PROMPT_TASK,
     WatchedSheet,
-    SlackIntegration
+    SlackIntegration,
+    IngestionJob
 )
 
 # Import encrypt_blob for cookie encryption
@@ -266,12 +275,16 @@ def load_user(user_id):
 
 # --- パスと定数 (変更なし) ---
 BASE_DIR = os.path.dirname(__file__)
-UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
+UPLOAD_FOLDER = UPLOAD_STAGING_DIR   # アップロードの一時置き場 (Worker と共有するストレージ)
 ICON_UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'icons')
 ICON_FILENAME = "ai_icon.png"
 ALLOWED_EXTENSIONS = {"txt", "pdf", "docx", "xls", "xlsx"}
 ALLOWED_ICON_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+# 運用向け API (/api/admin/cache_stats など) を使える管理者のメールアドレス (カンマ区切り, 未設定なら誰も使えない)
+ADMIN_EMAILS = {e.strip().lower() for e in os.getenv("ADMIN_EMAILS", "").split(",") if e.strip()}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# 上限を超えるリクエストは本文を読み込む前に 413 で拒否する (multipart のヘッダー分の余裕を持たせる)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + 1024 * 1024
 # Create folders once; ignore if they already exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(ICON_UPLOAD_FOLDER, exist_ok=True)
@@ -302,6 +315,8 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 def allowed_icon_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_ICON_EXTENSIONS
+def is_admin_user(user):
+    return bool(user.is_authenticated and user.email and user.email.lower() in ADMIN_EMAILS)
 
 # --- フロントエンド用ルート (変更なし) ---
 @app.route("/")
@@ -576,6 +591,14 @@ def slack_events():
     if not _verify_slack_signature(request):
         return "Invalid signature", 403
 
+    # ③ Dedup: 応答の遅延による Slack の再送 (X-Slack-Retry-Num) や重複配信は同じ event_id で届くので、
+    #    キューに入れる前に 1 回だけ通す (重複ごとに gpt-4.1 の呼び出しと返信が発生するのを防ぐ)
+    event_id = body.get("event_id")
+    if event_id and not slack_dedup.claim_event(event_id):
+        print(f"[INFO] Duplicate Slack event ignored. Event ID: {event_id}, "
+              f"Retry: {request.headers.get('X-Slack-Retry-Num')} ({request.headers.get('X-Slack-Retry-Reason')})")
+        return "", 200
+
     # -------- extract clean_text so worker can reply ----------
     event = body.get("event", {})
     bot_user_id = body.get("authorizations", [{}])[0].get("user_id")
@@ -596,21 +619,21 @@ def slack_events():
     # enqueue async processing – do not block / avoid duplicate replies
     try:
     # ★ ペイロードの一部（例: event_idやtextの冒頭）をログに出力すると追跡しやすい
-        event_id = body.get("event_id", "N/A")
         event_type = body.get("event", {}).get("type", "N/A")
-        print(f"[INFO] Received Slack event. Event ID: {event_id}, Type: {event_type}")
+        print(f"[INFO] Received Slack event. Event ID: {event_id or 'N/A'}, Type: {event_type}")
         print(f"[DEBUG] Attempting to enqueue handle_slack_event with body (first 100 chars): {str(body)[:100]}") # ★ bodyの内容も少し出す
 
         task = handle_slack_event.delay(body) # ★ taskオブジェクトを受け取る
         print(f"[INFO] handle_slack_event enqueued successfully. Task ID: {task.id}") # ★ Task IDもログに出す
 
     except ConnectionError as e_conn: # ★ Redis接続エラーを明示的にキャッチ
+        if event_id: slack_dedup.release_event(event_id) # Slack の再送で処理できるようにする
         print(f"[CRITICAL_ERROR] Failed to enqueue task due to Redis ConnectionError: {e_conn}")
         traceback.print_exc()
         # ここでSlackにエラー応答を返すことも検討（ただしタイムアウトに注意）
         return "Failed to enqueue task due to backend issue.", 500
     except Exception as e:
-        event_id = body.get("event_id", "N/A") # エラー時にもevent_idを取得試行
+        if event_id: slack_dedup.release_event(event_id)
         print(f"[ERROR] Failed to enqueue task (Event ID: {event_id}) for unknown reason: {e}")
         traceback.print_exc()
         # ここでSlackにエラー応答を返すことも検討
@@ -822,8 +845,11 @@ def ingest_google_sheet(file_id: str, user_id: int, cell_range: str = "A1:Z1000"
             return False
 
         chunks = ["\t".join(r) for r in rows]
-        retriever.add_documents(chunks, f"gsheet:{file_id}", user_id)
-        print(f"[ingest_google_sheet] Added {len(chunks)} chunks from '{sheet_name}' ({file_id}) for user {user_id}")
+        # 変更された行だけを Embedding し、消えた行は削除する
+        if not retriever.sync_documents(chunks, f"gsheet:{file_id}", user_id):
+            print(f"[ingest_google_sheet] Failed to sync sheet {file_id} for user {user_id}")
+            return False
+        print(f"[ingest_google_sheet] Synced {len(chunks)} chunks from '{sheet_name}' ({file_id}) for user {user_id}")
         return True
     except Exception as e:
         print(f"[ingest_google_sheet] Error processing sheet {file_id}: {e}")
@@ -854,8 +880,8 @@ def ingest_google_doc():
             mimeType="text/plain"
         ).execute()
         text = raw.decode("utf-8")
-        chunks = ingestion_utils.chunk_text(text)
-        retriever.add_documents(chunks, f"gdoc:{file_id}", current_user.id)
+        if not retriever.sync_documents(ingestion_utils.iter_text_chunks(text), f"gdoc:{file_id}", current_user.id):
+            return jsonify({"status": "error", "message": "ナレッジへの登録に失敗しました"}), 500
         return jsonify({"status": "ok", "message": "Google ドキュメントを取り込みました"})
     except Exception as e:
         traceback.print_exc()
@@ -944,97 +970,219 @@ def get_sheet_rows():
         traceback.print_exc()
         return jsonify({"status": "error", "message": f"Failed fetch rows: {e}"}), 500
 
+def _resolve_conversation(data: dict, user_id: int) -> tuple[str | None, list]:
+    """
+    リクエストの conversation_id から会話履歴をサーバー側で復元する。
+    conversation_id が無ければ新しい会話を始める (旧クライアントが history を送ってきた場合はそれを使う)。
+    不正な conversation_id の場合は (None, []) を返す。
+    """
+    conversation_id = data.get("conversation_id")
+    if conversation_id:
+        if not conversation.is_valid_conversation_id(conversation_id): return None, []
+        return conversation_id, conversation.load_history(user_id, conversation_id)
+    history = data.get("history", [])
+    if not isinstance(history, list): print(f"Warning: Received invalid history format for user {user_id}. Type: {type(history)}"); history = []
+    return conversation.new_conversation_id(), history
+
+def _save_turns(user_id: int, conversation_id: str, question: str, answer: str, log_prefix: str, remember: bool = True):
+    """質問と回答を chat_history に保存し、会話キャッシュにも追加する (remember=False ならエラー記録として DB のみ)"""
+    try:
+        db.session.add_all([
+            ChatHistory(user_id=user_id, conversation_id=conversation_id, role="user", content=question),
+            ChatHistory(user_id=user_id, conversation_id=conversation_id, role="assistant", content=answer),
+        ])
+        db.session.commit()
+        print(f"--- {log_prefix} --- Saved chat history (user & assistant) for user {user_id} to DB.")
+    except Exception as db_save_error: db.session.rollback(); print(f"Error saving chat history for user {user_id} to DB: {db_save_error}"); traceback.print_exc()
+    if remember: conversation.append_turns(user_id, conversation_id, [{"role": "user", "content": question}, {"role": "assistant", "content": answer}])
+
 @app.route("/api/ask", methods=["POST"])
 @login_required
 def ask():
-    # ...(変更なし、DBへの履歴保存は実装済み)...
-    user_id = current_user.id; user_email = current_user.email; history_to_save = []; answer = "エラーが発生しました。"
+    """
+    質問に回答する。会話履歴はサーバー側で conversation_id ごとに保持するので、
+    クライアントは前回の応答で受け取った conversation_id を送るだけでよい。
+    """
+    user_id = current_user.id; user_email = current_user.email; question = None; conversation_id = None
     try:
-        data = request.json; question = data.get("question", "").strip(); history = data.get("history", [])
+        data = request.json; question = (data or {}).get("question", "").strip()
         if not data or not question: return jsonify({"error": "Question is required."}), 400
-        if not isinstance(history, list): print(f"Warning: Received invalid history format for user {user_id}. Type: {type(history)}"); history = []
-        print(f"--- API /api/ask --- User: {user_id}({user_email}), Question: '{question}', History length received: {len(history)}")
-        history_to_save.append(ChatHistory(user_id=user_id, role="user", content=question))
-        answer = answer_question(question, user_id, history)
-        history_to_save.append(ChatHistory(user_id=user_id, role="assistant", content=answer))
+        conversation_id, history = _resolve_conversation(data, user_id)
+        if conversation_id is None: return jsonify({"error": "Invalid conversation_id."}), 400
+        print(f"--- API /api/ask --- User: {user_id}({user_email}), Conversation: {conversation_id}, Question: '{question}', History length: {len(history)}")
         try:
-            db.session.add_all(history_to_save); db.session.commit()
-            print(f"--- API /api/ask --- Saved chat history (user & assistant) for user {user_id} to DB.")
-        except Exception as db_save_error: db.session.rollback(); print(f"Error saving chat history for user {user_id} to DB: {db_save_error}"); traceback.print_exc()
-        return jsonify({"answer": answer})
+            answer = answer_question(question, user_id, history); remember = True
+        except ChatError as e:
+            answer = str(e); remember = False   # エラー文言は表示・DB 記録のみで、次の質問の文脈には入れない
+        _save_turns(user_id, conversation_id, question, answer, "API /api/ask", remember=remember)
+        return jsonify({"answer": answer, "conversation_id": conversation_id})
     except Exception as e:
         print(f"Critical Error in /api/ask for user {user_id}: {e}"); traceback.print_exc()
         try:
-            error_content = f"API Error: {e}"
-            if not history_to_save: history_to_save.append(ChatHistory(user_id=user_id, role="user", content=question if 'question' in locals() else "Unknown Question"))
-            history_to_save.append(ChatHistory(user_id=user_id, role="assistant", content=error_content))
-            db.session.add_all(history_to_save); db.session.commit(); print(f"--- API /api/ask --- Saved error occurrence for user {user_id} to DB.")
+            db.session.rollback()
+            db.session.add_all([
+                ChatHistory(user_id=user_id, conversation_id=conversation_id, role="user", content=question or "Unknown Question"),
+                ChatHistory(user_id=user_id, conversation_id=conversation_id, role="assistant", content=f"API Error: {e}"),
+            ])
+            db.session.commit(); print(f"--- API /api/ask --- Saved error occurrence for user {user_id} to DB.")
         except Exception as db_error_on_error: db.session.rollback(); print(f"Failed to save error occurrence to DB for user {user_id}: {db_error_on_error}")
         return jsonify({"error": "Internal server error processing your request."}), 500
 
+def _sse(data: dict, event: str | None = None) -> str:
+    """Server-Sent Events の 1 イベント分を整形する"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route("/api/ask/stream", methods=["POST"])
+@login_required
+def ask_stream():
+    """
+    /api/ask のストリーミング版 (text/event-stream)。
+    回答の差分を `data: {"delta": "..."}` として逐次送信し、
+    完了時に `event: done` で全文と conversation_id を送る。回答を生成できなかった場合は
+    `event: error` で利用者向けのメッセージを送る。履歴はストリーム終了後に保存する。
+    """
+    user_id = current_user.id
+    data = request.json or {}
+    question = data.get("question", "").strip()
+    if not question: return jsonify({"error": "Question is required."}), 400
+    conversation_id, history = _resolve_conversation(data, user_id)
+    if conversation_id is None: return jsonify({"error": "Invalid conversation_id."}), 400
+    print(f"--- API /api/ask/stream --- User: {user_id}, Conversation: {conversation_id}, Question: '{question}', History length: {len(history)}")
+
+    def generate():
+        parts: list[str] = []
+        failed = False
+        try:
+            for delta in stream_answer(question, user_id, history):
+                parts.append(delta)
+                yield _sse({"delta": delta})
+            answer = "".join(parts).strip()
+            yield _sse({"answer": answer, "conversation_id": conversation_id}, event="done")
+        except ChatError as e:
+            answer = str(e); failed = True
+            yield _sse({"error": answer, "conversation_id": conversation_id}, event="error")
+        except Exception as e:
+            print(f"Critical Error in /api/ask/stream for user {user_id}: {e}"); traceback.print_exc()
+            answer = f"API Error: {e}"; failed = True
+            yield _sse({"error": "Internal server error processing your request."}, event="error")
+        # --- ストリーム終了後に履歴を保存 ---
+        _save_turns(user_id, conversation_id, question, answer, "API /api/ask/stream", remember=not failed)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Conversation-Id": conversation_id},
+    )
+
 # --- (他のAPIエンドポイント: /api/url, /api/upload などは変更なし) ---
+CRAWL_SOFT_TIME_LIMIT_SEC = int(os.getenv("CRAWL_SOFT_TIME_LIMIT_SEC", "3600"))
+
+def _enqueue_ingestion(job: IngestionJob, options: dict | None = None):
+    """ジョブを Celery に投入し、202 Accepted を返す"""
+    try:
+        if job.kind == "crawl":
+            # クロールは 1 ページ取り込みより長くかかるので時間制限を緩める
+            task = ingest_source.apply_async(
+                args=[job.id, options],
+                soft_time_limit=CRAWL_SOFT_TIME_LIMIT_SEC,
+                time_limit=CRAWL_SOFT_TIME_LIMIT_SEC + 60,
+            )
+        else:
+            task = ingest_source.delay(job.id)
+        print(f"[INFO] ingest_source enqueued. Job ID: {job.id}, Task ID: {task.id}")
+    except Exception as e:
+        print(f"[ERROR] Failed to enqueue ingest_source (Job ID: {job.id}): {e}"); traceback.print_exc()
+        discard_upload(job.upload_path)
+        job.status = "failed"; job.error = f"enqueue failed: {e}"; job.payload = None; job.upload_path = None
+        job.finished_at = datetime.now(timezone.utc); db.session.commit()
+        return jsonify({"status": "error", "message": "Failed to enqueue ingestion job."}), 500
+    return jsonify({
+        "status": "ok",
+        "message": f"'{job.source_name}' の取り込みを開始しました。",
+        "job_id": job.id,
+        "status_url": url_for("get_ingestion_job", job_id=job.id),
+    }), 202
+
 @app.route("/api/url", methods=["POST"])
 @login_required
 def add_url():
-    # ...(変更なし)...
-    user_id = current_user.id; data = request.json; url = data.get("url", "")
+    """
+    URL の取り込みジョブを登録する (処理は Celery の ingest_source で実行)
+    JSON: { "url": "...", "crawl": false, "max_depth": 2, "max_pages": 200, "same_domain": true }
+    crawl=true (または sitemap.xml の URL) の場合はリンク / sitemap を辿って複数ページを取り込む。
+    """
+    user_id = current_user.id; data = request.json or {}; url = data.get("url", "").strip()
     if not url: return jsonify({"status": "error", "message": "URL required"}), 400
-    print(f"User {user_id} overwriting URL: {url}"); delete_success = retriever.delete_documents_by_source(url, user_id)
-    if not delete_success: print(f"Warning: Failed delete for User {user_id}, URL {url}.")
-    text = ingestion_utils.fetch_text_from_url(url, current_user.id)
-    if not text or not text.strip(): return jsonify({"status": "error", "message": "Fetch failed or no text"}), 400
-    chunks = ingestion_utils.chunk_text(text)
-    if not chunks: return jsonify({"status": "error", "message": "No chunks generated"}), 400
-    add_success = retriever.add_documents(chunks, url, user_id)
-    if add_success: return jsonify({"status": "ok", "message": f"URL '{url}' (re)added."})
-    else: return jsonify({"status": "error", "message": f"Failed add chunks from '{url}'."}), 500
+    crawl = bool(data.get("crawl")) or is_sitemap_url(url)
+    options = None
+    if crawl:
+        try:
+            options = {
+                "max_depth": max(0, min(int(data.get("max_depth", 2)), 5)),
+                "max_pages": max(1, int(data.get("max_pages", 200))),
+                "same_domain": bool(data.get("same_domain", True)),
+            }
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "max_depth / max_pages must be integers"}), 400
+    print(f"User {user_id} queueing {'crawl' if crawl else 'URL'}: {url} {options or ''}")
+    job = IngestionJob(id=str(uuid4()), user_id=user_id, kind="crawl" if crawl else "url", source_name=url, status="queued", stage="queued")
+    db.session.add(job); db.session.commit()
+    return _enqueue_ingestion(job, options)
 
 @app.route("/api/upload", methods=["POST"])
 @login_required
 def upload_file():
-    # ...(変更なし)...
+    """ファイルの取り込みジョブを登録する (処理は Celery の ingest_source で実行)"""
     user_id = current_user.id; file = request.files.get('file')
     if not file: return jsonify({"status": "error", "message": "No file part"}), 400
     filename = secure_filename(file.filename)
     if filename == '': return jsonify({"status": "error", "message": "No selected file"}), 400
-    if allowed_file(filename):
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"user_{user_id}_{int(time.time())}_{filename}")
-        try:
-            print(f"User {user_id} overwriting File: {filename}"); delete_success = retriever.delete_documents_by_source(filename, user_id)
-            if not delete_success: print(f"Warning: Failed delete for User {user_id}, file {filename}.")
-            # Ensure upload folder exists (safe for parallel workers)
-            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-            file.save(filepath); print(f"Temp file saved for user {user_id}: {filepath}")
-            text, file_ext = None, filename.rsplit('.', 1)[1].lower()
-            print(f"Extracting text from: {filename} ({file_ext})")
-            if file_ext == 'pdf': text = ingestion_utils.extract_text_from_pdf(filepath)
-            elif file_ext in ['xls', 'xlsx']:
-                try:
-                    df = pd.read_excel(filepath)
-                    text = df.to_string(index=False)
-                except Exception as e:
-                    return jsonify({"status": "error", "message": f"Excelファイルの読み込みエラー: {e}"}), 500
-            elif file_ext == 'docx': text = ingestion_utils.extract_text_from_docx(filepath)
-            elif file_ext == 'txt':
-                 encodings_to_try = ['utf-8', 'shift-jis', 'euc-jp']; text_read = False
-                 for enc in encodings_to_try:
-                     try:
-                         with open(filepath, 'r', encoding=enc) as f: text = f.read(); print(f"Read {filename} with {enc}"); text_read = True; break
-                     except: continue
-                 if not text_read: return jsonify(status="error",message=f"Could not decode '{filename}'."),500
-            if text is None and file_ext not in ['txt']: return jsonify(status="error",message=f"Failed extract text from {file_ext}."),500
-            elif isinstance(text,str)and not text.strip(): return jsonify(status="error",message=f"No text in '{filename}'."),400
-            chunks = ingestion_utils.chunk_text(text)
-            if not chunks: return jsonify({"status": "error", "message": "No chunks generated."}), 500
-            add_success = retriever.add_documents(chunks, filename, user_id)
-            if add_success: return jsonify({"status": "ok", "message": f"File '{filename}' (re)added."})
-            else: return jsonify({"status": "error", "message": f"Failed add chunks from '{filename}'."}), 500
-        except Exception as e: print(f"Error processing file {filename} for user {user_id}: {e}"); traceback.print_exc(); return jsonify({"status": "error", "message": f"Error processing file: {e}"}), 500
-        finally:
-            if os.path.exists(filepath):
-                try: os.remove(filepath)
-                except OSError as e_rem: print(f"Error removing temp file {filepath}: {e_rem}")
-    else: return jsonify({"status": "error", "message": f"File type not allowed. Allowed: {ALLOWED_EXTENSIONS}"}), 400
+    if not allowed_file(filename): return jsonify({"status": "error", "message": f"File type not allowed. Allowed: {ALLOWED_EXTENSIONS}"}), 400
+    file_ext = filename.rsplit('.', 1)[1].lower(); is_text = file_ext == 'txt'
+    try:
+        # ブロック単位で読みながら共有ストレージへ書き出し、sha256・文字コードを求める。上限超過はその時点で打ち切る
+        upload = receive_upload(file.stream, detect_encoding=is_text, suffix=f".{file_ext}")
+    except UploadTooLarge as e: return jsonify({"status": "error", "message": str(e)}), 413
+    if upload.size == 0: discard_upload(upload.path); return jsonify({"status": "error", "message": "Empty file"}), 400
+    if is_text and upload.encoding is None: discard_upload(upload.path); return jsonify({"status": "error", "message": "Could not detect text encoding (UTF-8 / Shift_JIS / EUC-JP)"}), 400
+    if _is_unchanged_upload(user_id, filename, upload.sha256):
+        discard_upload(upload.path)
+        print(f"User {user_id} re-uploaded identical file {filename} (sha256={upload.sha256[:12]}) – skipped")
+        return jsonify({"status": "ok", "message": f"'{filename}' は前回と同じ内容のため、取り込みを省略しました。", "unchanged": True}), 200
+    try:
+        print(f"User {user_id} queueing File: {filename} ({upload.size} bytes, sha256={upload.sha256[:12]}, encoding={upload.encoding})")
+        job = IngestionJob(id=str(uuid4()), user_id=user_id, kind="file", source_name=filename, status="queued", stage="queued",
+                           upload_path=upload.path, content_sha256=upload.sha256, encoding=upload.encoding)
+        db.session.add(job); db.session.commit()
+    except Exception as e: db.session.rollback(); discard_upload(upload.path); print(f"Error queueing file {filename} for user {user_id}: {e}"); traceback.print_exc(); return jsonify({"status": "error", "message": f"Error processing file: {e}"}), 500
+    return _enqueue_ingestion(job)
+
+def _is_unchanged_upload(user_id: int, filename: str, sha256: str) -> bool:
+    """同じファイル名で最後に取り込みに成功した内容と同一で、ナレッジにも残っていれば True"""
+    last = db.session.scalars(
+        db.select(IngestionJob)
+        .filter_by(user_id=user_id, kind="file", source_name=filename, status="succeeded")
+        .order_by(IngestionJob.finished_at.desc())
+        .limit(1)
+    ).first()
+    if last is None or last.content_sha256 != sha256:
+        return False
+    # ユーザーがソースを削除済みなら取り込み直す
+    return bool(retriever.get_documents_by_source(filename, user_id, limit=1))
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    return jsonify({"status": "error", "message": f"File exceeds the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit"}), 413
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+@login_required
+def get_ingestion_job(job_id):
+    """取り込みジョブの進捗 (status / stage / message) を返す"""
+    job = db.session.get(IngestionJob, job_id)
+    if job is None or job.user_id != current_user.id:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify({"status": "ok", "job": job.to_dict()})
 
 @app.route("/api/sources", methods=["GET"])
 @login_required
@@ -1062,6 +1210,8 @@ def delete_source_api(source_name):
     user_id = current_user.id; source_name_decoded = urllib.parse.unquote(source_name); print(f"API delete request user {user_id}, source: {source_name_decoded}")
     encoded_source = quote(source_name_decoded, safe=":/?&=%#")
     success = retriever.delete_documents_by_source(encoded_source, user_id)
+    if success: ingestion_utils.delete_url_validators(user_id, encoded_source)  # URL ソースなら条件付き再取得・定期更新の対象から外す
+    if success and (answer_cache := get_answer_cache()) is not None: answer_cache.invalidate(user_id)  # 削除したソースに基づく回答を即座に捨てる
     if success: return jsonify({"status": "ok", "message": f"Source '{source_name_decoded}' deleted."})
     else: return jsonify({"status": "error", "message": f"Failed delete source '{source_name_decoded}'. Check logs."}), 500
 
@@ -1234,6 +1384,20 @@ def get_admin_user_history(user_id):
         return jsonify({"status": "error", "message": f"ユーザー {user_id} のチャット履歴取得に失敗しました。"}), 500
 # --- ▲▲▲ Admin用 履歴表示API (新規追加) ▲▲▲ ---
 
+@app.route("/api/admin/cache_stats", methods=["GET"])
+@login_required
+def get_admin_cache_stats():
+    """回答キャッシュ / Embedding キャッシュのヒット率 (このプロセス分の集計)"""
+    if not is_admin_user(current_user):
+        return jsonify({"status": "error", "message": "Unauthorized"}), 403
+    return jsonify({
+        "status": "ok",
+        "pid": os.getpid(),
+        "answer_cache": get_answer_cache_stats(),
+        "embedding_cache": get_embedding_cache_stats(),
+        "query_embedding_cache": get_query_embedding_cache_stats(),
+    })
+
 # --- ▼▼▼ Admin用 チャット履歴API (新規追加) ▼▼▼ ---
 @app.route('/api/chat_history', methods=['GET'])
 @login_required
@@ -77,6 +77,8 @@ class ChatHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     # 外部キー制約: usersテーブルのidカラムを参照
     user_id = db.Column(db.Integer, ForeignKey('users.id'), nullable=False, index=True)
+    # 会話 (セッション) ID: /api/ask が発行し、同じ会話の発言をまとめる (既存の行は NULL)
+    conversation_id = db.Column(db.String(64), nullable=True, index=True)
     role = db.Column(db.String(10), nullable=False)  # 'user' または 'assistant'
     content = db.Column(db.Text, nullable=False)
     # タイムスタンプ: レコード作成時に自動的に現在日時を記録
@@ -197,4 +199,81 @@ class GoogleCookie(db.Model):
 
     def __repr__(self):
         return f"<GoogleCookie id={self.id} user_id={self.user_id}>"
-# --- ▲▲▲ GoogleCookie モデル追加 ▲▲▲ ---
\ No newline at end of file
+# --- ▲▲▲ GoogleCookie モデル追加 ▲▲▲ ---
+# --- ▼▼▼ IngestionJob モデル (URL / ファイル取り込みの非同期ジョブ) ▼▼▼ ---
+class IngestionJob(db.Model):
+    """
+    /api/url・/api/upload で受け付けた取り込み処理を Celery で実行する際の
+    進捗レコード。GET /api/jobs/<id> がこの内容を返す。
+    """
+    __tablename__ = "ingestion_jobs"
+
+    # ステージは queued → fetching / extracting → chunking → embedding → upserting → done の順に進む
+    STAGES = ("queued", "fetching", "extracting", "chunking", "embedding", "upserting", "done")
+
+    id          = db.Column(db.String(36), primary_key=True)                # uuid4
+    user_id     = db.Column(db.Integer, ForeignKey("users.id"), nullable=False, index=True)
+    kind        = db.Column(db.String(16), nullable=False)                 # 'url' | 'file' | 'crawl'
+    source_name = db.Column(db.String(1024), nullable=False)               # URL またはファイル名
+    status      = db.Column(db.String(16), nullable=False, default="queued")  # queued / running / succeeded / failed
+    stage       = db.Column(db.String(16), nullable=False, default="queued")
+    message     = db.Column(db.Text, nullable=True)
+    error       = db.Column(db.Text, nullable=True)
+    # アップロードファイルの置き場所 (UPLOAD_STAGING_DIR 内。Worker はここから直接抽出し、処理後に削除)
+    upload_path = db.Column(db.String(1024), nullable=True)
+    # 旧方式のアップロード本体 (upload_path 導入前に登録されたジョブのみ。処理後に破棄)
+    payload     = db.Column(db.LargeBinary, nullable=True)
+    # アップロードファイルの sha256 / 検出済みエンコーディング (同一内容の再アップロード判定・txt の読み込みに使用)
+    content_sha256 = db.Column(db.String(64), nullable=True, index=True)
+    encoding    = db.Column(db.String(32), nullable=True)
+    created_at  = db.Column(DateTime(timezone=True), server_default=func.now())
+    updated_at  = db.Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    finished_at = db.Column(DateTime(timezone=True), nullable=True)
+
+    user = relationship("User", backref="ingestion_jobs")
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "source": self.source_name,
+            "status": self.status,
+            "stage": self.stage,
+            "stage_index": self.STAGES.index(self.stage) if self.stage in self.STAGES else None,
+            "stage_count": len(self.STAGES),
+            "message": self.message,
+            "error": self.error,
+            "content_sha256": self.content_sha256,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    def __repr__(self):
+        return f"<IngestionJob {self.id} user={self.user_id} {self.status}/{self.stage}>"
+# --- ▲▲▲ IngestionJob モデル追加 ▲▲▲ ---
+
+# --- ▼▼▼ UrlValidator モデル (URL ソースの条件付き再取得用) ▼▼▼ ---
+class UrlValidator(db.Model):
+    """
+    URL ソースを最後に取り込んだ時の ETag / Last-Modified / 本文ハッシュ。
+    再取得時に If-None-Match / If-Modified-Since を送り、304 または本文が同一なら
+    抽出・Embedding を丸ごと省略する。
+    """
+    __tablename__ = "url_validators"
+    __table_args__ = (db.UniqueConstraint("user_id", "url_hash", name="uq_url_validators_user_url"),)
+
+    id            = db.Column(db.Integer, primary_key=True)
+    user_id       = db.Column(db.Integer, ForeignKey("users.id"), nullable=False, index=True)
+    url           = db.Column(db.Text, nullable=False)
+    url_hash      = db.Column(db.String(40), nullable=False)     # sha1(url)
+    etag          = db.Column(db.String(512), nullable=True)
+    last_modified = db.Column(db.String(128), nullable=True)
+    body_sha1     = db.Column(db.String(40), nullable=True)      # 取得した本文 (HTML またはテキスト) の sha1
+    checked_at    = db.Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    user = relationship("User", backref="url_validators")
+
+    def __repr__(self):
+        return f"<UrlValidator user={self.user_id} url={self.url[:60]}>"
+# --- ▲▲▲ UrlValidator モデル追加 ▲▲▲ ---
@@ -0,0 +1,237 @@
+# backend/services/answer_cache.py
+"""
+Per-user semantic answer cache for standalone questions.
+
+A question is first looked up by its normalised text; failing that, its
+embedding is compared (cosine) against the user's cached questions and the
+best match above ANSWER_CACHE_SIMILARITY is served.  Entries remember the
+user's source version (source_version.py) and the prompt settings they were
+answered with, so adding or deleting sources — in any process — or editing
+the prompts makes them stale.  The cache is bounded by TTL, a per-user cap and
+a global LRU cap, and keeps hit/miss counters for monitoring.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+from backend.services import source_version
+from backend.services.embedding import get_query_embedding
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") not in ("0", "false", "False")
+ANSWER_CACHE_TTL_SEC = float(os.getenv("ANSWER_CACHE_TTL_SEC", "21600"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))   # コサイン類似度の下限
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+ANSWER_CACHE_MAX_PER_USER = int(os.getenv("ANSWER_CACHE_MAX_PER_USER", "200"))
+
+_SPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT = "?？!！。.、,， "
+
+
+def normalize_question(question: str) -> str:
+    """表記ゆれ (全角/半角・大文字小文字・空白・末尾の句読点) を吸収したキー用の文字列"""
+    text = unicodedata.normalize("NFKC", question).lower()
+    return _SPACE_RE.sub(" ", text).strip().rstrip(_TRAILING_PUNCT)
+
+
+def prompt_scope(*parts: str | None) -> str:
+    """回答に影響する設定 (ロール/タスクのプロンプト等) の指紋"""
+    return hashlib.sha1("\x1f".join(p or "" for p in parts).encode()).hexdigest()[:16]
+
+
+@dataclass
+class CacheProbe:
+    """lookup の結果。miss の場合はそのまま store に渡して回答を登録する"""
+    user_id: int
+    question: str
+    scope: str
+    text_key: str
+    version: int | None
+    embedding: np.ndarray | None = None
+    answer: str | None = None
+    similarity: float | None = None
+
+
+@dataclass
+class _Entry:
+    user_id: int
+    scope: str
+    text_key: str
+    version: int
+    vector: np.ndarray | None
+    answer: str
+    created_at: float
+
+
+class AnswerCache:
+    def __init__(self, ttl_sec: float, threshold: float, max_entries: int, max_per_user: int):
+        self.ttl_sec = ttl_sec
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_per_user = max_per_user
+        self._lru: OrderedDict[int, _Entry] = OrderedDict()      # entry id → entry (末尾が最近使用)
+        self._by_user: dict[int, dict[int, _Entry]] = {}
+        self._by_text: dict[tuple[int, str, str], int] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    # ------------------------------------------------------------------
+    def lookup(self, user_id: int, question: str, scope: str) -> CacheProbe:
+        probe = CacheProbe(user_id, question, scope, normalize_question(question), source_version.get_version(user_id))
+        if probe.version is None:
+            # ソースのバージョンが分からない (Redis 障害) 間は引きも登録もしない
+            with self._lock:
+                self.misses += 1
+            return probe
+        now = time.monotonic()
+        with self._lock:
+            self._purge_user(user_id, probe.version, now)
+            entry_id = self._by_text.get((user_id, scope, probe.text_key))
+            if entry_id is not None:
+                self._lru.move_to_end(entry_id)
+                self.exact_hits += 1
+                probe.answer, probe.similarity = self._lru[entry_id].answer, 1.0
+                return probe
+            has_candidates = any(e.scope == scope and e.vector is not None for e in self._by_user.get(user_id, {}).values())
+
+        # 完全一致が無ければ質問の Embedding で近い質問を探す
+        # (候補がある時だけ取得する。取得したベクトルはクエリ Embedding キャッシュに残るので検索側で再利用される)
+        if has_candidates:
+            probe.embedding = _unit_vector(get_query_embedding(question))
+        if probe.embedding is not None:
+            with self._lock:
+                candidates = [(i, e) for i, e in self._by_user.get(user_id, {}).items()
+                              if e.scope == scope and e.vector is not None and e.vector.shape == probe.embedding.shape]
+                if candidates:
+                    sims = np.stack([e.vector for _, e in candidates]) @ probe.embedding
+                    best = int(np.argmax(sims))
+                    if sims[best] >= self.threshold:
+                        entry_id, entry = candidates[best]
+                        self._lru.move_to_end(entry_id)
+                        self.semantic_hits += 1
+                        probe.answer, probe.similarity = entry.answer, float(sims[best])
+                        return probe
+        with self._lock:
+            self.misses += 1
+        return probe
+
+    def store(self, probe: CacheProbe, answer: str) -> None:
+        """lookup 時点のソースバージョンで回答を登録する (その間にソースが変われば登録しない)"""
+        if not answer or probe.answer is not None or probe.version is None:
+            return
+        if source_version.get_version(probe.user_id) != probe.version:
+            return
+        if probe.embedding is None:
+            # 検索時に同じ質問の Embedding を取得済みなので、通常はクエリ Embedding キャッシュから返る
+            probe.embedding = _unit_vector(get_query_embedding(probe.question))
+        with self._lock:
+            key = (probe.user_id, probe.scope, probe.text_key)
+            if key in self._by_text:
+                self._remove(self._by_text[key])
+            entry_id = self._next_id
+            self._next_id += 1
+            entry = _Entry(probe.user_id, probe.scope, probe.text_key, probe.version, probe.embedding, answer, time.monotonic())
+            self._lru[entry_id] = entry
+            user_entries = self._by_user.setdefault(probe.user_id, {})
+            user_entries[entry_id] = entry
+            self._by_text[key] = entry_id
+            if len(user_entries) > self.max_per_user:
+                self._remove(next(i for i in self._lru if i in user_entries))   # そのユーザーの最も古い利用
+                self.evictions += 1
+            while len(self._lru) > self.max_entries:
+                self._remove(next(iter(self._lru)))
+                self.evictions += 1
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            for entry_id in list(self._by_user.get(user_id, {})):
+                self._remove(entry_id)
+                self.invalidations += 1
+
+    def stats(self) -> dict[str, float | int]:
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            total = hits + self.misses
+            return {
+                "entries": len(self._lru),
+                "users": len(self._by_user),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "hit_rate": (hits / total) if total else 0.0,
+            }
+
+    # ------------------------------------------------------------------
+    def _purge_user(self, user_id: int, version: int, now: float) -> None:
+        """ソースが更新された / TTL 切れのエントリを捨てる (lock 保持中に呼ぶ)"""
+        for entry_id, entry in list(self._by_user.get(user_id, {}).items()):
+            if entry.version != version:
+                self._remove(entry_id)
+                self.invalidations += 1
+            elif now - entry.created_at >= self.ttl_sec:
+                self._remove(entry_id)
+                self.expirations += 1
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._lru.pop(entry_id, None)
+        if entry is None:
+            return
+        user_entries = self._by_user.get(entry.user_id)
+        if user_entries is not None:
+            user_entries.pop(entry_id, None)
+            if not user_entries:
+                del self._by_user[entry.user_id]
+        key = (entry.user_id, entry.scope, entry.text_key)
+        if self._by_text.get(key) == entry_id:
+            del self._by_text[key]
+
+
+def _unit_vector(embedding) -> np.ndarray | None:
+    if not embedding:
+        return None
+    vec = np.asarray(embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else None
+
+
+_cache: AnswerCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> AnswerCache | None:
+    """Return the process-wide answer cache, or None when disabled."""
+    global _cache
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AnswerCache(ANSWER_CACHE_TTL_SEC, ANSWER_CACHE_SIMILARITY,
+                                     ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_PER_USER)
+    return _cache
+
+
+def get_answer_cache_stats() -> dict:
+    cache = get_cache()
+    return cache.stats() if cache is not None else {}
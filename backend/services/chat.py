@@ -12,6 +12,8 @@ from backend.models import User, DEFAULT_PROMPT_ROLE, DEFAULT_PROMPT_TASK  # デ
 
 # retriever から関数を直接インポート
 from backend.services.retriever import retrieve_similar_docs
+from backend.services import answer_cache
+from backend.services import prompt_builder
 
 load_dotenv()
 
@@ -27,24 +29,52 @@ except AttributeError: print("CRITICAL ERROR: openai.OpenAI() not found. Ensure
 except Exception as init_error: print(f"CRITICAL: Failed to init OpenAI client: {init_error}"); traceback.print_exc()
 
 
-# --- ▼▼▼ answer_question 関数 (history引数を追加、messages構築を変更、モデル名指定) ▼▼▼ ---
-def answer_question(question: str, user_id: int, history: list[dict] = []) -> str:
+CHAT_MODEL = "gpt-4.1"
+CHAT_TEMPERATURE = 0.3 # 応答の多様性を少し出す
+CHAT_MAX_TOKENS = 1500 # 回答の最大トークン数
+CHAT_RETRIEVAL_TOP_K = int(os.getenv("CHAT_RETRIEVAL_TOP_K", "3")) # 検索するチャンク数 (実際に入る数はトークン予算次第)
+
+# 予算に入りきらない古い会話を要約して残す (要約のために 1 回 API を呼ぶので既定は無効)
+CHAT_HISTORY_SUMMARY_ENABLED = os.getenv("CHAT_HISTORY_SUMMARY_ENABLED", "0") in ("1", "true", "True")
+CHAT_SUMMARY_MODEL = os.getenv("CHAT_SUMMARY_MODEL", "gpt-4.1-mini")
+CHAT_HISTORY_SUMMARY_TOKENS = int(os.getenv("CHAT_HISTORY_SUMMARY_TOKENS", "300"))
+CHAT_SUMMARY_INPUT_TOKENS = 8000   # 要約に渡す古い会話の上限 (新しい側から)
+
+
+class ChatError(Exception):
+    """回答を生成できなかった。str(e) はそのまま利用者に表示できるメッセージ (会話履歴には残さない)"""
+
+
+# --- ▼▼▼ プロンプト構築 (answer_question / stream_answer 共通) ▼▼▼ ---
+def _load_prompts(user_id: int) -> tuple[str, str]:
+    """データベースからユーザーのロール/タスクプロンプトを取得 (ユーザーが存在しない or 未設定ならデフォルト値)"""
+    user = None
+    try:
+        user = db.session.get(User, user_id)
+        if user is None:
+             print(f"Warning in answer_question: User with id {user_id} not found in DB. Using default prompts.")
+    except Exception as db_error:
+        print(f"Error fetching user {user_id} from DB in answer_question: {db_error}")
+        traceback.print_exc()
+        # DBエラーの場合もデフォルトプロンプトを使用
+    role_prompt = user.current_prompt_role if user else DEFAULT_PROMPT_ROLE
+    task_prompt = user.current_prompt_task if user else DEFAULT_PROMPT_TASK
+    return role_prompt, task_prompt
+
+
+def _prepare_messages(question: str, user_id: int, history: list[dict],
+                      prompts: tuple[str, str] | None = None) -> tuple[list[dict] | None, str | None]:
     """
-    質問応答の中核機能。会話履歴と指定されたユーザーのDB設定、知識を使って回答を生成。
-    Args:
-        question (str): ユーザーからの現在の質問。
-        user_id (int): ユーザーID。
-        history (list[dict]): 会話履歴。各要素は {"role": "user" or "assistant", "content": ...} の形式。
+    OpenAI API に渡す messages を構築する。
     Returns:
-        str: AIからの回答。
+        (messages, None) 成功時 / (None, エラー時にユーザーへ返す文言) 失敗時
     """
-    global client
     if client is None:
         print("Error in answer_question: OpenAI client is not initialized (None). Check initialization logs.")
-        return "申し訳ありません、AIモデルへの接続設定に問題があります。"
+        return None, "申し訳ありません、AIモデルへの接続設定に問題があります。"
     if user_id is None:
         print("Error in answer_question: user_id is required but was None.")
-        return "エラー：ユーザー情報が特定できません。"
+        return None, "エラー：ユーザー情報が特定できません。"
     if not isinstance(history, list): # history の型チェックを追加
         print(f"Warning in answer_question: received invalid history type: {type(history)}. Resetting to empty list for user {user_id}.")
         history = []
@@ -57,53 +87,50 @@ def answer_question(question: str, user_id: int, history: list[dict] = []) -> st
     #     print(f"--- [DEBUG Chat Service] Received History Content (last 2 items): {history[-2:]}")
 
     # --- データベースからユーザー設定（プロンプト含む）を取得 ---
-    user = None
-    try:
-        user = db.session.get(User, user_id)
-        if user is None:
-             print(f"Warning in answer_question: User with id {user_id} not found in DB. Using default prompts.")
-    except Exception as db_error:
-        print(f"Error fetching user {user_id} from DB in answer_question: {db_error}")
-        traceback.print_exc()
-        # DBエラーの場合もデフォルトプロンプトを使用
-
-    # プロンプトを取得 (ユーザーが存在しない or 未設定ならデフォルト値)
-    role_prompt = user.current_prompt_role if user else DEFAULT_PROMPT_ROLE
-    task_prompt = user.current_prompt_task if user else DEFAULT_PROMPT_TASK
+    role_prompt, task_prompt = prompts or _load_prompts(user_id)
     print(f"--- [DEBUG Chat Service] Using Role Prompt: '{role_prompt[:50]}...'")
     print(f"--- [DEBUG Chat Service] Using Task Prompt: '{task_prompt[:50]}...'")
 
+    # --- 予算計算の基準: システムプロンプト (Role, Task) と質問は必ず入る ---
+    budget = prompt_builder.PromptBudget()
+    base_system = f"{role_prompt}\n\n{task_prompt}"
+    budget.base = (prompt_builder.count_tokens(base_system, CHAT_MODEL) + prompt_builder.count_tokens(question, CHAT_MODEL)
+                   + 2 * prompt_builder.MESSAGE_OVERHEAD_TOKENS)
+
     # --- 1. 類似ドキュメントを取得 ---
     results = None
     context = "" # コンテキストは必ず初期化しておく
     try:
         print(f"--- [DEBUG Chat Service] Retrieving similar documents for user {user_id}...")
-        results = retrieve_similar_docs(question, user_id, top_k=3) # retriever.py 内の関数を呼び出し
+        results = retrieve_similar_docs(question, user_id, top_k=CHAT_RETRIEVAL_TOP_K) # retriever.py 内の関数を呼び出し
         if results and results.get('documents') and results['documents'][0]:
-            context_texts = results['documents'][0]
-            context = "\n\n---\n\n".join(context_texts) # コンテキスト文字列を作成
-            print(f"--- [DEBUG Chat Service] Found {len(context_texts)} relevant chunks.")
+            docs = results['documents'][0]
+            metadatas = (results.get('metadatas') or [[]])[0] or []
+            # 隣接チャンクはオーバーラップ分の本文を共有しているので、重なりを除いてから詰める
+            deduped = prompt_builder.dedupe_chunks(docs)
+            # 構造化チャンクは見出しパスを添えて渡す (どの節の記述かをモデルが判断できるように)
+            context_texts = []
+            for index, text in deduped:
+                meta = metadatas[index] if index < len(metadatas) else None
+                context_texts.append(f"【{meta['heading_path']}】\n{text}" if isinstance(meta, dict) and meta.get('heading_path') else text)
+            context_texts, budget.context = prompt_builder.pack_context(context_texts, budget.context_budget(), CHAT_MODEL)
+            budget.chunks_in, budget.chunks_kept = len(docs), len(context_texts)
+            context = prompt_builder.CONTEXT_SEPARATOR.join(context_texts) # コンテキスト文字列を作成
+            print(f"--- [DEBUG Chat Service] Found {len(docs)} relevant chunks, {len(context_texts)} used after dedupe/budget.")
         else:
             print(f"--- [DEBUG Chat Service] No relevant chunks found.")
     except Exception as retrieve_error:
         print(f"Error during retrieval for user {user_id} in answer_question: {retrieve_error}");
         traceback.print_exc()
         # 検索エラーが発生しても処理は続行するが、エラーメッセージを返す
-        return "関連情報の検索中にエラーが発生しました。"
+        return None, "関連情報の検索中にエラーが発生しました。"
 
     print(f"--- [DEBUG Chat Service] Context length (chars): {len(context)}")
     # コンテキスト内容のログ (必要な場合のみコメント解除)
     # if context:
     #     print(f"--- [DEBUG Chat Service] Context Content Snippet:\n{context[:200]}...")
 
-    # --- 3. OpenAI APIに渡すメッセージリストの構築 ---
-    # システムプロンプト (Role, Task, Context を結合)
-    system_message_content = f"{role_prompt}\n\n{task_prompt}"
-    if context: # コンテキストがある場合のみ追加
-        system_message_content += f"\n\n【内部文書（コンテキスト）】\n{context}"
-    system_message = {"role": "system", "content": system_message_content}
-
-    # 会話履歴を整形 (不正な形式はスキップ)
+    # --- 2. 会話履歴を整形 (不正な形式はスキップ) し、新しい発言から予算内に詰める ---
     history_messages = []
     invalid_history_items = 0
     for message in history:
@@ -116,6 +143,29 @@ def answer_question(question: str, user_id: int, history: list[dict] = []) -> st
     if invalid_history_items > 0:
         print(f"--- [DEBUG Chat Service] Skipped {invalid_history_items} invalid history items for user {user_id}.")
 
+    budget.turns_in = len(history_messages)
+    history_budget = budget.history_budget()
+    kept, dropped, budget.history = prompt_builder.pack_history(history_messages, history_budget, CHAT_MODEL)
+    history_summary = None
+    if dropped and CHAT_HISTORY_SUMMARY_ENABLED:
+        # 要約の分だけ枠を空けて詰め直し、入りきらない古い発言を要約に置き換える
+        kept, dropped, budget.history = prompt_builder.pack_history(
+            history_messages, max(0, history_budget - CHAT_HISTORY_SUMMARY_TOKENS), CHAT_MODEL)
+        history_summary = _summarize_history(dropped, user_id)
+        if history_summary:
+            budget.history += prompt_builder.count_tokens(history_summary, CHAT_MODEL)
+    budget.turns_kept = len(kept)
+    history_messages = kept
+
+    # --- 3. OpenAI APIに渡すメッセージリストの構築 ---
+    # システムプロンプト (Role, Task, 会話の要約, Context を結合)
+    system_message_content = base_system
+    if history_summary:
+        system_message_content += f"\n\n【これまでの会話の要約】\n{history_summary}"
+    if context: # コンテキストがある場合のみ追加
+        system_message_content += f"\n\n【内部文書（コンテキスト）】\n{context}"
+    system_message = {"role": "system", "content": system_message_content}
+
     # 最新のユーザー質問
     # コンテキストはシステムメッセージに含まれているので、質問のみでOK
     user_message = {"role": "user", "content": question}
@@ -123,58 +173,189 @@ def answer_question(question: str, user_id: int, history: list[dict] = []) -> st
     # メッセージリストを結合 [システム, 過去の会話..., 最新の質問] の順序
     messages = [system_message] + history_messages + [user_message]
 
+    print(f"--- [DEBUG Chat Service] {budget.summary()}")
     print(f"--- [DEBUG Chat Service] Total messages constructed for OpenAI API: {len(messages)}")
     # メッセージ内容のログ (必要ならコメント解除)
     # print("--- [DEBUG Chat Service] Messages for OpenAI API (Snippets):")
     # for i, msg in enumerate(messages):
     #     print(f"  [{i}] Role: {msg['role']}, Content: {msg['content'][:70]}...")
+    return messages, None
 
 
-    # --- 4. OpenAI API 呼び出し ---
+def _summarize_history(turns: list[dict], user_id: int) -> str | None:
+    """予算からあふれた古い会話を短く要約する (失敗時は None = 要約なしで続行)"""
+    turns, _, _ = prompt_builder.pack_history(turns, CHAT_SUMMARY_INPUT_TOKENS, CHAT_MODEL)
+    if not turns:
+        return None
+    transcript = "\n".join(f"{'ユーザー' if t['role'] == 'user' else 'アシスタント'}: {t['content']}" for t in turns)
     try:
-        print(f"--- [DEBUG Chat Service] Sending request to OpenAI API (Model: gpt-4.1)...")
         response = client.chat.completions.create(
-            model="gpt-4.1", # ★★★ モデル名を指定 ★★★
-            messages=messages,
-            temperature=0.3, # 応答の多様性を少し出す
-            max_tokens=1500  # 回答の最大トークン数
-            # stream=False # ストリーミングは今回は使用しない
+            model=CHAT_SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": "以下の会話を、後続の質問に答えるために必要な事実・前提・決定事項に絞って簡潔に要約してください。"},
+                {"role": "user", "content": transcript},
+            ],
+            temperature=0,
+            max_tokens=CHAT_HISTORY_SUMMARY_TOKENS,
         )
-        answer = response.choices[0].message.content.strip()
-        finish_reason = response.choices[0].finish_reason
-        usage = response.usage # トークン使用量
+        summary = (response.choices[0].message.content or "").strip()
+        print(f"--- [DEBUG Chat Service] Summarized {len(turns)} older turns for user {user_id} ({len(summary)} chars).")
+        return summary or None
+    except Exception as e:
+        print(f"Warning: history summarization failed for user {user_id}: {e}")
+        return None
+# --- ▲▲▲ プロンプト構築 ▲▲▲ ---
 
-        print(f"--- [DEBUG Chat Service] Received answer from OpenAI (Finish reason: {finish_reason})")
-        if usage:
-            print(f"--- [DEBUG Chat Service] OpenAI API Token Usage: Prompt={usage.prompt_tokens}, Completion={usage.completion_tokens}, Total={usage.total_tokens}")
-        else:
-            print("--- [DEBUG Chat Service] OpenAI API Token Usage information not available in response.")
 
-        return answer
+# --- ▼▼▼ 回答キャッシュ (履歴の無い単独の質問のみ) ▼▼▼ ---
+def _probe_answer_cache(question: str, user_id: int, history) -> tuple[answer_cache.CacheProbe | None, tuple[str, str] | None]:
+    """
+    キャッシュを引く。戻り値は (probe, prompts)。
+    probe.answer があればそれが回答。probe が None ならキャッシュ対象外。
+    """
+    cache = answer_cache.get_cache()
+    if cache is None or history or user_id is None or client is None:
+        return None, None
+    prompts = _load_prompts(user_id)
+    try:
+        probe = cache.lookup(user_id, question, answer_cache.prompt_scope(CHAT_MODEL, *prompts))
+    except Exception as cache_error:
+        print(f"Warning: answer cache lookup failed for user {user_id}: {cache_error}")
+        return None, prompts
+    if probe.answer is not None:
+        stats = cache.stats()
+        print(f"--- [DEBUG Chat Service] Answer cache hit for user {user_id} (similarity={probe.similarity:.3f}, hit rate={stats['hit_rate']:.1%})")
+    return probe, prompts
 
-    # --- エラーハンドリング ---
-    except openai.AuthenticationError as e:
+
+def _store_answer_cache(probe: answer_cache.CacheProbe | None, answer: str, finish_reason: str | None) -> None:
+    """正常終了した回答だけを登録する (途中で打ち切られた回答やエラー文言は登録しない)"""
+    if probe is None or finish_reason != "stop":
+        return
+    try:
+        answer_cache.get_cache().store(probe, answer)
+    except Exception as cache_error:
+        print(f"Warning: answer cache store failed for user {probe.user_id}: {cache_error}")
+# --- ▲▲▲ 回答キャッシュ ▲▲▲ ---
+
+
+# --- ▼▼▼ OpenAI 例外 → ユーザー向けメッセージ ▼▼▼ ---
+def _openai_error_message(e: Exception) -> str:
+    if isinstance(e, openai.AuthenticationError):
         error_msg = f"OpenAI Authentication Error: {e}. Check your API key."
         print(error_msg); traceback.print_exc();
         return "AI認証エラーが発生しました。管理者にお問い合わせください。(APIキー設定を確認してください)"
-    except openai.RateLimitError as e:
+    if isinstance(e, openai.RateLimitError):
         error_msg = f"OpenAI Rate Limit Error: {e}. Please wait and try again later."
         print(error_msg); traceback.print_exc();
         return "AIへのリクエストが制限を超えました。しばらくしてから再度お試しください。"
-    except openai.NotFoundError as e:
-        error_msg = f"OpenAI Not Found Error (Model 'gpt-4.1' might be unavailable or misspelled): {e}"
+    if isinstance(e, openai.NotFoundError):
+        error_msg = f"OpenAI Not Found Error (Model '{CHAT_MODEL}' might be unavailable or misspelled): {e}"
         print(error_msg); traceback.print_exc();
         return "AIモデルが見つかりませんでした。管理者にお問い合わせください。"
-    except openai.APIConnectionError as e:
+    if isinstance(e, openai.APIConnectionError):
         error_msg = f"OpenAI API Connection Error: {e}. Check network connectivity."
         print(error_msg); traceback.print_exc();
         return "AIサービスへの接続に失敗しました。ネットワーク接続を確認してください。"
-    except openai.APIStatusError as e: # APIからのステータスエラー (例: 5xx)
+    if isinstance(e, openai.APIStatusError): # APIからのステータスエラー (例: 5xx)
         error_msg = f"OpenAI API Status Error: {e.status_code} - {e.message}"
         print(error_msg); traceback.print_exc();
         return f"AIサービスでエラーが発生しました (コード: {e.status_code})。しばらくしてから再度お試しください。"
+    error_msg = f"An unexpected error occurred during OpenAI API call: {e}"
+    print(error_msg); traceback.print_exc();
+    return "AIとの通信中に予期せぬエラーが発生しました。"
+# --- ▲▲▲ OpenAI 例外 → ユーザー向けメッセージ ▲▲▲ ---
+
+
+# --- ▼▼▼ answer_question 関数 (history引数を追加、messages構築を変更、モデル名指定) ▼▼▼ ---
+def answer_question(question: str, user_id: int, history: list[dict] = []) -> str:
+    """
+    質問応答の中核機能。会話履歴と指定されたユーザーのDB設定、知識を使って回答を生成。
+    Args:
+        question (str): ユーザーからの現在の質問。
+        user_id (int): ユーザーID。
+        history (list[dict]): 会話履歴。各要素は {"role": "user" or "assistant", "content": ...} の形式。
+    Returns:
+        str: AIからの回答。
+    Raises:
+        ChatError: 回答を生成できなかった場合 (メッセージは利用者向け)。
+    """
+    probe, prompts = _probe_answer_cache(question, user_id, history)
+    if probe is not None and probe.answer is not None:
+        return probe.answer
+
+    messages, error_answer = _prepare_messages(question, user_id, history, prompts)
+    if messages is None:
+        raise ChatError(error_answer)
+
+    # --- 4. OpenAI API 呼び出し ---
+    try:
+        print(f"--- [DEBUG Chat Service] Sending request to OpenAI API (Model: {CHAT_MODEL})...")
+        response = client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=messages,
+            temperature=CHAT_TEMPERATURE,
+            max_tokens=CHAT_MAX_TOKENS
+        )
+        answer = response.choices[0].message.content.strip()
+        finish_reason = response.choices[0].finish_reason
+        usage = response.usage # トークン使用量
+
+        print(f"--- [DEBUG Chat Service] Received answer from OpenAI (Finish reason: {finish_reason})")
+        if usage:
+            print(f"--- [DEBUG Chat Service] OpenAI API Token Usage: Prompt={usage.prompt_tokens}, Completion={usage.completion_tokens}, Total={usage.total_tokens}")
+        else:
+            print("--- [DEBUG Chat Service] OpenAI API Token Usage information not available in response.")
+
+        _store_answer_cache(probe, answer, finish_reason)
+        return answer
+
+    # --- エラーハンドリング ---
     except Exception as e:
-        error_msg = f"An unexpected error occurred during OpenAI API call: {e}"
-        print(error_msg); traceback.print_exc();
-        return "AIとの通信中に予期せぬエラーが発生しました。"
-# --- ▲▲▲ answer_question 関数を修正 ▲▲▲
\ No newline at end of file
+        raise ChatError(_openai_error_message(e)) from e
+# --- ▲▲▲ answer_question 関数を修正 ▲▲▲
+
+
+# --- ▼▼▼ stream_answer 関数 (トークン単位のストリーミング) ▼▼▼ ---
+def stream_answer(question: str, user_id: int, history: list[dict] = []):
+    """
+    answer_question のストリーミング版。回答の差分テキストを生成順に yield する。
+    生成できなかった場合は (途中まで yield していても) ChatError を送出する。
+    """
+    probe, prompts = _probe_answer_cache(question, user_id, history)
+    if probe is not None and probe.answer is not None:
+        yield probe.answer
+        return
+
+    messages, error_answer = _prepare_messages(question, user_id, history, prompts)
+    if messages is None:
+        raise ChatError(error_answer)
+
+    try:
+        print(f"--- [DEBUG Chat Service] Streaming request to OpenAI API (Model: {CHAT_MODEL})...")
+        stream = client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=messages,
+            temperature=CHAT_TEMPERATURE,
+            max_tokens=CHAT_MAX_TOKENS,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        finish_reason = None
+        parts: list[str] = []
+        for chunk in stream:
+            if chunk.usage:
+                print(f"--- [DEBUG Chat Service] OpenAI API Token Usage: Prompt={chunk.usage.prompt_tokens}, Completion={chunk.usage.completion_tokens}, Total={chunk.usage.total_tokens}")
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            if choice.delta and choice.delta.content:
+                parts.append(choice.delta.content)
+                yield choice.delta.content
+        print(f"--- [DEBUG Chat Service] Finished streaming answer from OpenAI (Finish reason: {finish_reason})")
+        _store_answer_cache(probe, "".join(parts).strip(), finish_reason)
+    except Exception as e:
+        raise ChatError(_openai_error_message(e)) from e
+# --- ▲▲▲ stream_answer 関数 ▲▲▲
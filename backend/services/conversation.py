@@ -0,0 +1,175 @@
+# backend/services/conversation.py
+"""
+Server-side conversation sessions.
+
+Each conversation keeps its most recent turns in Redis (one list per
+conversation, trimmed to CONVERSATION_MAX_MESSAGES and expiring after
+CONVERSATION_TTL_SEC of inactivity), so /api/ask can rebuild the history from
+a `conversation_id` instead of having the browser resend it.  Without Redis an
+in-process LRU is used.  On a cache miss the turns are reloaded from the
+`chat_history` table, which remains the durable record.
+
+Retention is bounded both by message count and by CONVERSATION_MAX_TOKENS:
+each stored turn carries its token count, and the oldest turns are trimmed
+once the total exceeds the limit.  Slack threads use the same store, keyed by
+(team, channel, thread_ts), so follow-ups need no conversations.replies call.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from uuid import uuid4
+
+from backend.extensions import db
+from backend.models import ChatHistory
+from backend.services.prompt_builder import count_tokens
+from backend.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "20"))   # user/assistant 合わせた件数
+CONVERSATION_TTL_SEC = int(os.getenv("CONVERSATION_TTL_SEC", str(24 * 3600)))
+CONVERSATION_MAX_TOKENS = int(os.getenv("CONVERSATION_MAX_TOKENS", "4000"))    # 保持する発言のトークン数の上限
+CONVERSATION_LOCAL_MAX = int(os.getenv("CONVERSATION_LOCAL_MAX", "1000"))       # Redis が無い場合にプロセス内で保持する会話数
+TOKEN_COUNT_MODEL = "gpt-4.1"
+
+_KEY = "aiqly:conv:{user_id}:{conversation_id}"
+_ID_RE = re.compile(r"^[A-Za-z0-9_.:-]{1,64}$")
+
+_local: OrderedDict[str, tuple[float, deque]] = OrderedDict()   # key → (最終更新, 発言)
+_local_lock = threading.Lock()
+
+
+def new_conversation_id() -> str:
+    return uuid4().hex
+
+
+def slack_thread_id(team_id: str, channel_id: str, thread_ts: str) -> str:
+    """Slack スレッドの会話 ID (チーム・チャンネル・スレッドの親メッセージの ts で一意)"""
+    return f"slack:{team_id}:{channel_id}:{thread_ts}"
+
+
+def is_valid_conversation_id(conversation_id) -> bool:
+    return isinstance(conversation_id, str) and bool(_ID_RE.match(conversation_id))
+
+
+def _key(user_id: int, conversation_id: str) -> str:
+    # ユーザー ID を含めて、他人の conversation_id を指定しても履歴が読めないようにする
+    return _KEY.format(user_id=user_id, conversation_id=conversation_id)
+
+
+def _load_from_db(user_id: int, conversation_id: str) -> list[dict]:
+    rows = db.session.scalars(
+        db.select(ChatHistory)
+        .where(ChatHistory.user_id == user_id, ChatHistory.conversation_id == conversation_id)
+        .order_by(ChatHistory.id.desc())
+        .limit(CONVERSATION_MAX_MESSAGES)
+    ).all()
+    return [{"role": row.role, "content": row.content} for row in reversed(rows)]
+
+
+def _with_tokens(message: dict) -> dict:
+    """保存形式: role / content に加えてトークン数を持たせ、トリム時に数え直さない"""
+    return {"role": message["role"], "content": message["content"],
+            "tokens": message.get("tokens") or count_tokens(message["content"], TOKEN_COUNT_MODEL)}
+
+
+def _excess(turns: list[dict]) -> int:
+    """トークン上限に収めるために先頭から捨てる件数 (最新の 1 往復は必ず残す)"""
+    total = sum(t.get("tokens", 0) for t in turns)
+    drop = 0
+    while total > CONVERSATION_MAX_TOKENS and len(turns) - drop > 2:
+        total -= turns[drop].get("tokens", 0)
+        drop += 1
+    # 残りが回答から始まらないよう、対応する質問と一緒に捨てる
+    while drop and drop < len(turns) - 2 and turns[drop].get("role") == "assistant":
+        drop += 1
+    return drop
+
+
+def _cache_get(key: str) -> list[dict] | None:
+    client = get_redis()
+    if client is not None:
+        try:
+            pipe = client.pipeline()
+            pipe.lrange(key, 0, -1)
+            pipe.expire(key, CONVERSATION_TTL_SEC)
+            raw, _ = pipe.execute()
+            if raw:
+                return [json.loads(item) for item in raw]
+            return None
+        except Exception as e:
+            logger.warning("Conversation cache read failed for %s: %s", key, e)
+    with _local_lock:
+        entry = _local.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= CONVERSATION_TTL_SEC:
+            del _local[key]
+            return None
+        _local.move_to_end(key)
+        return list(entry[1])
+
+
+def _cache_append(key: str, messages: list[dict]) -> None:
+    messages = [_with_tokens(m) for m in messages]
+    client = get_redis()
+    if client is not None:
+        try:
+            pipe = client.pipeline()
+            pipe.rpush(key, *[json.dumps(m, ensure_ascii=False, separators=(",", ":")) for m in messages])
+            pipe.ltrim(key, -CONVERSATION_MAX_MESSAGES, -1)
+            pipe.expire(key, CONVERSATION_TTL_SEC)
+            pipe.lrange(key, 0, -1)
+            raw = pipe.execute()[-1]
+            drop = _excess([json.loads(item) for item in raw])
+            if drop:
+                client.ltrim(key, drop, -1)
+            return
+        except Exception as e:
+            logger.warning("Conversation cache write failed for %s: %s", key, e)
+    with _local_lock:
+        entry = _local.get(key)
+        turns = entry[1] if entry is not None else deque(maxlen=CONVERSATION_MAX_MESSAGES)
+        turns.extend(messages)
+        for _ in range(_excess(list(turns))):
+            turns.popleft()
+        _local[key] = (time.monotonic(), turns)
+        _local.move_to_end(key)
+        while len(_local) > CONVERSATION_LOCAL_MAX:
+            _local.popitem(last=False)
+
+
+def load_history(user_id: int, conversation_id: str, db_fallback: bool = True) -> list[dict]:
+    """
+    会話の直近の発言を [{"role", "content", "tokens"}, ...] (古い順) で返す。
+    キャッシュに無ければ chat_history テーブルから読み直してキャッシュに載せる
+    (db_fallback=False なら読み直さない: DB に保存しない Slack スレッド用)。
+    """
+    key = _key(user_id, conversation_id)
+    history = _cache_get(key)
+    if history is not None:
+        return history
+    if not db_fallback:
+        return []
+    try:
+        history = _load_from_db(user_id, conversation_id)
+    except Exception as e:
+        logger.warning("Failed to load conversation %s for user %s from DB: %s", conversation_id, user_id, e)
+        return []
+    if history:
+        _cache_append(key, history)
+        history = _cache_get(key) or history      # トークン上限でトリムされた状態に揃える
+    return history
+
+
+def append_turns(user_id: int, conversation_id: str, messages: list[dict]) -> None:
+    """発言 (質問と回答) を会話キャッシュの末尾に追加する。DB への保存は呼び出し側で行う"""
+    if messages:
+        _cache_append(_key(user_id, conversation_id), messages)
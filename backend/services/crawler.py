@@ -0,0 +1,324 @@
+# backend/services/crawler.py
+"""
+Multi-page crawl ingestion.
+
+Starting from a seed URL (HTML page or sitemap.xml) pages are fetched
+concurrently by a bounded thread pool with per-host politeness limits,
+deduplicated by canonical URL and by content hash, and each page is fed
+through the regular extract_structured_text → iter_text_chunks → retriever path
+as its own source.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from urllib.parse import urljoin, urlparse, urlunparse
+from urllib.robotparser import RobotFileParser
+
+import requests
+
+from backend.services import ingestion, retriever
+from backend.services.html_parser import parse_html
+
+logger = logging.getLogger(__name__)
+
+CRAWL_USER_AGENT = "Mozilla/5.0 (compatible; AiQlyBot/1.0)"
+CRAWL_MAX_WORKERS = int(os.getenv("CRAWL_MAX_WORKERS", "8"))
+CRAWL_PER_HOST_CONCURRENCY = int(os.getenv("CRAWL_PER_HOST_CONCURRENCY", "2"))
+CRAWL_PER_HOST_DELAY_SEC = float(os.getenv("CRAWL_PER_HOST_DELAY_SEC", "0.5"))
+CRAWL_MAX_PAGES_LIMIT = int(os.getenv("CRAWL_MAX_PAGES_LIMIT", "1000"))
+
+_SKIP_EXTENSIONS = (
+    ".jpg", ".jpeg", ".png", ".gif", ".svg", ".webp", ".ico", ".css", ".js", ".zip", ".gz",
+    ".mp3", ".mp4", ".mov", ".avi", ".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx",
+)
+
+
+def canonicalize_url(url: str) -> str:
+    """スキーム・ホストを小文字化し、フラグメントと末尾スラッシュの揺れを除いた URL"""
+    parsed = urlparse(url.strip())
+    path = parsed.path or "/"
+    if len(path) > 1 and path.endswith("/"):
+        path = path.rstrip("/")
+    netloc = parsed.netloc.lower()
+    if (parsed.scheme == "http" and netloc.endswith(":80")) or (parsed.scheme == "https" and netloc.endswith(":443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    return urlunparse((parsed.scheme.lower(), netloc, path, "", parsed.query, ""))
+
+
+def is_sitemap_url(url: str) -> bool:
+    path = urlparse(url).path.lower()
+    return path.endswith((".xml", ".xml.gz")) and "sitemap" in path
+
+
+@dataclass
+class CrawlResult:
+    pages_ingested: int = 0
+    pages_failed: int = 0
+    duplicates: int = 0
+    chunks: int = 0
+    sources: list[str] = field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        return {
+            "pages_ingested": self.pages_ingested,
+            "pages_failed": self.pages_failed,
+            "duplicates": self.duplicates,
+            "chunks": self.chunks,
+            "sources": self.sources,
+        }
+
+
+class _HostLimiter:
+    """ホストごとの同時接続数と最小リクエスト間隔を守る"""
+
+    def __init__(self, concurrency: int, delay_sec: float):
+        self.concurrency = max(1, concurrency)
+        self.delay_sec = delay_sec
+        self._lock = threading.Lock()
+        self._semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self._next_slot: dict[str, float] = {}
+
+    def _semaphore(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            sem = self._semaphores.get(host)
+            if sem is None:
+                sem = self._semaphores[host] = threading.BoundedSemaphore(self.concurrency)
+            return sem
+
+    def acquire(self, host: str) -> None:
+        self._semaphore(host).acquire()
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.delay_sec
+        if slot > now:
+            time.sleep(slot - now)
+
+    def release(self, host: str) -> None:
+        self._semaphore(host).release()
+
+
+class Crawler:
+    """Bounded, polite crawler that ingests every discovered page as a source."""
+
+    def __init__(self, user_id: int, max_depth: int = 2, max_pages: int = 200, same_domain: bool = True,
+                 workers: int = CRAWL_MAX_WORKERS, progress_cb=None):
+        self.user_id = user_id
+        self.max_depth = max(0, max_depth)
+        self.max_pages = max(1, min(max_pages, CRAWL_MAX_PAGES_LIMIT))
+        self.same_domain = same_domain
+        self.workers = max(1, workers)
+        self.progress_cb = progress_cb
+        self.result = CrawlResult()
+        self._limiter = _HostLimiter(CRAWL_PER_HOST_CONCURRENCY, CRAWL_PER_HOST_DELAY_SEC)
+        self._lock = threading.Lock()
+        self._seen_urls: set[str] = set()       # 取得を割り当てた URL (max_pages の対象)
+        self._seen_canonicals: set[str] = set() # 取り込んだページの canonical URL (別名なので上限には数えない)
+        self._seen_hashes: set[str] = set()
+        self._robots: dict[str, RobotFileParser | None] = {}
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers["User-Agent"] = CRAWL_USER_AGENT
+        self._allowed_hosts: set[str] = set()
+        self._app = None
+
+    # ------------------------------------------------------------------
+    # HTTP helpers
+    # ------------------------------------------------------------------
+    def _get(self, url: str, timeout_sec: int = 15) -> requests.Response | None:
+        host = urlparse(url).netloc
+        self._limiter.acquire(host)
+        try:
+            return self._session.get(url, timeout=timeout_sec, allow_redirects=True)
+        except requests.exceptions.RequestException as ex:
+            logger.warning("Crawl request error for %s: %s", url, ex)
+            return None
+        finally:
+            self._limiter.release(host)
+
+    def _allowed_by_robots(self, url: str) -> bool:
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        with self._lock:
+            known = origin in self._robots
+            parser = self._robots.get(origin)
+        if not known:
+            parser = None
+            resp = self._get(origin + "/robots.txt", timeout_sec=10)
+            if resp is not None and resp.status_code == 200:
+                parser = RobotFileParser()
+                parser.parse(resp.text.splitlines())
+            with self._lock:
+                self._robots[origin] = parser
+        return parser is None or parser.can_fetch(CRAWL_USER_AGENT, url)
+
+    def _in_scope(self, url: str) -> bool:
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https"):
+            return False
+        if parsed.path.lower().endswith(_SKIP_EXTENSIONS):
+            return False
+        return not self.same_domain or parsed.netloc.lower() in self._allowed_hosts
+
+    def _claim_url(self, url: str) -> bool:
+        """未訪問ならマークして True を返す (上限到達時は False)"""
+        with self._lock:
+            if url in self._seen_urls or url in self._seen_canonicals or len(self._seen_urls) >= self.max_pages:
+                return False
+            self._seen_urls.add(url)
+            return True
+
+    # ------------------------------------------------------------------
+    # sitemap
+    # ------------------------------------------------------------------
+    def _sitemap_urls(self, sitemap_url: str, depth: int = 0) -> list[str]:
+        resp = self._get(sitemap_url)
+        if resp is None or resp.status_code // 100 != 2:
+            logger.warning("Failed to fetch sitemap %s", sitemap_url)
+            return []
+        body = resp.content
+        if body[:2] == b"\x1f\x8b":
+            body = gzip.decompress(body)
+        try:
+            root = ET.fromstring(body)
+        except ET.ParseError as e:
+            logger.warning("Invalid sitemap XML %s: %s", sitemap_url, e)
+            return []
+        locs = [el.text.strip() for el in root.iter() if el.tag.rsplit("}", 1)[-1] == "loc" and el.text]
+        if root.tag.rsplit("}", 1)[-1] == "sitemapindex":
+            urls: list[str] = []
+            for child in locs:
+                if depth < 2 and len(urls) < self.max_pages:
+                    urls.extend(self._sitemap_urls(child, depth + 1))
+            return urls
+        return locs
+
+    # ------------------------------------------------------------------
+    # page processing
+    # ------------------------------------------------------------------
+    def _process_page(self, url: str) -> list[str]:
+        """1 ページを取得・登録し、次の階層へ辿るリンクを返す"""
+        context = self._app.app_context() if self._app is not None else nullcontext()
+        with context:
+            try:
+                return self._ingest_page(url)
+            except Exception as e:
+                logger.exception("Crawl failed for %s: %s", url, e)
+                with self._lock:
+                    self.result.pages_failed += 1
+                return []
+
+    def _ingest_page(self, url: str) -> list[str]:
+        if not self._allowed_by_robots(url):
+            logger.info("Disallowed by robots.txt: %s", url)
+            return []
+        links: list[str] = []
+        source_url = url
+        text = None
+        resp = self._get(url)
+        if resp is None or resp.status_code // 100 != 2:
+            logger.info("Crawl skipped %s: %s", url, "request failed" if resp is None else f"HTTP {resp.status_code}")
+            with self._lock:
+                self.result.pages_failed += 1
+            return []
+        if "text/html" not in resp.headers.get("content-type", "").lower():
+            logger.info("Crawl skipped non-HTML page %s (%s)", url, resp.headers.get("content-type"))
+            with self._lock:
+                self.result.pages_failed += 1
+            return []
+        soup = parse_html(resp.text)
+        canonical = soup.find("link", rel="canonical")
+        if canonical and canonical.get("href"):
+            source_url = canonicalize_url(urljoin(resp.url, canonical["href"]))
+            if source_url != url:
+                with self._lock:
+                    if source_url in self._seen_urls or source_url in self._seen_canonicals:
+                        self.result.duplicates += 1
+                        return []
+                    self._seen_canonicals.add(source_url)
+        for a in soup.find_all("a", href=True):
+            links.append(canonicalize_url(urljoin(resp.url, a["href"])))
+        if soup.body is not None:
+            structured = ingestion.extract_structured_text(soup.body, resp.url)
+            text = re.sub(r'\n\s*\n\s*\n+', '\n\n', structured).strip()
+        if not text or len(text) < 50:
+            # 取得できた HTML から本文がほとんど取れない (JS 描画のページなど) 場合だけ Selenium で取り直す
+            text = ingestion.fetch_text_from_url(url, self.user_id)
+        if not text or not text.strip():
+            with self._lock:
+                self.result.pages_failed += 1
+            return links
+
+        content_hash = hashlib.sha1(text.encode()).hexdigest()
+        with self._lock:
+            if content_hash in self._seen_hashes:
+                self.result.duplicates += 1
+                return links
+            self._seen_hashes.add(content_hash)
+
+        synced = retriever.sync_documents(ingestion.iter_text_chunks(text), source_url, self.user_id)
+        with self._lock:
+            if synced:
+                self.result.pages_ingested += 1
+                self.result.chunks += synced.chunks
+                self.result.sources.append(source_url)
+            else:
+                self.result.pages_failed += 1
+        return links
+
+    # ------------------------------------------------------------------
+    def run(self, seed_url: str) -> CrawlResult:
+        try:
+            from flask import current_app
+            self._app = current_app._get_current_object()
+        except (ImportError, RuntimeError):
+            self._app = None
+
+        seed = canonicalize_url(seed_url)
+        self._allowed_hosts.add(urlparse(seed).netloc.lower())
+        if is_sitemap_url(seed):
+            frontier = [canonicalize_url(u) for u in self._sitemap_urls(seed)]
+            self._allowed_hosts.update(urlparse(u).netloc.lower() for u in frontier)
+            max_depth = 0  # sitemap に載っているページだけを取り込む
+        else:
+            frontier = [seed]
+            max_depth = self.max_depth
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="crawl") as pool:
+            for depth in range(max_depth + 1):
+                batch = [u for u in dict.fromkeys(frontier) if self._in_scope(u) and self._claim_url(u)]
+                if not batch:
+                    break
+                logger.info("Crawl depth %d: %d pages (seen %d)", depth, len(batch), len(self._seen_urls))
+                next_frontier: list[str] = []
+                for links in pool.map(self._process_page, batch):
+                    next_frontier.extend(links)
+                    if self.progress_cb:
+                        self.progress_cb(
+                            "fetching",
+                            f"{self.result.pages_ingested} pages ingested / {len(self._seen_urls)} discovered",
+                        )
+                frontier = next_frontier
+        self._session.close()
+        logger.info("Crawl finished for %s: %s", seed_url, self.result.to_dict())
+        return self.result
+
+
+def crawl_and_ingest(seed_url: str, user_id: int, max_depth: int = 2, max_pages: int = 200,
+                     same_domain: bool = True, progress_cb=None) -> CrawlResult:
+    """シード URL (または sitemap.xml) からクロールし、各ページをソースとして登録する"""
+    return Crawler(user_id, max_depth=max_depth, max_pages=max_pages, same_domain=same_domain,
+                   progress_cb=progress_cb).run(seed_url)
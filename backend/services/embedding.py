@@ -2,24 +2,196 @@
 
 import openai
 import os
+import threading
+import time
+import logging
 from dotenv import load_dotenv
 
+from backend.services.embedding_cache import get_cache, get_query_cache, normalize_text, text_hash
+
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# ここに関数を実装
-def get_embedding(text: str, model="text-embedding-3-large"): # モデル名を修正
-   text = text.replace("\n", " ") # Embeddingモデルの推奨事項
-   try:
-       # openai v1.x.x 以降の書き方 (推奨)
-       client = openai.OpenAI() # クライアントを初期化
-       response = client.embeddings.create(input=[text], model=model)
-       return response.data[0].embedding
-       # openai v0.x.x の書き方 (古いバージョンを使用している場合)
-       # response = openai.Embedding.create(input=[text], model=model)
-       # return response['data'][0]['embedding']
-   except Exception as e:
-       print(f"Error getting embedding: {e}")
-       return None
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-large"
+
+# --- OpenAI Embeddings API の制限 (text-embedding-3-*) ---------------------
+# 1 入力あたり 8191 tokens / 1 リクエストあたり 2048 入力・300k tokens まで
+MAX_INPUT_TOKENS = 8191
+MAX_BATCH_ITEMS = int(os.getenv("EMBEDDING_MAX_BATCH_ITEMS", "2048"))
+MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", "300000"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "4"))             # レート制限・5xx 時の再送回数
+EMBEDDING_RETRY_BASE_SEC = float(os.getenv("EMBEDDING_RETRY_BASE_SEC", "1.0"))   # 再送間隔 (指数バックオフ)
+
+# --------------------------------------------------------------------
+# プロセス内で共有する OpenAI クライアント (HTTP keep-alive を再利用)
+# --------------------------------------------------------------------
+_client = None
+_client_lock = threading.Lock()
+
+
+def _get_client():
+    """Return the process-wide OpenAI client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = openai.OpenAI()
+    return _client
+
+
+_encoding = None
+
+
+def _count_tokens(text: str) -> int:
+    """cl100k_base でトークン数を数える (tiktoken が使えなければ文字数で近似)"""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning("tiktoken unavailable, approximating token counts: %s", e)
+            _encoding = False
+    if _encoding is False:
+        return len(text)
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def _pack_batches(items: list[tuple[int, str, int]]) -> list[list[tuple[int, str, int]]]:
+    """(index, text, n_tokens) を件数・トークン上限に収まるバッチへ詰める"""
+    batches: list[list[tuple[int, str, int]]] = []
+    current: list[tuple[int, str, int]] = []
+    current_tokens = 0
+    for item in items:
+        n_tokens = item[2]
+        if current and (len(current) >= MAX_BATCH_ITEMS or current_tokens + n_tokens > MAX_BATCH_TOKENS):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(item)
+        current_tokens += n_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _is_transient(e: Exception) -> bool:
+    """時間をおけば成功し得るエラー (レート制限・接続エラー・5xx)"""
+    if isinstance(e, (openai.RateLimitError, openai.APIConnectionError)):   # APITimeoutError を含む
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+
+def _embed_batch(batch: list[tuple[int, str, int]], model: str, results: list) -> None:
+    """
+    1 バッチを送信し results に書き込む。
+    一時的なエラーはバックオフして再送し、BadRequest (不正な入力) の場合だけ二分して切り分ける。
+    それ以外の失敗ではバッチ全体を失敗 (None のまま) とする。
+    """
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        try:
+            response = _get_client().embeddings.create(input=[text for _, text, _ in batch], model=model)
+            for (idx, _, _), data in zip(batch, sorted(response.data, key=lambda d: d.index)):
+                results[idx] = data.embedding
+            return
+        except openai.BadRequestError as e:
+            if len(batch) == 1:
+                logger.error("Error getting embedding for input #%d: %s", batch[0][0], e)
+                return
+            logger.warning("Embedding batch of %d inputs rejected (%s); splitting.", len(batch), e)
+            mid = len(batch) // 2
+            _embed_batch(batch[:mid], model, results)
+            _embed_batch(batch[mid:], model, results)
+            return
+        except Exception as e:
+            if not _is_transient(e) or attempt == EMBEDDING_MAX_RETRIES:
+                logger.error("Embedding batch of %d inputs failed: %s", len(batch), e)
+                return
+            delay = EMBEDDING_RETRY_BASE_SEC * (2 ** attempt)
+            logger.warning("Embedding batch of %d inputs failed (%s); retrying in %.1fs.", len(batch), e, delay)
+            time.sleep(delay)
+
+
+def get_embeddings(texts: list[str], model: str = DEFAULT_EMBEDDING_MODEL) -> list[list[float] | None]:
+    """
+    複数テキストの Embedding をまとめて取得する。
+    入力はモデルの件数・トークン上限に収まるよう自動でバッチ分割される。
+    戻り値は入力と同じ順序のリストで、取得に失敗した要素は None になる。
+    """
+    results: list[list[float] | None] = [None] * len(texts)
+    hashes: list[str | None] = [None] * len(texts)
+    for idx, text in enumerate(texts):
+        if not text or not text.strip():
+            logger.warning("Skipping empty input #%d for embedding.", idx)
+            continue
+        hashes[idx] = text_hash(text)
+
+    # --- キャッシュ済みのベクトルはそのまま使う ---
+    cache = get_cache()
+    cached: dict[str, list[float]] = {}
+    if cache is not None:
+        cached = cache.get_many(model, [h for h in hashes if h is not None])
+
+    items: list[tuple[int, str, int]] = []
+    for idx, text in enumerate(texts):
+        sha = hashes[idx]
+        if sha is None:
+            continue
+        if sha in cached:
+            results[idx] = cached[sha]
+            continue
+        text = normalize_text(text)  # Embeddingモデルの推奨事項 (改行→空白)
+        n_tokens = _count_tokens(text)
+        if n_tokens > MAX_INPUT_TOKENS:
+            logger.error("Input #%d has %d tokens (limit %d); skipped.", idx, n_tokens, MAX_INPUT_TOKENS)
+            continue
+        items.append((idx, text, n_tokens))
+
+    for batch in _pack_batches(items):
+        _embed_batch(batch, model, results)
+
+    if cache is not None:
+        cache.put_many(model, {hashes[idx]: results[idx] for idx, _, _ in items if results[idx] is not None})
+
+    failed = sum(1 for idx, _, _ in items if results[idx] is None)
+    if failed:
+        logger.warning("Failed to embed %d of %d inputs.", failed, len(texts))
+    return results
+
+
+def get_embedding_cache_stats() -> dict:
+    """Embedding キャッシュのヒット/ミス数 (無効時は空 dict)"""
+    cache = get_cache()
+    return cache.stats() if cache is not None else {}
+
+
+def get_query_embedding_cache_stats() -> dict:
+    """検索クエリ用キャッシュ (プロセス内 LRU + Redis) のヒット/ミス数 (無効時は空 dict)"""
+    cache = get_query_cache()
+    return cache.stats() if cache is not None else {}
+
+
+def get_embedding(text: str, model: str = DEFAULT_EMBEDDING_MODEL):
+    """単一テキストの Embedding を取得する (失敗時は None)"""
+    return get_embeddings([text], model=model)[0]
+
+
+def get_query_embedding(query: str, model: str = DEFAULT_EMBEDDING_MODEL):
+    """
+    検索クエリの Embedding を取得する (失敗時は None)。
+    同じ質問の繰り返し (Slack の再送・FAQ) ではプロセス内 LRU → Redis の順に引き、
+    OpenAI への往復を省く。ミス時は get_embedding (SQLite キャッシュ経由) で取得して両方に入れる。
+    """
+    cache = get_query_cache()
+    if cache is None or not query or not query.strip():
+        return get_embedding(query, model=model)
+    sha = text_hash(query)
+    vector = cache.get(model, sha)
+    if vector is None:
+        vector = get_embedding(query, model=model)
+        if vector is not None:
+            cache.put(model, sha, vector)
+    return vector
 
 # --- ChromaDB関連のコードは retriever.py に移動 ---
@@ -0,0 +1,276 @@
+# backend/services/embedding_cache.py
+"""
+Content-addressed embedding cache.
+
+Vectors are keyed by (model name, sha1 of the normalised chunk text) and kept
+in a local SQLite file so they survive restarts and are shared by every
+gunicorn / Celery process on the same host.  The store is bounded by entry
+count and evicts least-recently-used rows once the bound is exceeded.
+
+Query embeddings additionally go through `QueryEmbeddingCache`: a small
+in-process LRU in front of an optional Redis tier, which web and worker
+containers (separate hosts, separate SQLite files) can share.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from backend.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "instance", "embedding_cache.sqlite3")
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "1") not in ("0", "false", "False")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", _DEFAULT_PATH)
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "50000"))
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024"))     # 0 で無効
+QUERY_EMBEDDING_REDIS_ENABLED = os.getenv("QUERY_EMBEDDING_REDIS_ENABLED", "1") not in ("0", "false", "False")
+QUERY_EMBEDDING_REDIS_TTL_SEC = int(os.getenv("QUERY_EMBEDDING_REDIS_TTL_SEC", str(7 * 24 * 3600)))
+
+
+def normalize_text(text: str) -> str:
+    """Embedding API へ送る形に正規化する (キャッシュキーと送信内容を一致させる)"""
+    return text.replace("\n", " ").strip()
+
+
+def text_hash(text: str) -> str:
+    """sha1 of the normalised text (same digest add_documents uses for ids)."""
+    return hashlib.sha1(normalize_text(text).encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """SQLite-backed, size-bounded LRU store of embedding vectors."""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._approx_count: int | None = None
+
+    # ------------------------------------------------------------------
+    # connection handling (one connection per thread)
+    # ------------------------------------------------------------------
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_cache ("
+                " model TEXT NOT NULL,"
+                " text_sha1 TEXT NOT NULL,"
+                " vector BLOB NOT NULL,"
+                " last_used REAL NOT NULL,"
+                " PRIMARY KEY (model, text_sha1))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_embedding_cache_last_used ON embedding_cache (last_used)")
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    # ------------------------------------------------------------------
+    # public API
+    # ------------------------------------------------------------------
+    def get_many(self, model: str, hashes: list[str]) -> dict[str, list[float]]:
+        """Return {sha1: vector} for the hashes present in the cache."""
+        if not hashes:
+            return {}
+        found: dict[str, list[float]] = {}
+        unique = list(dict.fromkeys(hashes))
+        try:
+            conn = self._conn()
+            # SQLite のパラメータ上限 (999) を超えないよう分割
+            for start in range(0, len(unique), 500):
+                part = unique[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = conn.execute(
+                    f"SELECT text_sha1, vector FROM embedding_cache WHERE model = ? AND text_sha1 IN ({placeholders})",
+                    [model, *part],
+                ).fetchall()
+                for sha, blob in rows:
+                    found[sha] = array("f", blob).tolist()
+            if found:
+                now = time.time()
+                conn.executemany(
+                    "UPDATE embedding_cache SET last_used = ? WHERE model = ? AND text_sha1 = ?",
+                    [(now, model, sha) for sha in found],
+                )
+                conn.commit()
+        except Exception as e:
+            logger.warning("Embedding cache lookup failed: %s", e)
+        with self._stats_lock:
+            self.hits += sum(1 for h in hashes if h in found)
+            self.misses += sum(1 for h in hashes if h not in found)
+        return found
+
+    def put_many(self, model: str, entries: dict[str, list[float]]) -> None:
+        """Store {sha1: vector} and evict LRU rows if over capacity."""
+        if not entries:
+            return
+        try:
+            conn = self._conn()
+            now = time.time()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (model, text_sha1, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(model, sha, array("f", vec).tobytes(), now) for sha, vec in entries.items()],
+            )
+            conn.commit()
+            self._evict_if_needed(conn, len(entries))
+        except Exception as e:
+            logger.warning("Embedding cache store failed: %s", e)
+
+    def stats(self) -> dict[str, float | int]:
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+    # ------------------------------------------------------------------
+    def _evict_if_needed(self, conn: sqlite3.Connection, added: int) -> None:
+        if self._approx_count is None:
+            self._approx_count = conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+        else:
+            self._approx_count += added
+        if self._approx_count <= self.max_entries:
+            return
+        # 他プロセスの書き込みも含めて正確な件数を取り直してから削除
+        count = conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+        # 毎回の削除を避けるため上限の 10% 分まとめて空ける
+        excess = count - int(self.max_entries * 0.9)
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM embedding_cache WHERE rowid IN "
+                "(SELECT rowid FROM embedding_cache ORDER BY last_used ASC LIMIT ?)",
+                (excess,),
+            )
+            conn.commit()
+            with self._stats_lock:
+                self.evictions += excess
+            logger.info("Embedding cache evicted %d LRU entries (limit %d).", excess, self.max_entries)
+            count -= excess
+        self._approx_count = count
+
+
+_cache: EmbeddingCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> EmbeddingCache | None:
+    """Return the process-wide cache, or None when disabled."""
+    global _cache
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES)
+    return _cache
+
+
+class QueryEmbeddingCache:
+    """
+    Thread-safe LRU of query vectors (stored as float32 arrays) with an
+    optional shared Redis tier.  Keys are (model, sha1 of normalised text).
+    """
+
+    REDIS_KEY = "aiqly:qemb:{model}:{sha}"
+
+    def __init__(self, max_entries: int, use_redis: bool, redis_ttl_sec: int):
+        self.max_entries = max_entries
+        self.use_redis = use_redis
+        self.redis_ttl_sec = redis_ttl_sec
+        self._entries: OrderedDict[tuple[str, str], array] = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def get(self, model: str, sha: str) -> list[float] | None:
+        key = (model, sha)
+        with self._lock:
+            vec = self._entries.get(key)
+            if vec is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return vec.tolist()
+        client = get_redis() if self.use_redis else None
+        if client is not None:
+            try:
+                blob = client.get(self.REDIS_KEY.format(model=model, sha=sha))
+            except Exception as e:
+                logger.warning("Query embedding Redis lookup failed: %s", e)
+                blob = None
+            if blob:
+                vec = array("f", blob)
+                self._remember(key, vec)
+                with self._lock:
+                    self.redis_hits += 1
+                return vec.tolist()
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, model: str, sha: str, vector: list[float]) -> None:
+        vec = array("f", vector)
+        self._remember((model, sha), vec)
+        client = get_redis() if self.use_redis else None
+        if client is not None:
+            try:
+                client.set(self.REDIS_KEY.format(model=model, sha=sha), vec.tobytes(), ex=self.redis_ttl_sec)
+            except Exception as e:
+                logger.warning("Query embedding Redis store failed: %s", e)
+
+    def stats(self) -> dict[str, float | int]:
+        with self._lock:
+            hits = self.memory_hits + self.redis_hits
+            total = hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "memory_hits": self.memory_hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "hit_rate": (hits / total) if total else 0.0,
+            }
+
+    def _remember(self, key: tuple[str, str], vec: array) -> None:
+        with self._lock:
+            self._entries[key] = vec
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_query_cache: QueryEmbeddingCache | None = None
+
+
+def get_query_cache() -> QueryEmbeddingCache | None:
+    """Return the process-wide query embedding cache, or None when disabled."""
+    global _query_cache
+    if QUERY_EMBEDDING_CACHE_SIZE <= 0:
+        return None
+    if _query_cache is None:
+        with _cache_lock:
+            if _query_cache is None:
+                _query_cache = QueryEmbeddingCache(QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_REDIS_ENABLED,
+                                                   QUERY_EMBEDDING_REDIS_TTL_SEC)
+    return _query_cache
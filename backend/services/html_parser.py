@@ -0,0 +1,116 @@
+# backend/services/html_parser.py
+"""
+HTML parsing backend and main-content detection for ingestion.
+
+`parse_html` builds a BeautifulSoup tree with the fastest available tree
+builder (lxml when installed, the pure-Python html.parser otherwise), so the
+rest of the pipeline keeps working on bs4 objects.  `find_main_content`
+locates the article body in a single pass over the tree instead of running
+one CSS selector query per candidate.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+
+from bs4 import BeautifulSoup, FeatureNotFound, Tag
+
+logger = logging.getLogger(__name__)
+
+# "auto" → lxml があれば lxml、無ければ html.parser / 明示指定も可
+HTML_PARSER = os.getenv("HTML_PARSER", "auto")
+FALLBACK_PARSER = "html.parser"
+
+
+def _detect_parser() -> str:
+    if HTML_PARSER != "auto":
+        return HTML_PARSER
+    try:
+        import lxml  # noqa: F401
+        return "lxml"
+    except ImportError:
+        return FALLBACK_PARSER
+
+
+PARSER_BACKEND = _detect_parser()
+
+
+def parse_html(html: str | bytes) -> BeautifulSoup:
+    """Parse with the configured backend, falling back to html.parser."""
+    if PARSER_BACKEND != FALLBACK_PARSER:
+        try:
+            return BeautifulSoup(html, PARSER_BACKEND)
+        except FeatureNotFound:
+            logger.warning("HTML parser '%s' unavailable, using %s.", PARSER_BACKEND, FALLBACK_PARSER)
+        except Exception as e:                          # 壊れた HTML で lxml が失敗した場合など
+            logger.warning("HTML parser '%s' failed (%s), using %s.", PARSER_BACKEND, e, FALLBACK_PARSER)
+    return BeautifulSoup(html, FALLBACK_PARSER)
+
+
+# --- 本文領域の検出 --------------------------------------------------------
+# 従来の select_one の優先順位: main, article, [role="main"], .content, #content,
+# .post-content, #main-content, .entry-content
+MAIN_CONTENT_RULES = (
+    ("main", lambda t: t.name == "main"),
+    ("article", lambda t: t.name == "article"),
+    ('[role="main"]', lambda t: t.get("role") == "main"),
+    (".content", lambda t: "content" in (t.get("class") or ())),
+    ("#content", lambda t: t.get("id") == "content"),
+    (".post-content", lambda t: "post-content" in (t.get("class") or ())),
+    ("#main-content", lambda t: t.get("id") == "main-content"),
+    (".entry-content", lambda t: "entry-content" in (t.get("class") or ())),
+)
+_SCORED_TAGS = frozenset(["p", "pre", "td"])           # 本文らしさの根拠にする要素
+_CANDIDATE_TAGS = frozenset(["div", "section", "article", "main", "td", "blockquote"])
+MIN_SCORED_TEXT = 25                                   # これより短い段落は数えない
+MIN_SCORE_SHARE = 0.6                                  # 全段落の得点のうちこの割合を含む要素だけを本文とみなす
+
+
+def find_main_content(soup: BeautifulSoup) -> tuple[Tag | None, str]:
+    """
+    本文領域を 1 回の走査で探す。戻り値は (要素, 検出理由)。
+    1. 既知のセレクタに一致する要素 (従来と同じ優先順位・文書順で最初の要素)
+    2. 無ければ段落の文字数・読点数を親 / 祖父要素に加点し、最高得点の要素
+       (ページ全体の得点の MIN_SCORE_SHARE 以上を含む場合のみ。本文の取りこぼしを防ぐ)
+    3. それも無ければ <body>
+    """
+    body = soup.body
+    if body is None:
+        return None, "no body"
+
+    matches: list[Tag | None] = [None] * len(MAIN_CONTENT_RULES)
+    scores: dict[int, float] = {}
+    nodes: dict[int, Tag] = {}
+    total_score = 0.0
+    for node in body.descendants:
+        if not isinstance(node, Tag):
+            continue
+        for i, (_, rule) in enumerate(MAIN_CONTENT_RULES):
+            if matches[i] is None and rule(node):
+                matches[i] = node
+        if matches[0] is not None:
+            break                                      # 最優先の <main> が見つかれば終了
+        if node.name in _SCORED_TAGS:
+            text = node.get_text(" ", strip=True)
+            if len(text) < MIN_SCORED_TEXT:
+                continue
+            score = 1 + text.count(",") + text.count("、") + text.count("。") + min(len(text) / 100, 3)
+            total_score += score
+            parent = node.parent
+            for weight in (1.0, 0.5):
+                if parent is None or parent is body:
+                    break
+                if parent.name in _CANDIDATE_TAGS:
+                    scores[id(parent)] = scores.get(id(parent), 0.0) + score * weight
+                    nodes[id(parent)] = parent
+                parent = parent.parent
+
+    for (selector, _), match in zip(MAIN_CONTENT_RULES, matches):
+        if match is not None:
+            return match, f"selector '{selector}'"
+    if scores:
+        best = max(scores, key=scores.get)
+        if scores[best] >= total_score * MIN_SCORE_SHARE:
+            return nodes[best], f"text score {scores[best]:.1f}/{total_score:.1f}"
+    return body, "body"
@@ -1,18 +1,25 @@
 import requests
-from bs4 import BeautifulSoup, NavigableString, Tag
+from bs4 import NavigableString, Tag, Comment, Declaration, Doctype, ProcessingInstruction
 import tiktoken
-import PyPDF2
 from docx import Document
+from docx.table import Table as DocxTable
+import openpyxl
+import pandas as pd
+import codecs
+import datetime
+import mmap
 import time
 import re
 import os
+import hashlib
+import threading
 import traceback
+from array import array
+from dataclasses import dataclass
 from urllib.parse import urljoin
 from urllib.parse import urlparse
 
 # Selenium関連
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service as ChromeService
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
@@ -21,8 +28,12 @@ from selenium.common.exceptions import TimeoutException, WebDriverException
 import json
 import base64
 import platform
-from backend.models import db, GoogleCookie  # GoogleCookie: user_id PK, cookie_json_encrypted column
+from collections import namedtuple
+from backend.models import db, GoogleCookie, UrlValidator  # GoogleCookie: user_id PK, cookie_json_encrypted column
 from backend.extensions import get_google_cookies
+from backend.services.webdriver_pool import driver_pool
+from backend.services.html_parser import parse_html, find_main_content
+from backend.services.pdf_extract import iter_pdf_pages
 
 # --- ロガー設定 ---
 import logging
@@ -30,16 +41,45 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+# === HTTP 接続プール (keep-alive) ===
+# Session は Cookie を持つためユーザー間で共有せず、接続プールを持つ Adapter だけを共有する
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "20"))
+_http_adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_MAXSIZE, pool_maxsize=HTTP_POOL_MAXSIZE)
+
+
+def _new_session() -> requests.Session:
+    sess = requests.Session()
+    sess.mount("http://", _http_adapter)
+    sess.mount("https://", _http_adapter)
+    return sess
+
+
+@dataclass
+class FetchValidators:
+    """条件付き再取得に使う検証子 (ETag / Last-Modified / 本文 sha1)"""
+    etag: str | None = None
+    last_modified: str | None = None
+    body_sha1: str | None = None
+
+
+@dataclass
+class SimpleFetchResult:
+    status: str                                # "ok" | "not_modified" | "failed"
+    text: str | None = None
+    validators: FetchValidators | None = None
+
+
 # === シンプルな requests 取得（まずはこちらで試し、失敗したら Selenium） ===
-def fetch_text_simple(url: str, user_id: int | None = None, timeout_sec=15) -> str | None:
-    """requests だけで取得できるページはここで済ませる"""
+def _fetch_simple(url: str, user_id: int | None = None, timeout_sec=15,
+                  validators: FetchValidators | None = None) -> SimpleFetchResult:
+    """requests で取得する。validators があれば条件付きリクエストを送り、未変更なら抽出を省く"""
     # --- optional Google Sites cookie injection ---------------------------
     cookies_to_add = None
     if "sites.google.com" in url and user_id is not None:
         cookies_to_add = get_google_cookies(user_id)
 
     # --- Build requests session (always use a Session object) -------------
-    sess = requests.Session()
+    sess = _new_session()
 
     if cookies_to_add:  # Google Sites private pages
         # requests.Session expects a {name: value} map; ignore other fields
@@ -49,105 +89,380 @@ def fetch_text_simple(url: str, user_id: int | None = None, timeout_sec=15) -> s
             logger.info("Injected %d Google cookies into session", len(cookie_map))
         except Exception as ck_err:
             logger.warning("Failed to inject cookies: %s", ck_err)
+    headers = {"User-Agent": "Mozilla/5.0 (compatible; AiQlyBot/1.0)"}
+    if validators:
+        if validators.etag: headers["If-None-Match"] = validators.etag
+        if validators.last_modified: headers["If-Modified-Since"] = validators.last_modified
     try:
         r = sess.get(url,
                      timeout=timeout_sec,
                      allow_redirects=True,
-                     headers={"User-Agent": "Mozilla/5.0 (compatible; AiQlyBot/1.0)"})
+                     headers=headers)
+        if r.status_code == 304 and validators:
+            logger.info("304 Not Modified for %s – skipping extraction", url)
+            return SimpleFetchResult("not_modified", validators=validators)
         if r.status_code // 100 != 2:
             logger.warning("Non‑2xx status %s for %s", r.status_code, url)
-            return None
+            return SimpleFetchResult("failed")
 
         if "text" not in r.headers.get("content-type", ""):
             logger.warning("Non‑text content‑type %s for %s", r.headers.get("content-type"), url)
-            return None
+            return SimpleFetchResult("failed")
+
+        new_validators = FetchValidators(
+            etag=r.headers.get("ETag"),
+            last_modified=r.headers.get("Last-Modified"),
+            body_sha1=hashlib.sha1(r.content).hexdigest(),
+        )
+        if validators and validators.body_sha1 == new_validators.body_sha1:
+            logger.info("Body unchanged for %s – skipping extraction", url)
+            return SimpleFetchResult("not_modified", validators=new_validators)
 
         html_text = r.text.strip()
         # --- Google "Sign in" page detection → force Selenium fallback ----
         if "Use your Google Account" in html_text and "Sign in" in html_text and "accounts.google.com" in r.url:
             logger.info("Detected Google sign‑in page for %s (likely auth required) → fallback to Selenium", url)
-            return None  # treat as failure so caller will try Selenium
+            return SimpleFetchResult("failed")  # treat as failure so caller will try Selenium
         if not html_text:
             logger.warning("Empty body for %s", url)
-            return None
+            return SimpleFetchResult("failed")
 
-        soup = BeautifulSoup(html_text, "html.parser")
+        soup = parse_html(html_text)
         structured = extract_structured_text(soup.body, url)
         cleaned = re.sub(r'\n\s*\n\s*\n+', '\n\n', structured).strip()
-        return cleaned if cleaned else None
+        if not cleaned:
+            return SimpleFetchResult("failed")
+        return SimpleFetchResult("ok", text=cleaned, validators=new_validators)
     except requests.exceptions.RequestException as ex:
         logger.error("requests error for %s: %s", url, ex)
+        return SimpleFetchResult("failed")
+    finally:
+        sess.close()
+
+
+def fetch_text_simple(url: str, user_id: int | None = None, timeout_sec=15) -> str | None:
+    """requests だけで取得できるページはここで済ませる"""
+    return _fetch_simple(url, user_id, timeout_sec).text
+
+
+# === URL ソースの条件付き再取得 ===
+@dataclass
+class ConditionalFetchResult:
+    text: str | None                      # 変更あり時の抽出テキスト
+    unchanged: bool = False               # 304 / 本文同一 → 取り込み不要
+    validators: FetchValidators | None = None
+
+
+def _url_hash(url: str) -> str:
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+def load_url_validators(user_id: int, url: str) -> FetchValidators | None:
+    rec = db.session.scalars(
+        db.select(UrlValidator).filter_by(user_id=user_id, url_hash=_url_hash(url))
+    ).first()
+    if rec is None:
         return None
+    return FetchValidators(etag=rec.etag, last_modified=rec.last_modified, body_sha1=rec.body_sha1)
+
+
+def save_url_validators(user_id: int, url: str, validators: FetchValidators | None) -> None:
+    """取り込み成功後に検証子を保存する (失敗時に保存すると次回誤ってスキップしてしまうため)"""
+    if validators is None:
+        return
+    try:
+        rec = db.session.scalars(
+            db.select(UrlValidator).filter_by(user_id=user_id, url_hash=_url_hash(url))
+        ).first()
+        if rec is None:
+            rec = UrlValidator(user_id=user_id, url=url, url_hash=_url_hash(url))
+            db.session.add(rec)
+        rec.etag = validators.etag
+        rec.last_modified = validators.last_modified
+        rec.body_sha1 = validators.body_sha1
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning("Failed to save URL validators for %s: %s", url, e)
+
+
+def delete_url_validators(user_id: int, url: str) -> None:
+    """ソース削除時に検証子を消す (残すと再登録が「変更なし」で省略され、定期再取得の対象にも残る)"""
+    try:
+        db.session.execute(db.delete(UrlValidator).filter_by(user_id=user_id, url_hash=_url_hash(url)))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning("Failed to delete URL validators for %s: %s", url, e)
+
+
+def fetch_text_if_changed(url: str, user_id: int, timeout_sec=45, use_stored_validators: bool = True) -> ConditionalFetchResult:
+    """
+    前回取り込み時の検証子を使って URL を再取得する。
+    304 または本文が同一なら unchanged=True (text=None) を返し、抽出・Embedding を省略できる。
+    ナレッジからソースが消えている場合は use_stored_validators=False で呼び、必ず取り込み直す。
+    取り込みに成功したら呼び出し側で save_url_validators() を呼ぶこと。
+    """
+    previous = load_url_validators(user_id, url) if use_stored_validators else None
+    simple = _fetch_simple(url, user_id, min(timeout_sec, 15), validators=previous)
+    if simple.status == "not_modified":
+        # ETag 等が更新されている可能性があるので検証子だけは保存しておく
+        save_url_validators(user_id, url, simple.validators)
+        return ConditionalFetchResult(None, unchanged=True, validators=simple.validators)
+    if simple.status == "ok":
+        return ConditionalFetchResult(simple.text, validators=simple.validators)
+
+    # requests で取れないページは Selenium で取得し、抽出テキストのハッシュで比較する
+    text = fetch_text_from_url(url, user_id, timeout_sec, try_simple=False)
+    if not text:
+        return ConditionalFetchResult(None)
+    text_validators = FetchValidators(body_sha1=hashlib.sha1(text.encode()).hexdigest())
+    if previous and previous.body_sha1 == text_validators.body_sha1:
+        logger.info("Rendered text unchanged for %s – skipping ingestion", url)
+        return ConditionalFetchResult(None, unchanged=True, validators=text_validators)
+    return ConditionalFetchResult(text, validators=text_validators)
+
+# === 構造化テキスト抽出 (HTML → Markdown 風テキスト) ===
+_SKIP_TAGS = frozenset(['script', 'style', 'header', 'footer', 'nav', 'aside', 'form', 'button', 'iframe', 'noscript', 'svg', 'meta', 'link', 'head'])
+_INLINE_TAGS = frozenset(['a', 'span', 'strong', 'b', 'em', 'i', 'img', 'code', 'td', 'th'])
+_STRIP_CHILDREN_TAGS = frozenset(['a', 'strong', 'b', 'em', 'i'])   # 子要素の出力を個別に strip して連結する
+_IGNORED_STRINGS = (Comment, Declaration, Doctype, ProcessingInstruction)
+_WS_RE = re.compile(r'[ \t]+')
+
+
+class _Frame:
+    """extract_structured_text の走査スタック上で、子要素の処理後に閉じる要素"""
+    __slots__ = ('tag', 'start', 'mark', 'strip', 'prefix', 'suffix', 'href')
+
+    def __init__(self, tag, start, mark, strip, prefix='\n', suffix='\n', href=None):
+        self.tag, self.start, self.mark, self.strip = tag, start, mark, strip
+        self.prefix, self.suffix, self.href = prefix, suffix, href
+
+
+def _strip_range(out: list[str], start: int) -> None:
+    """out[start:] を連結したものを strip したのと同じ結果になるよう、両端の断片だけを削る"""
+    for i in range(start, len(out)):
+        out[i] = out[i].lstrip()
+        if out[i]: break
+    for i in range(len(out) - 1, start - 1, -1):
+        out[i] = out[i].rstrip()
+        if out[i]: break
+
 
-# === 再帰的な構造化テキスト抽出ヘルパー関数 ===
-# (変更なし)
 def extract_structured_text(element, base_url):
-    text = ''
+    """
+    HTML 要素を見出し・リンク・表・リスト・引用を残した Markdown 風テキストに変換する。
+    明示的なスタックで DOM を 1 回だけ走査し、断片をリストに積んで最後に 1 度だけ空白を正規化する
+    (深い DOM でも再帰上限に達せず、巨大なページでも処理時間は要素数に比例)。
+    """
     if element is None: return ''
     if isinstance(element, NavigableString):
-        parent_tag = getattr(element, 'parent', None); parent_name = getattr(parent_tag, 'name', None)
+        if isinstance(element, _IGNORED_STRINGS): return ''
+        parent_name = getattr(getattr(element, 'parent', None), 'name', None)
         if parent_name in ['script', 'style', 'noscript']: return ''
-        stripped_string = element.string.strip(); return stripped_string if stripped_string else ''
-    elif isinstance(element, Tag):
-        tag_name = element.name.lower()
-        if tag_name in ['script', 'style', 'header', 'footer', 'nav', 'aside', 'form', 'button', 'iframe', 'noscript', 'svg', 'meta', 'link', 'head']: return ''
-        prefix, suffix = '\n', '\n'; content = ''
-        if tag_name in ['a', 'span', 'strong', 'b', 'em', 'i', 'img', 'code', 'td', 'th']: prefix, suffix = '', ''
-        if tag_name == 'li': prefix, suffix = "\n- ", "\n"
-        if tag_name == 'br': return "\n"
-        # --- タグ種類に応じた処理 ---
-        if tag_name.startswith('h') and tag_name[1:].isdigit(): level = int(tag_name[1:]); content = '#' * level + ' ' + element.get_text(strip=True)
-        elif tag_name == 'a':
-            href = element.get('href'); anchor_text = "".join(extract_structured_text(child, base_url).strip() for child in element.children)
-            if not anchor_text: anchor_text = "link"
-            if href and not href.strip().lower().startswith('javascript:'): full_url = urljoin(base_url, href.strip()); content = f"[{anchor_text}]({full_url})"
-            else: content = anchor_text
+        return element.strip()
+
+    out: list[str] = []
+    nonblank = 0            # 空白以外を含む断片を積んだ回数 (要素の中身が空かどうかの判定用)
+    stack: list = [(element, False)]
+    while stack:
+        item = stack.pop()
+        item_type = type(item)
+
+        # --- 表の区切りなどの固定文字列 ---
+        if item_type is str:
+            out.append(item)
+            if item.strip(): nonblank += 1
+            continue
+
+        # --- 子要素を処理し終えた要素を閉じる ---
+        if item_type is _Frame:
+            f = item; tag_name = f.tag
+            if tag_name == 'a':
+                if nonblank == f.mark: del out[f.start + 1:]; out.append('link'); nonblank += 1
+                if f.href: out[f.start] = '['; out.append(f"]({f.href})")
+            elif tag_name in ('strong', 'b', 'em', 'i'):
+                mark = '**' if tag_name in ('strong', 'b') else '*'
+                out[f.start] = mark; out.append(mark); nonblank += 1
+            elif tag_name == 'table':
+                pass
+            elif nonblank == f.mark:
+                del out[f.start:]      # 中身が空の要素は前後の改行ごと出力しない
+            else:
+                out[f.start] = f.prefix; out.append(f.suffix)
+            if f.strip: _strip_range(out, f.start)
+            continue
+
+        node, strip = item
+        if isinstance(node, NavigableString):
+            if isinstance(node, _IGNORED_STRINGS): continue
+            text = node.strip()
+            if text: out.append(text); nonblank += 1
+            continue
+        if not isinstance(node, Tag): continue
+
+        tag_name = node.name.lower()
+        if tag_name in _SKIP_TAGS: continue
+
+        # --- 子要素を辿らない要素はその場で出力 ---
+        piece = None
+        if tag_name == 'br':
+            piece = '\n'
+        elif tag_name.startswith('h') and tag_name[1:].isdigit():
+            piece = '\n' + '#' * int(tag_name[1:]) + ' ' + node.get_text(strip=True) + '\n'
         elif tag_name == 'img':
-            alt = element.get('alt', '').strip(); src = element.get('src', ''); full_src = urljoin(base_url, src.strip()) if src else ''
+            alt = node.get('alt', '').strip(); src = node.get('src', ''); full_src = urljoin(base_url, src.strip()) if src else ''
             alt_text = f": {alt}" if alt else ""
-            if full_src and full_src.lower().startswith('http'): content = f"[画像{alt_text}]({full_src})"
-            elif alt: content = f"[画像{alt_text}]"
-            else: content = "[画像]"
-            prefix, suffix = ' ', ' '
-        elif tag_name in ['strong', 'b']: content = f"**{''.join(extract_structured_text(child, base_url).strip() for child in element.children)}**"
-        elif tag_name in ['em', 'i']: content = f"*{''.join(extract_structured_text(child, base_url).strip() for child in element.children)}*"
-        elif tag_name == 'table':
-            table_text = "\n---\n"; rows = element.find_all('tr')
-            for row in rows: cells = [extract_structured_text(cell, base_url).strip() for cell in row.find_all(['th', 'td'])]; table_text += " | ".join(cells) + "\n"
-            table_text += "---\n"; content = table_text; return content
-        elif tag_name in ['td', 'th', 'tr']: pass
-        elif tag_name == 'pre': content = element.get_text(); prefix = '\n```\n'; suffix = '\n```\n'
-        elif tag_name == 'code': content = f"`{element.get_text(strip=True)}`"; prefix, suffix = '', ''
-        elif tag_name == 'blockquote': prefix = '\n> '; content = "".join(extract_structured_text(child, base_url) for child in element.children); suffix = '\n'
-        else: content = "".join(extract_structured_text(child, base_url) for child in element.children)
-        if content.strip(): text = prefix + content + suffix
-        else: text = ''
-    text = re.sub(r'[ \t]+', ' ', text); return text
+            if full_src and full_src.lower().startswith('http'): piece = f" [画像{alt_text}]({full_src}) "
+            elif alt: piece = f" [画像{alt_text}] "
+            else: piece = " [画像] "
+        elif tag_name == 'pre':
+            content = node.get_text()
+            piece = '\n```\n' + content + '\n```\n' if content.strip() else ''
+        elif tag_name == 'code':
+            piece = f"`{node.get_text(strip=True)}`"
+        if piece is not None:
+            if strip: piece = piece.strip()
+            if piece:
+                out.append(piece)
+                if piece.strip(): nonblank += 1
+            continue
+
+        # --- 子要素を持つ要素: 閉じ処理 (_Frame) を積んでから子を逆順に積む ---
+        start = len(out)
+        out.append('')          # prefix の差し込み位置 (閉じる時に確定)
+        if tag_name == 'table':
+            stack.append(_Frame(tag_name, start, nonblank, strip))
+            ops: list = ['\n---\n']
+            for row in node.find_all('tr'):
+                for i, cell in enumerate(row.find_all(['th', 'td'])):
+                    if i: ops.append(' | ')
+                    ops.append((cell, True))
+                ops.append('\n')
+            ops.append('---\n')
+            stack.extend(reversed(ops))
+            continue
+        if tag_name == 'a':
+            href = node.get('href')
+            full_url = urljoin(base_url, href.strip()) if href and not href.strip().lower().startswith('javascript:') else None
+            frame = _Frame(tag_name, start, nonblank, strip, href=full_url)
+        elif tag_name == 'li':
+            frame = _Frame(tag_name, start, nonblank, strip, "\n- ", "\n")
+        elif tag_name == 'blockquote':
+            frame = _Frame(tag_name, start, nonblank, strip, '\n> ', '\n')
+        elif tag_name in _INLINE_TAGS:
+            frame = _Frame(tag_name, start, nonblank, strip, '', '')
+        else:
+            frame = _Frame(tag_name, start, nonblank, strip)
+        stack.append(frame)
+        child_strip = tag_name in _STRIP_CHILDREN_TAGS
+        stack.extend((child, child_strip) for child in reversed(node.contents))
+
+    return _WS_RE.sub(' ', ''.join(out))
+
+# === ページ読み込み完了の検知 (固定 sleep の代替) ===
+ReadinessResult = namedtuple("ReadinessResult", ["waited_sec", "reason", "scroll_height"])
+
+READINESS_IDLE_MS = int(os.getenv("SELENIUM_READY_IDLE_MS", "500"))       # この時間通信・DOM変化が無ければ完了
+READINESS_LONG_REQUEST_SEC = 5.0    # これより長く続くリクエスト (long-poll / stream) は待たない
+READINESS_POLL_SEC = 0.1
+
+_MUTATION_OBSERVER_JS = """
+(function () {
+  if (window.__aiqlyMutationObserver) return;
+  window.__aiqlyLastMutation = performance.now();
+  var obs = new MutationObserver(function () { window.__aiqlyLastMutation = performance.now(); });
+  obs.observe(document.documentElement || document, {childList: true, subtree: true, attributes: true, characterData: true});
+  window.__aiqlyMutationObserver = obs;
+})();
+"""
+_READINESS_PROBE_JS = """
+return [
+  document.readyState,
+  window.__aiqlyLastMutation === undefined ? null : performance.now() - window.__aiqlyLastMutation,
+  document.body ? document.body.scrollHeight : 0
+];
+"""
+
+
+def drain_network_events(driver) -> list[tuple[str, str]]:
+    """
+    Chrome performance ログから CDP Network イベントを取り出す。
+    Returns: [(method, requestId), ...]  (ログが取れない環境では空リスト)
+    """
+    events: list[tuple[str, str]] = []
+    try:
+        entries = driver.get_log("performance")
+    except Exception:
+        return events
+    for entry in entries:
+        try:
+            msg = json.loads(entry["message"])["message"]
+        except (KeyError, TypeError, ValueError):
+            continue
+        method = msg.get("method", "")
+        if method in ("Network.requestWillBeSent", "Network.loadingFinished", "Network.loadingFailed"):
+            events.append((method, msg.get("params", {}).get("requestId", "")))
+    return events
+
+
+def wait_until_ready(driver, max_wait_sec: float, prev_scroll_height: int | None = None) -> ReadinessResult:
+    """
+    ネットワークが idle (CDP Network イベントで実行中リクエスト 0 件) かつ
+    DOM 変化 (MutationObserver) が READINESS_IDLE_MS 続けて無くなるまで待つ。
+    prev_scroll_height が渡された場合 (スクロール後の待機) は、idle 到達時に
+    scrollHeight が変わっていなければ即終了する。最大 max_wait_sec で打ち切り。
+    """
+    start = time.monotonic()
+    inflight: dict[str, float] = {}
+    last_network_activity = start
+    scroll_height = prev_scroll_height or 0
+    try:
+        driver.execute_script(_MUTATION_OBSERVER_JS)
+    except Exception as e:
+        logger.debug("MutationObserver install failed (ignored): %s", e)
+
+    while True:
+        now = time.monotonic()
+        elapsed = now - start
+        for method, request_id in drain_network_events(driver):
+            last_network_activity = now
+            if method == "Network.requestWillBeSent":
+                inflight[request_id] = now
+            else:
+                inflight.pop(request_id, None)
+        try:
+            ready_state, mutation_age_ms, scroll_height = driver.execute_script(_READINESS_PROBE_JS)
+        except Exception as e:
+            logger.debug("Readiness probe failed: %s", e)
+            return ReadinessResult(elapsed, "probe failed", scroll_height)
+
+        if elapsed >= max_wait_sec:
+            return ReadinessResult(elapsed, "max wait reached", scroll_height)
+
+        pending = [rid for rid, t in inflight.items() if now - t < READINESS_LONG_REQUEST_SEC]
+        network_idle = not pending and (now - last_network_activity) * 1000 >= READINESS_IDLE_MS
+        dom_quiet = mutation_age_ms is None or mutation_age_ms >= READINESS_IDLE_MS
+        if ready_state == "complete" and network_idle and dom_quiet:
+            if prev_scroll_height is not None and scroll_height == prev_scroll_height:
+                return ReadinessResult(elapsed, "idle, no new content", scroll_height)
+            return ReadinessResult(elapsed, "network idle + DOM quiet", scroll_height)
+        time.sleep(READINESS_POLL_SEC)
+
 
 # --- URLからのテキスト抽出 (変更あり) ---
-def fetch_text_from_url(url: str, user_id: int | None = None, timeout_sec=45, wait_after_load_sec=5, scroll_attempts=3) -> str | None:
-    """Seleniumを使ってURLを開き、構造化テキストを抽出する"""
+def fetch_text_from_url(url: str, user_id: int | None = None, timeout_sec=45, wait_after_load_sec=5, scroll_attempts=3, try_simple=True) -> str | None:
+    """
+    Seleniumを使ってURLを開き、構造化テキストを抽出する。
+    wait_after_load_sec は読み込み完了待ちの上限 (多くのページはそれより早く完了する)。
+    """
     # まずは簡易 requests で取れないか試す
-    simple = fetch_text_simple(url, user_id, timeout_sec)
-    if simple:
-        return simple
+    if try_simple:
+        simple = fetch_text_simple(url, user_id, timeout_sec)
+        if simple:
+            return simple
     # ↓ ここから先は従来の Selenium 流れ ...
     logger.info(f"Fetching URL with Selenium: {url}")
-    options = webdriver.ChromeOptions()  # オプション設定...
-    options.add_argument('--headless=new');  # use modern headless mode – improves cookie support
-    options.add_argument('--no-sandbox'); options.add_argument('--disable-dev-shm-usage'); options.add_argument('--disable-gpu'); options.add_argument('--log-level=3'); options.add_argument('--disable-blink-features=AutomationControlled'); options.add_experimental_option('excludeSwitches', ['enable-automation']); options.add_experimental_option('useAutomationExtension', False); options.add_argument('user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36')
-    # --- Ensure cookies (incl. SameSite=None and third‑party) are accepted ---
-    options.add_argument("--disable-features=SameSiteByDefaultCookies,CookiesWithoutSameSiteMustBeSecure,BlockThirdPartyCookies")
-    options.add_argument("--disable-features=ImprovedCookieControls,ChromeCookieCrumbs")
-    options.add_experimental_option(
-        "prefs",
-        {
-            "profile.default_content_settings.cookies": 1,
-            "profile.block_third_party_cookies": False,
-            "profile.cookie_controls_mode": 0,  # Chrome 115+
-        },
-    )
-
     logger.info("Setting up WebDriver...")
     # --- Google Sites 専用: Cookie 注入で Private ページを取得 ---
     use_google_cookie = "sites.google.com" in url and user_id is not None
@@ -156,23 +471,10 @@ def fetch_text_from_url(url: str, user_id: int | None = None, timeout_sec=45, wa
                  json.dumps(cookies_to_inject, indent=2, ensure_ascii=False) if cookies_to_inject else "None")
 
     driver = None
+    driver_broken = False
     try:
-        driver_path = "/usr/local/bin/chromedriver"  # Dockerfileで配置したパス
-        if not os.path.exists(driver_path):
-            logger.error(f"ChromeDriver not found at specified path: {driver_path}")
-            return None
-        if not os.access(driver_path, os.X_OK):
-            logger.error(f"ChromeDriver at {driver_path} is not executable.")
-            return None
-        logger.info(f"Using ChromeDriver from: {driver_path}")
-
-        service = ChromeService(driver_path)
-        driver = webdriver.Chrome(service=service, options=options)
-        # --- Enable DevTools Network domain so we can batch‑set cookies with SameSite=None ---
-        try:
-            driver.execute_cdp_cmd("Network.enable", {})
-        except Exception as net_err:
-            logger.debug("CDP Network.enable failed (ignored): %s", net_err)
+        # 起動済みの Chrome をプールから借りる (Cookie / ストレージは返却時に消去済み)
+        driver = driver_pool.acquire()
         # --- Cookie injection: group by domain and inject per domain ---
         try:
             if cookies_to_inject:
@@ -294,6 +596,7 @@ def fetch_text_from_url(url: str, user_id: int | None = None, timeout_sec=45, wa
             logger.warning("Cookie injection failed: %s", cke)
         driver.set_page_load_timeout(timeout_sec)
         driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+        drain_network_events(driver)  # 事前訪問などで溜まったイベントを捨てる
         logger.info(f"Navigating to {url}...")
         driver.get(url)
         # --- Sanity‑check: did we actually land on the intended host? ---------
@@ -309,42 +612,35 @@ def fetch_text_from_url(url: str, user_id: int | None = None, timeout_sec=45, wa
             return None
         logger.info("After navigation current_url=%s", driver.current_url)
         WebDriverWait(driver, timeout_sec).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
-        logger.info(f"Waiting {wait_after_load_sec}s...")
-        time.sleep(wait_after_load_sec)
+        # 固定 sleep の代わりに、ネットワーク・DOM が落ち着いた時点で先へ進む
+        ready = wait_until_ready(driver, max_wait_sec=wait_after_load_sec)
+        waited_total, stop_reason = ready.waited_sec, ready.reason
         if scroll_attempts > 0: # スクロール処理...
              logger.info(f"Scrolling down up to {scroll_attempts} times...")
              last_height = driver.execute_script("return document.body.scrollHeight")
              for i in range(scroll_attempts):
                  driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-                 time.sleep(2)
-                 new_height = driver.execute_script("return document.body.scrollHeight")
-                 if new_height == last_height:
+                 ready = wait_until_ready(driver, max_wait_sec=2, prev_scroll_height=last_height)
+                 waited_total += ready.waited_sec
+                 if ready.scroll_height == last_height:
                      logger.info("Scroll height did not change, breaking scroll loop.")
+                     stop_reason = f"{ready.reason}, scroll height stable"
                      break
-                 last_height = new_height
+                 last_height = ready.scroll_height
+        logger.info("Readiness wait for %s: %.2fs (stopped: %s)", url, waited_total, stop_reason)
         logger.info("Getting page source...")
         html_content = driver.page_source
         if not html_content:
             logger.warning("Failed to get page source.")
             return None
         logger.info("Parsing HTML & extracting structured text...")
-        soup = BeautifulSoup(html_content, 'html.parser')
-        main_content_selectors = ['main', 'article', '[role="main"]', '.content', '#content', '.post-content', '#main-content', '.entry-content']
-        target_element = None
+        soup = parse_html(html_content)
         logger.info("Searching for main content area...")
-        for selector in main_content_selectors:
-            try:
-                potential_target = soup.select_one(selector)
-                if potential_target:
-                    target_element = potential_target
-                    logger.info(f"Found main content using selector: '{selector}'")
-                    break
-            except Exception as select_error:
-                logger.warning(f"Error occurred while using selector '{selector}': {select_error}")
-                continue
-        if not target_element:
+        target_element, found_by = find_main_content(soup)
+        if target_element is not None and target_element is not soup.body:
+            logger.info("Found main content using %s", found_by)
+        else:
             logger.warning("Main content not found, using body.")
-            target_element = soup.body
         if target_element:
             structured_text = extract_structured_text(target_element, url)
             cleaned_text = re.sub(r'\n\s*\n\s*\n+', '\n\n', structured_text).strip()
@@ -379,96 +675,507 @@ def fetch_text_from_url(url: str, user_id: int | None = None, timeout_sec=45, wa
         return None
     except WebDriverException as e:
         logger.exception("Error fetching %s", url)
+        driver_broken = True
         return None
     except Exception as e:
         logger.exception("Error fetching %s", url)
         return None
     finally:
         if driver:
-            logger.info("Closing WebDriver...")
-            driver.quit()
-
-# --- テキストのチャンク分割 (変更なし) ---
-def chunk_text(text: str, chunk_size_tokens=500, overlap_tokens=50) -> list[str]:
-    # ... (変更なし、whileループ版) ...
-    if not text: return []
-    try: encoding = tiktoken.get_encoding("cl100k_base")
-    except Exception as e: raise ValueError(f"Tiktoken encoding not found: {e}") from e
-    tokens = encoding.encode(text); chunks, current_position, total_tokens = [], 0, len(tokens)
-    while current_position < total_tokens:
-        end_position = min(current_position + chunk_size_tokens, total_tokens)
-        chunk_tokens = tokens[current_position:end_position]; chunk_text = encoding.decode(chunk_tokens).strip()
-        if chunk_text: chunks.append(chunk_text)
-        next_start = current_position + chunk_size_tokens - overlap_tokens; current_position = max(next_start, current_position + 1)
-        if end_position == total_tokens: break
-    return chunks
-
-# --- ▼ PDFからのテキスト抽出 (インデント修正) ▼ ---
-def extract_text_from_pdf(file_path: str) -> str | None:
-    """PDFファイルからテキストを抽出する"""
-    text_list: list[str] = []
-    try:
-        with open(file_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            num_pages = len(reader.pages)
-            if num_pages == 0:
-                 logger.warning(f"PDF file {file_path} has 0 pages.")
-                 return ""
-
-            # print(f"Reading PDF: {file_path} ({num_pages} pages)")
-            # --- ▼ for ループ (インデントレベル 3) ▼ ---
-            for i, page in enumerate(reader.pages):
-                # --- ▼ ループ内部の処理 (インデントレベル 4) ▼ ---
-                page_text_raw = None # 初期化
-
-                # --- ▼ try-except ブロック (インデントレベル 4) ▼ ---
-                # このブロック全体が for ループの中に入るようにインデント
-                try:
-                    # --- ▼ try内部 (インデントレベル 5) ▼ ---
-                    page_text_raw = page.extract_text()
-                    if page_text_raw and page_text_raw.strip():
-                        # --- ▼ if内部 (インデントレベル 6) ▼ ---
-                        text_list.append(page_text_raw.strip())
-                    # --- ▲ if終了 ▲ ---
-                # --- ▲ try終了 ▲ ---
-                except Exception as page_error:
-                    # --- ▼ except内部 (インデントレベル 5) ▼ ---
-                    logger.error(f"Error extracting text from page {i+1} of {file_path}: {page_error}")
-                    continue # 次のページへ
-                # --- ▲ except終了 ▲ ---
-            # --- ▲ for ループ終了 ▲ ---
-
-            full_text = "\n".join(text_list)
-            if not full_text and num_pages > 0:
-                 logger.warning(f"No text could be extracted from any pages in {file_path}.")
-            return full_text
+            logger.info("Returning WebDriver to pool...")
+            driver_pool.release(driver, broken=driver_broken)
+
+# --- テキストのチャンク分割 ---
+CHUNK_ENCODING_NAME = "cl100k_base"
+CHUNK_ENCODE_SEGMENT_CHARS = 1_000_000   # 巨大テキストはこの文字数ごと (改行位置) に分けてトークン化
+
+_chunk_encoding = None
+_chunk_encoding_lock = threading.Lock()
+
+
+def get_chunk_encoding():
+    """チャンク分割用の tiktoken エンコーダ (プロセス内で 1 度だけ読み込む)"""
+    global _chunk_encoding
+    if _chunk_encoding is None:
+        with _chunk_encoding_lock:
+            if _chunk_encoding is None:
+                try: _chunk_encoding = tiktoken.get_encoding(CHUNK_ENCODING_NAME)
+                except Exception as e: raise ValueError(f"Tiktoken encoding not found: {e}") from e
+    return _chunk_encoding
 
+
+def _iter_text_segments(text: str, segment_chars: int):
+    """text を segment_chars 程度ごとに、できるだけ改行の直後で区切って返す"""
+    start, length = 0, len(text)
+    while start < length:
+        end = start + segment_chars
+        if end >= length:
+            yield text[start:]; return
+        cut = text.rfind("\n", start, end)
+        end = cut + 1 if cut > start else end
+        yield text[start:end]
+        start = end
+
+
+def _iter_pieces(text):
+    """str はそのまま、ページ等の反復可能オブジェクトは改行で連結した場合と同じ区切りで返す"""
+    if isinstance(text, str):
+        yield from _iter_text_segments(text, CHUNK_ENCODE_SEGMENT_CHARS)
+        return
+    for i, piece in enumerate(text):
+        yield piece if i == 0 else "\n" + piece
+
+
+def iter_chunks(text, chunk_size_tokens=500, overlap_tokens=50):
+    """
+    chunk_text の逐次版。overlap 付きの固定長ウィンドウでチャンクを 1 つずつ返す。
+    トークンは array (uint32) に区間ごとに積み、使い終わった先頭部分は捨てるため
+    巨大なテキストでも全トークン・全チャンクを同時にメモリへ載せない。
+    text には str のほか、PDF のページ列のような str の反復可能オブジェクトも渡せる。
+    """
+    if not text: return
+    encoding = get_chunk_encoding()
+    step = max(chunk_size_tokens - overlap_tokens, 1)
+    buf = array("I")
+    base = 0            # buf[0] のテキスト全体での位置
+    pos = 0             # 次のウィンドウの開始位置
+
+    segments = _iter_pieces(text)
+    segment = next(segments, None)
+    while segment is not None:
+        buf.extend(encoding.encode(segment, disallowed_special=()))
+        segment = next(segments, None)
+        total = base + len(buf)
+        if segment is not None:
+            # 続きがある間は、丸ごと揃ったウィンドウだけを切り出す
+            while pos + chunk_size_tokens <= total:
+                chunk = encoding.decode(buf[pos - base:pos - base + chunk_size_tokens].tolist()).strip()
+                if chunk: yield chunk
+                pos += step
+            del buf[:pos - base]; base = pos
+        else:
+            while pos < total:
+                end = min(pos + chunk_size_tokens, total)
+                chunk = encoding.decode(buf[pos - base:end - base].tolist()).strip()
+                if chunk: yield chunk
+                if end == total: break
+                pos += step
+
+
+# --- 構造を考慮したチャンク分割 (見出し・表・段落・文の境界で区切る) ---
+CHUNKING_STRATEGY = os.getenv("CHUNKING_STRATEGY", "structured")   # "structured" | "fixed"
+
+_HEADING_LINE_RE = re.compile(r'^(#{1,6}) +(.*\S)\s*$')
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[。！？!?])\s*|(?<=\.)\s+')
+
+
+class Chunk(str):
+    """見出しパス付きのチャンク。str のサブクラスなので既存の呼び出し側はそのまま扱える"""
+    heading_path: str = ""
+
+    def __new__(cls, text: str, heading_path: str = ""):
+        obj = super().__new__(cls, text)
+        obj.heading_path = heading_path
+        return obj
+
+
+def _iter_blocks(text):
+    """
+    extract_structured_text 形式のテキスト (またはページ等の str の列) をブロックに分ける。
+    ("heading", level, title) / ("code" | "text", lines) を順に返す。
+    表 (--- で囲まれた行) は巨大になり得る (Excel のシート等) ので溜めずに
+    ("row", line) を 1 行ずつ返し、閉じた所で ("table_end",) を返す。
+    """
+    # 巨大な str も改行位置で区切って少しずつ行に分ける (全行のリストを作らない)
+    pieces = _iter_text_segments(text, CHUNK_ENCODE_SEGMENT_CHARS) if isinstance(text, str) else text
+    kind, lines = None, []
+    for line in (line for piece in pieces for line in piece.splitlines()):
+        stripped = line.strip()
+        if kind == "code":
+            lines.append(line)
+            if stripped == "```": yield ("code", lines); kind, lines = None, []
+            continue
+        if kind == "table":
+            if stripped == "---": yield ("table_end",); kind = None
+            elif stripped: yield ("row", line)
+            continue
+        if stripped in ("```", "---"):
+            if lines: yield ("text", lines)
+            kind, lines = ("code", [line]) if stripped == "```" else ("table", [])
+            continue
+        heading = _HEADING_LINE_RE.match(stripped)
+        if heading:
+            if lines: yield ("text", lines)
+            kind, lines = None, []
+            yield ("heading", len(heading.group(1)), heading.group(2))
+            continue
+        if not stripped:
+            if lines: yield ("text", lines)
+            lines = []
+            continue
+        lines.append(line)
+    if kind == "table": yield ("table_end",)
+    elif lines: yield (kind or "text", lines)
+
+
+def iter_structured_chunks(text, chunk_size_tokens=500, overlap_tokens=50):
+    """
+    見出し (#)・表 (--- で囲まれた行)・段落・日本語の文末 (。！？) を境界として
+    chunk_size_tokens 以内のチャンクを作る。見出しが変わると必ずチャンクを区切り、
+    各チャンクには "大見出し > 中見出し" 形式の heading_path を付ける。
+    1 文でも上限を超える場合だけ固定長ウィンドウ (overlap_tokens 重複) で分割する。
+    """
+    if not text: return
+    encoding = get_chunk_encoding()
+
+    def count(s: str) -> int:
+        return len(encoding.encode(s, disallowed_special=()))
+
+    headings: list[tuple[int, str]] = []
+    parts: list[str] = []
+    size = 0
+    has_body = False
+
+    def flush():
+        nonlocal parts, size, has_body
+        chunk = "\n".join(parts).strip()
+        if chunk and has_body:
+            yield Chunk(chunk, " > ".join(title for _, title in headings))
+        parts, size, has_body = [], 0, False
+
+    def add(unit: str, n_tokens: int):
+        nonlocal size, has_body
+        if has_body and size + n_tokens > chunk_size_tokens:
+            yield from flush()
+        parts.append(unit); size += n_tokens + 1; has_body = True   # +1 は区切りの改行
+
+    def add_long(unit: str):
+        """上限を超える 1 行を文単位 → 固定長ウィンドウの順に分割して追加"""
+        for sentence in filter(None, (s.strip() for s in _SENTENCE_SPLIT_RE.split(unit))):
+            n_tokens = count(sentence)
+            if n_tokens <= chunk_size_tokens:
+                yield from add(sentence, n_tokens)
+            else:
+                for window in iter_chunks(sentence, chunk_size_tokens, overlap_tokens):
+                    yield from flush()
+                    yield from add(window, chunk_size_tokens)
+
+    def add_line(line: str, header: str | None, first: bool):
+        """大きいブロックの 1 行を詰める (表の続きのチャンクには見出し行を再掲)"""
+        n_tokens = count(line)
+        if n_tokens > chunk_size_tokens:
+            yield from add_long(line)
+            return
+        if header is not None and not first and has_body and size + n_tokens > chunk_size_tokens:
+            yield from flush()
+            yield from add(header, count(header))
+        yield from add(line, n_tokens)
+
+    def add_block(kind: str, lines: list[str]):
+        body = "\n".join(lines)
+        if kind == "table": body = "---\n" + body + "\n---"
+        n_tokens = count(body)
+        if n_tokens <= chunk_size_tokens:
+            yield from add(body, n_tokens)
+            return
+        # --- 大きいブロックは行単位で詰める ---
+        header = lines[0] if kind == "table" else None
+        for i, line in enumerate(lines):
+            yield from add_line(line, header, i == 0)
+
+    # 表は上限に収まる間だけ行を溜め (収まれば --- で囲んで 1 まとまりで追加)、
+    # 超えた時点で行単位の追加に切り替えて以降の行は溜めない
+    table_rows: list[str] = []
+    table_tokens = 0
+    table_header: str | None = None     # 行単位に切り替えた表の見出し行
+
+    for block in _iter_blocks(text):
+        if block[0] == "row":
+            line = block[1]
+            if table_header is not None:
+                yield from add_line(line, table_header, False)
+                continue
+            table_rows.append(line); table_tokens += count(line) + 1
+            if table_tokens > chunk_size_tokens:
+                # 行ごとの概算が上限を超えたら、囲んだ全体を数え直して確かめる
+                table_tokens = count("---\n" + "\n".join(table_rows) + "\n---")
+            if table_tokens > chunk_size_tokens:
+                table_header = table_rows[0]
+                for i, row in enumerate(table_rows):
+                    yield from add_line(row, table_header, i == 0)
+                table_rows = []
+            continue
+        if block[0] == "table_end":
+            if table_rows: yield from add_block("table", table_rows)
+            table_rows, table_tokens, table_header = [], 0, None
+            continue
+        if block[0] == "heading":
+            _, level, title = block
+            if has_body: yield from flush()
+            while headings and headings[-1][0] >= level: headings.pop()
+            # 本文の無かった同階層以下の見出し行は捨て、親見出しの行だけ残す
+            parts = [p for p in parts if len(p) - len(p.lstrip("#")) < level]
+            headings.append((level, title))
+            parts.append("#" * level + " " + title)
+            size = sum(count(p) + 1 for p in parts)
+            continue
+        yield from add_block(*block)
+    yield from flush()
+
+
+CHUNKING_STRATEGIES = {
+    "fixed": iter_chunks,
+    "structured": iter_structured_chunks,
+}
+
+
+def iter_text_chunks(text, chunk_size_tokens=500, overlap_tokens=50, strategy: str | None = None):
+    """
+    テキスト (str またはページ等の str の反復可能オブジェクト) をチャンクに分割し、1 つずつ返す。
+    strategy (既定は CHUNKING_STRATEGY) で分割方法を選ぶ。
+    "structured" は見出しパス付きの Chunk を、"fixed" は固定長ウィンドウの str を返す。
+    retriever.sync_documents にそのまま渡せば、全チャンクをメモリに載せずに登録できる。
+    """
+    name = strategy or CHUNKING_STRATEGY
+    chunker = CHUNKING_STRATEGIES.get(name)
+    if chunker is None:
+        logger.warning("Unknown chunking strategy '%s', using fixed windows.", name)
+        chunker = iter_chunks
+    return chunker(text, chunk_size_tokens, overlap_tokens)
+
+
+def chunk_text(text, chunk_size_tokens=500, overlap_tokens=50, strategy: str | None = None) -> list[str]:
+    """iter_text_chunks の結果をリストで返す"""
+    return list(iter_text_chunks(text, chunk_size_tokens, overlap_tokens, strategy))
+
+# --- PDFからのテキスト抽出 (ページ単位の並列・逐次処理は pdf_extract.py) ---
+def iter_text_from_pdf(file_path: str):
+    """
+    PDF のページテキストを 1 ページずつ返す (ファイルが無ければ何も返さない)。
+    それ以外の読み込みエラーは送出する: 途中までのページで差分同期すると残りのチャンクが削除されるため、
+    取り込みジョブ側で失敗として扱う。
+    """
+    try:
+        yield from iter_pdf_pages(file_path)
     except FileNotFoundError:
         logger.error(f"PDF not found: {file_path}")
+
+
+def extract_text_from_pdf(file_path: str) -> str | None:
+    """PDFファイルからテキストを抽出する"""
+    if not os.path.exists(file_path):
+        logger.error(f"PDF not found: {file_path}")
         return None
-    except PyPDF2.errors.PdfReadError as pdf_error:
-        logger.error(f"Error reading PDF {file_path}: {pdf_error}")
-        return None
+    try:
+        full_text = "\n".join(iter_text_from_pdf(file_path))
     except Exception as e:
-        logger.exception(f"PDF error {file_path}: {e}")
+        logger.exception(f"Error reading PDF {file_path}: {e}")
         return None
-# --- ▲ PDFからのテキスト抽出 (インデント修正) ▲ ---
+    if not full_text:
+        logger.warning(f"No text could be extracted from any pages in {file_path}.")
+    return full_text
 
 
-# --- DOCXからのテキスト抽出 (変更あり) ---
-def extract_text_from_docx(file_path: str) -> str | None:
-    # ... (変更なし) ...
-    text_list: list[str] = []
+# --- DOCXからのテキスト抽出 (本文の段落・表を文書順に、ヘッダー/フッターも含める) ---
+_DOCX_HEADING_RE = re.compile(r'^(?:Heading|見出し)\s*(\d)$')
+
+
+def _docx_paragraph_text(paragraph) -> str:
+    """段落のテキスト。見出しスタイルは '#' 付きにして構造化チャンク分割で見出しとして扱う"""
+    text = paragraph.text.strip()
+    if not text:
+        return ""
+    style_name = paragraph.style.name if paragraph.style is not None else ""
+    heading = _DOCX_HEADING_RE.match(style_name or "")
+    if heading:
+        return "#" * min(int(heading.group(1)), 6) + " " + text
+    if style_name == "Title":
+        return "# " + text
+    return text
+
+
+def _docx_table_lines(table) -> list[str]:
+    """表を '---' で囲んだ 'セル | セル' 形式の行にする (結合セルの重複は除く)"""
+    lines = ["---"]
+    for row in table.rows:
+        cells, seen = [], set()
+        for cell in row.cells:
+            if id(cell._tc) in seen:
+                continue
+            seen.add(id(cell._tc))
+            cells.append(" ".join(cell.text.split()))
+        if any(cells):
+            lines.append(" | ".join(cells))
+    lines.append("---")
+    return lines if len(lines) > 2 else []
+
+
+def _docx_header_footer_lines(doc, attr: str) -> list[str]:
+    lines: list[str] = []
+    for section in doc.sections:
+        part = getattr(section, attr)
+        if part.is_linked_to_previous:
+            continue
+        for paragraph in part.paragraphs:
+            text = paragraph.text.strip()
+            if text and text not in lines:
+                lines.append(text)
+    return lines
+
+
+def iter_text_from_docx(file_path: str):
+    """
+    DOCX のテキストを行単位で返す (ヘッダー → 本文の段落・表 → フッターの順)。
+    ファイルが無ければ何も返さず、それ以外の読み込みエラーは送出する (iter_text_from_pdf と同様)。
+    """
     try:
         doc = Document(file_path)
-        text_list = [para.text.strip() for para in doc.paragraphs if para.text and para.text.strip()]
-        full_text = "\n".join(text_list)
-        if not full_text:
-            logger.warning(f"No text extracted from DOCX: {file_path}")
-        return full_text
+        yield from _docx_header_footer_lines(doc, "header")
+        for block in doc.iter_inner_content():
+            if isinstance(block, DocxTable):
+                yield from _docx_table_lines(block)
+            else:
+                text = _docx_paragraph_text(block)
+                if text: yield text
+        yield from _docx_header_footer_lines(doc, "footer")
     except FileNotFoundError:
         logger.error(f"DOCX not found: {file_path}")
+
+
+def extract_text_from_docx(file_path: str) -> str | None:
+    """DOCXファイルからテキストを抽出する"""
+    if not os.path.exists(file_path):
+        logger.error(f"DOCX not found: {file_path}")
         return None
+    try:
+        full_text = "\n".join(iter_text_from_docx(file_path))
     except Exception as e:
         logger.exception(f"Error reading DOCX {file_path}: {e}")
-        return None
\ No newline at end of file
+        return None
+    if not full_text:
+        logger.warning(f"No text extracted from DOCX: {file_path}")
+    return full_text
+
+
+# --- Excel からのテキスト抽出 (シート・行を逐次読み込み) ---
+def _excel_cell_text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat() if value.time() == datetime.time() else value.isoformat(sep=" ")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return " ".join(str(value).split())
+
+
+def _excel_row_lines(sheet_name: str, rows):
+    """
+    1 シート分の行を "## シート名" + '---' で囲んだ 'セル | セル' 形式の表にする。
+    先頭の空でない行を見出し行とし、空行と末尾の空セルは出力しない (列幅の空白埋めも無し)。
+    """
+    started = False
+    for row in rows:
+        cells = [_excel_cell_text(v) for v in row]
+        while cells and not cells[-1]:
+            cells.pop()
+        if not cells:
+            continue
+        if not started:
+            yield f"## {sheet_name}"
+            yield "---"
+            started = True
+        yield " | ".join(cells)
+    if started:
+        yield "---"
+
+
+def iter_text_from_excel(file_path: str):
+    """
+    Excel の全シートを行単位で返す (.xlsx は openpyxl の read-only モードで逐次読み込み)。
+    ファイルが無ければ何も返さず、それ以外の読み込みエラーは送出する (iter_text_from_pdf と同様)。
+    """
+    try:
+        if file_path.lower().endswith(".xls"):
+            # 旧形式 (.xls) は openpyxl 非対応のため pandas で読む
+            for sheet_name, df in pd.read_excel(file_path, sheet_name=None, header=None, dtype=object).items():
+                rows = (tuple(None if pd.isna(v) else v for v in row) for row in df.itertuples(index=False))
+                yield from _excel_row_lines(sheet_name, rows)
+            return
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                yield from _excel_row_lines(sheet.title, sheet.iter_rows(values_only=True))
+        finally:
+            workbook.close()
+    except FileNotFoundError:
+        logger.error(f"Excel not found: {file_path}")
+
+
+def extract_text_from_excel(file_path: str) -> str | None:
+    """Excel (.xls / .xlsx) の全シートを 'セル | セル' 形式のテキストにする"""
+    if not os.path.exists(file_path):
+        logger.error(f"Excel not found: {file_path}")
+        return None
+    try:
+        return "\n".join(iter_text_from_excel(file_path))
+    except Exception as e:
+        logger.exception(f"Error reading Excel {file_path}: {e}")
+        return None
+
+
+# --- テキストファイルの読み込み (エンコーディング自動判別) ---
+TEXT_ENCODINGS = ('utf-8', 'shift-jis', 'cp932', 'euc-jp')
+
+
+def extract_text_from_txt(file_path: str, encoding: str | None = None) -> str | None:
+    """
+    テキストファイルを mmap で読み込む。encoding (アップロード時に検出済み) が無ければ
+    UTF-8 → Shift_JIS → CP932 → EUC-JP の順に試す (ファイルの再読み込みはしない)。
+    """
+    try:
+        if os.path.getsize(file_path) == 0:
+            return ""
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for enc in ([encoding] if encoding else []) + [e for e in TEXT_ENCODINGS if e != encoding]:
+                try:
+                    text = codecs.decode(mm, enc)
+                    logger.info(f"Read {file_path} with {enc}")
+                    return text
+                except (UnicodeDecodeError, LookupError):
+                    continue
+    except FileNotFoundError:
+        logger.error(f"Text file not found: {file_path}")
+        return None
+    logger.error(f"Could not decode text file: {file_path}")
+    return None
+
+
+# --- 拡張子に応じたファイルからのテキスト抽出 ---
+def iter_text_from_file(file_path: str, file_ext: str, encoding: str | None = None):
+    """
+    extract_text_from_file の逐次版。PDF はページごと、Excel / DOCX は行ごとにテキストを返すので、
+    iter_text_chunks にそのまま渡せば全文をメモリに載せずにチャンク分割できる。
+    """
+    file_ext = file_ext.lower().lstrip('.')
+    if file_ext == 'pdf': return iter_text_from_pdf(file_path)
+    if file_ext in ('xls', 'xlsx'): return iter_text_from_excel(file_path)
+    if file_ext == 'docx': return iter_text_from_docx(file_path)
+    if file_ext == 'txt':
+        text = extract_text_from_txt(file_path, encoding)
+        return [text] if text else []
+    text = extract_text_from_file(file_path, file_ext)
+    return [text] if text else []
+
+
+# --- 拡張子に応じたファイルからのテキスト抽出 ---
+def extract_text_from_file(file_path: str, file_ext: str) -> str | None:
+    """アップロードされたファイルからテキストを抽出する (未対応・失敗時は None)"""
+    file_ext = file_ext.lower().lstrip('.')
+    if file_ext == 'pdf': return extract_text_from_pdf(file_path)
+    if file_ext in ('xls', 'xlsx'): return extract_text_from_excel(file_path)
+    if file_ext == 'docx': return extract_text_from_docx(file_path)
+    if file_ext == 'txt': return extract_text_from_txt(file_path)
+    logger.error(f"Unsupported file type for extraction: {file_ext}")
+    return None
@@ -0,0 +1,309 @@
+# backend/services/lexical_index.py
+"""
+Per-user BM25 index for the lexical half of hybrid retrieval.
+
+Japanese text has no spaces, so CJK / kana runs are indexed as character
+bigrams while ASCII runs (product codes, model numbers, names) are indexed as
+whole lower-cased words plus their hyphen/dot separated parts.  Indexes are
+kept in process memory and built from the user's Chroma documents in a
+background thread (searches fall back to vector-only until the first build
+finishes).  Writes are applied incrementally: every write bumps the shared
+source version (source_version.py) together with a compressed record of the
+changed document ids.  Processes that did not perform the write replay those
+records, re-fetching the upserted documents from Chroma, instead of
+rebuilding.  When records are missing (trimmed, too large, Redis down) the
+index is rebuilt in the background while the old one keeps serving.  Memory is
+bounded by per-user and total token caps with LRU eviction.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.services import source_version
+
+logger = logging.getLogger(__name__)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+LEXICAL_INDEX_TTL_SEC = float(os.getenv("LEXICAL_INDEX_TTL_SEC", "1800"))   # これより古い索引はバックグラウンドで作り直す
+LEXICAL_INDEX_MAX_USERS = int(os.getenv("LEXICAL_INDEX_MAX_USERS", "200"))
+LEXICAL_INDEX_MAX_USER_TOKENS = int(os.getenv("LEXICAL_INDEX_MAX_USER_TOKENS", "5000000"))     # 超えるユーザーは BM25 を使わない
+LEXICAL_INDEX_MAX_TOTAL_TOKENS = int(os.getenv("LEXICAL_INDEX_MAX_TOTAL_TOKENS", "20000000"))  # プロセス内の全索引の合計
+LEXICAL_INDEX_BUILD_WORKERS = int(os.getenv("LEXICAL_INDEX_BUILD_WORKERS", "1"))
+LEXICAL_CHANGE_MAX_BYTES = int(os.getenv("LEXICAL_CHANGE_MAX_BYTES", str(16 * 1024)))        # 圧縮後の変更記録 (ID のみ) の上限
+LEXICAL_CATCH_UP_MAX_DOCS = int(os.getenv("LEXICAL_CATCH_UP_MAX_DOCS", "2000"))   # これより多く変わっていれば再生せず作り直す
+
+_WORD_RE = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+_CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")   # かな・カナ・漢字
+
+
+def tokenize(text: str) -> list[str]:
+    """NFKC 正規化した上で、英数字は単語 (+ 区切り記号で分けた部分)、日本語は文字 bigram にする"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens: list[str] = []
+    for word in _WORD_RE.findall(text):
+        tokens.append(word)
+        parts = re.split(r"[-_./]", word)
+        if len(parts) > 1:
+            tokens.extend(p for p in parts if p)
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    """Inverted index with BM25 scoring; documents are addressed by Chroma id."""
+
+    def __init__(self):
+        self.postings: dict[str, dict[str, int]] = {}   # term → {doc_id: tf}
+        self.doc_terms: dict[str, Counter] = {}          # doc_id → term counts (削除用)
+        self.doc_len: dict[str, int] = {}
+        self.total_len = 0
+        self.version = 0
+        self.built_at = time.monotonic()
+        self.last_used = self.built_at
+
+    def __len__(self) -> int:
+        return len(self.doc_len)
+
+    def add(self, doc_id: str, text: str) -> None:
+        if doc_id in self.doc_len:
+            self.remove(doc_id)
+        counts = Counter(tokenize(text))
+        self.doc_terms[doc_id] = counts
+        self.doc_len[doc_id] = sum(counts.values())
+        self.total_len += self.doc_len[doc_id]
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+
+    def remove(self, doc_id: str) -> None:
+        counts = self.doc_terms.pop(doc_id, None)
+        if counts is None:
+            return
+        self.total_len -= self.doc_len.pop(doc_id, 0)
+        for term in counts:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[term]
+
+    def search(self, query: str, top_k: int) -> list[tuple[str, float]]:
+        """Return up to top_k (doc_id, score) pairs, best first."""
+        n_docs = len(self.doc_len)
+        if not n_docs:
+            return []
+        avg_len = self.total_len / n_docs
+        scores: dict[str, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in list(posting.items()):   # 書き込みスレッドと並行しても落ちないようコピー
+                doc_len = self.doc_len.get(doc_id)
+                if doc_len is None:
+                    continue
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * doc_len / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        return sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:top_k]
+
+
+# ---------------------------------------------------------------------------
+# per-user index registry
+# ---------------------------------------------------------------------------
+class IndexTooLarge(Exception):
+    pass
+
+
+_indexes: dict[int, BM25Index] = {}
+_indexes_lock = threading.Lock()
+_build_locks: dict[int, threading.Lock] = {}
+_building: set[int] = set()                 # バックグラウンドで構築中のユーザー
+_too_large: dict[int, float] = {}           # 上限を超えたユーザー → 判定した時刻 (TTL の間は BM25 を使わない)
+_executor: ThreadPoolExecutor | None = None
+
+
+def _encode_change(upserted, deleted_ids) -> bytes:
+    """
+    他プロセスが再生できる変更記録。本文は載せず ID だけを記録し、再生側が Chroma から読み直す
+    (大きすぎる場合は空 = 再構築してもらう)。
+    """
+    payload = json.dumps({"u": [doc_id for doc_id, _ in upserted or []], "d": deleted_ids or []}, separators=(",", ":"))
+    change = zlib.compress(payload.encode(), 1)
+    return change if len(change) <= LEXICAL_CHANGE_MAX_BYTES else b""
+
+
+def _apply_change(index: BM25Index, upserted, deleted_ids) -> None:
+    for doc_id in deleted_ids or []:
+        index.remove(doc_id)
+    for doc_id, text in upserted or []:
+        if text:
+            index.add(doc_id, text)
+
+
+def _catch_up(user_id: int, index: BM25Index, version: int, fetch) -> bool:
+    """
+    index.version から version までの変更記録を再生する (記録が揃っていない・多すぎる場合は False)。
+    触れられた ID を一旦すべて外し、upsert された ID を fetch(ids) → [(doc_id, text), ...] で
+    Chroma から読み直して入れ直す (後で削除されたものは返らないので、そのまま消える)。
+    """
+    records = source_version.changes_since(user_id, index.version, version)
+    if records is None:
+        return False
+    upserted: dict[str, None] = {}
+    deleted: set[str] = set()
+    for record in records:
+        change = json.loads(zlib.decompress(record))
+        upserted.update(dict.fromkeys(change["u"]))
+        deleted.update(change["d"])
+    if len(upserted) + len(deleted) > LEXICAL_CATCH_UP_MAX_DOCS or (upserted and fetch is None):
+        return False
+    fetched = list(fetch(list(upserted))) if upserted else []
+    _apply_change(index, fetched, list(deleted | upserted.keys()))
+    index.version = version
+    return True
+
+
+def _enforce_limits(keep: int) -> None:
+    """ユーザー数・総トークン数の上限を超えた分を、最後に使われたのが古い索引から捨てる (lock 保持中に呼ぶ)"""
+    total = sum(index.total_len for index in _indexes.values())
+    while len(_indexes) > 1 and (len(_indexes) > LEXICAL_INDEX_MAX_USERS or total > LEXICAL_INDEX_MAX_TOTAL_TOKENS):
+        victim = min((uid for uid in _indexes if uid != keep), key=lambda uid: _indexes[uid].last_used)
+        total -= _indexes.pop(victim).total_len
+
+
+def _build(user_id: int, loader, fetch) -> BM25Index:
+    version = source_version.get_version(user_id)   # 読み込み中の書き込みは後で変更記録から追いつく
+    if version is None:
+        raise RuntimeError("source version unavailable")
+    t0 = time.monotonic()
+    index = BM25Index()
+    for doc_id, text in loader():
+        if text:
+            index.add(doc_id, text)
+            if index.total_len > LEXICAL_INDEX_MAX_USER_TOKENS:
+                raise IndexTooLarge(f"more than {LEXICAL_INDEX_MAX_USER_TOKENS} tokens")
+    index.version = version
+    latest = source_version.get_version(user_id)
+    if latest is not None and latest != version and not _catch_up(user_id, index, latest, fetch):
+        logger.info("Lexical index for user %s built at version %s, now %s; will refresh.", user_id, version, latest)
+    logger.info("Built lexical index for user %s: %d docs, %d terms, %d tokens (%.2fs)",
+                user_id, len(index), len(index.postings), index.total_len, time.monotonic() - t0)
+    return index
+
+
+def _build_in_background(user_id: int, loader, fetch) -> None:
+    try:
+        index = _build(user_id, loader, fetch)
+    except IndexTooLarge as e:
+        logger.warning("Lexical index for user %s skipped (%s); using vector search only.", user_id, e)
+        with _indexes_lock:
+            _too_large[user_id] = time.monotonic()
+            _indexes.pop(user_id, None)
+        return
+    except Exception as e:
+        logger.warning("Failed to build lexical index for user %s: %s", user_id, e)
+        return
+    finally:
+        with _indexes_lock:
+            _building.discard(user_id)
+    with _build_locks.setdefault(user_id, threading.Lock()):
+        with _indexes_lock:
+            _too_large.pop(user_id, None)
+            _indexes[user_id] = index
+            _enforce_limits(keep=user_id)
+
+
+def _schedule_build(user_id: int, loader, fetch) -> None:
+    """索引の (再) 構築をバックグラウンドで始める。既存の索引は完了まで引き続き使われる"""
+    global _executor
+    with _indexes_lock:
+        if user_id in _building:
+            return
+        marked = _too_large.get(user_id)
+        if marked is not None and time.monotonic() - marked < LEXICAL_INDEX_TTL_SEC:
+            return
+        _building.add(user_id)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=LEXICAL_INDEX_BUILD_WORKERS, thread_name_prefix="lexical-index")
+        executor = _executor
+    executor.submit(_build_in_background, user_id, loader, fetch)
+
+
+def get_index(user_id: int, loader, fetch=None) -> BM25Index | None:
+    """
+    ユーザーの索引を返す。他プロセスの書き込みでバージョンが進んでいれば変更記録を再生して
+    (本文は fetch(ids) → [(doc_id, text), ...] で読み直して) 追いつき、記録が足りない・TTL 切れなら
+    loader() → [(doc_id, text), ...] での作り直しをバックグラウンドで始めて、それまでは今の索引を返す。
+    未構築・上限超過の場合は None (呼び出し側はベクトル検索のみ)。
+    """
+    version = source_version.get_version(user_id)
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+        lock = _build_locks.setdefault(user_id, threading.Lock())
+    if version is None:
+        return index    # バージョンが読めない (Redis 障害) 間は追いつきも作り直しもしない
+    if index is None:
+        _schedule_build(user_id, loader, fetch)
+        return None
+    index.last_used = time.monotonic()
+    if index.version != version:
+        with lock:  # 同じユーザーの変更記録を複数スレッドで同時に再生しない
+            if index.version < version and _catch_up(user_id, index, version, fetch):
+                return index
+        if index.version != version:
+            _schedule_build(user_id, loader, fetch)
+    elif time.monotonic() - index.built_at >= LEXICAL_INDEX_TTL_SEC:
+        _schedule_build(user_id, loader, fetch)
+    return index
+
+
+def apply_changes(user_id: int, upserted: list[tuple[str, str]] | None = None, deleted_ids: list[str] | None = None) -> None:
+    """
+    書き込み後に呼ぶ。変更記録を付けてバージョンを進め (他プロセスはこれを再生して追いつく)、
+    このプロセスの索引が直前の版なら差分をそのまま反映する。
+    """
+    change = _encode_change(upserted, deleted_ids)
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+        lock = _build_locks.setdefault(user_id, threading.Lock())
+    if index is None:
+        source_version.bump_version(user_id, change)
+        return
+    with lock:
+        previous = index.version
+        version = source_version.bump_version(user_id, change)
+        if version is None:
+            # 版を記録できなかった (Redis 障害): この索引は版が分からなくなるので捨てて作り直させる
+            with _indexes_lock:
+                if _indexes.get(user_id) is index:
+                    del _indexes[user_id]
+            return
+        if version != previous + 1:
+            return      # 他の書き込みを取りこぼしている: 次の get_index で追いつく (または作り直す)
+        _apply_change(index, upserted, deleted_ids)
+        index.version = version
+    if index.total_len > LEXICAL_INDEX_MAX_USER_TOKENS:
+        logger.warning("Lexical index for user %s exceeds %d tokens; dropped.", user_id, LEXICAL_INDEX_MAX_USER_TOKENS)
+        with _indexes_lock:
+            _too_large[user_id] = time.monotonic()
+            if _indexes.get(user_id) is index:
+                del _indexes[user_id]
+        return
+    with _indexes_lock:
+        _enforce_limits(keep=user_id)
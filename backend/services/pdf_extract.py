@@ -0,0 +1,205 @@
+# backend/services/pdf_extract.py
+"""
+Page-parallel PDF text extraction.
+
+Pages are split into ranges and extracted in a process pool; results are
+yielded page by page, in order, with a bounded number of ranges in flight so
+memory stays flat on very large documents.  Small documents use a pool of one
+process, so every PDF is extracted outside the caller's process.  Each page
+gets its own timeout (SIGALRM in the pool process), so one pathological page
+cannot stall the whole file.  A page stuck in native code, which the alarm
+cannot interrupt, hits the range deadline instead.  The pool is then
+terminated and PdfRangeTimeout is raised.
+
+This module only imports PDF libraries so that spawned worker processes start
+quickly (it must not import the Flask app or Selenium).
+"""
+
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+# "auto" → pypdfium2 (高速) → pypdf → PyPDF2 の順に使えるものを選ぶ
+PDF_BACKEND = os.getenv("PDF_BACKEND", "auto")
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "25"))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "50"))   # これ未満はプロセスを起動せず直列で処理
+PDF_PAGE_TIMEOUT_SEC = float(os.getenv("PDF_PAGE_TIMEOUT_SEC", "20"))
+PDF_SLOW_PAGE_SEC = 2.0                                                    # これより遅いページはログに残す
+PDF_RANGE_GRACE_SEC = 30.0                                                 # 範囲の締め切りに足す余裕 (プロセス起動・ファイル読み込み)
+
+
+class PageTimeout(Exception):
+    pass
+
+
+class PdfRangeTimeout(Exception):
+    """ページ範囲が締め切りまでに終わらなかった (ネイティブコードで固まったページ等)"""
+
+
+# ---------------------------------------------------------------------------
+# backends: open(path) → document / page_count(doc) / page_text(doc, index)
+# ---------------------------------------------------------------------------
+def _pdfium_open(path):
+    import pypdfium2
+    return pypdfium2.PdfDocument(path)
+
+
+def _pdfium_text(doc, index: int) -> str:
+    page = doc[index]
+    try:
+        textpage = page.get_textpage()
+        try:
+            return textpage.get_text_range()
+        finally:
+            textpage.close()
+    finally:
+        page.close()
+
+
+def _pypdf_open(path):
+    import pypdf
+    return pypdf.PdfReader(path)
+
+
+def _pypdf2_open(path):
+    import PyPDF2
+    return PyPDF2.PdfReader(path)
+
+
+_BACKENDS = {
+    "pypdfium2": (_pdfium_open, len, _pdfium_text),
+    "pypdf": (_pypdf_open, lambda r: len(r.pages), lambda r, i: r.pages[i].extract_text()),
+    "pypdf2": (_pypdf2_open, lambda r: len(r.pages), lambda r, i: r.pages[i].extract_text()),
+}
+_BACKEND_MODULES = {"pypdfium2": "pypdfium2", "pypdf": "pypdf", "pypdf2": "PyPDF2"}
+
+
+def _close(doc) -> None:
+    """pypdfium2 の PdfDocument はネイティブのハンドルを持つので明示的に閉じる (pypdf 系は close を持たない)"""
+    close = getattr(doc, "close", None)
+    if close is not None:
+        close()
+
+
+def _select_backend() -> str:
+    names = [PDF_BACKEND] if PDF_BACKEND != "auto" else ["pypdfium2", "pypdf", "pypdf2"]
+    for name in names:
+        try:
+            __import__(_BACKEND_MODULES[name])
+            return name
+        except (ImportError, KeyError):
+            continue
+    return "pypdf2"
+
+
+BACKEND = _select_backend()
+
+
+# ---------------------------------------------------------------------------
+# per-page timeout (SIGALRM; worker processes run tasks on their main thread)
+# ---------------------------------------------------------------------------
+def _alarm_handler(signum, frame):
+    raise PageTimeout()
+
+
+def _extract_page(doc, index: int, page_text, use_alarm: bool) -> tuple[str, float]:
+    t0 = time.perf_counter()
+    if use_alarm:
+        signal.setitimer(signal.ITIMER_REAL, PDF_PAGE_TIMEOUT_SEC)
+    try:
+        text = page_text(doc, index) or ""
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    return text.strip(), time.perf_counter() - t0
+
+
+def _extract_range(path: str, backend: str, start: int, end: int, use_alarm: bool = True) -> list[tuple[int, str, float]]:
+    """Extract pages [start, end) → [(page index, text, seconds)]; failed pages yield ''."""
+    open_doc, _, page_text = _BACKENDS[backend]
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _alarm_handler)
+    doc = open_doc(path)
+    try:
+        results = []
+        for index in range(start, end):
+            try:
+                text, elapsed = _extract_page(doc, index, page_text, use_alarm)
+            except PageTimeout:
+                logger.warning("PDF page %d of %s timed out after %.0fs – skipped.", index + 1, path, PDF_PAGE_TIMEOUT_SEC)
+                text, elapsed = "", PDF_PAGE_TIMEOUT_SEC
+            except Exception as page_error:
+                logger.error(f"Error extracting text from page {index+1} of {path}: {page_error}")
+                text, elapsed = "", 0.0
+            results.append((index, text, elapsed))
+        return results
+    finally:
+        _close(doc)
+
+
+def count_pages(path: str, backend: str = BACKEND) -> int:
+    open_doc, page_count, _ = _BACKENDS[backend]
+    doc = open_doc(path)
+    try:
+        return page_count(doc)
+    finally:
+        _close(doc)
+
+
+def iter_pdf_pages(path: str, backend: str | None = None, workers: int | None = None):
+    """
+    PDF のページテキストを先頭から順に 1 ページずつ返す (空ページは返さない)。
+    大きな PDF はページ範囲ごとにプロセスプールで並列抽出し、同時に処理中の範囲を
+    workers * 2 個までに抑える。小さな PDF も 1 プロセスのプールで抽出する
+    (ページごとのタイムアウトを効かせ、固まったページで呼び出し元を止めないため)。
+    範囲が締め切りまでに終わらなければプールを強制終了して PdfRangeTimeout を送出する。
+    """
+    backend = backend or BACKEND
+    workers = workers or PDF_WORKERS
+    num_pages = count_pages(path, backend)
+    if num_pages == 0:
+        logger.warning(f"PDF file {path} has 0 pages.")
+        return
+    t0 = time.perf_counter()
+    slow_pages = 0
+
+    def emit(results):
+        nonlocal slow_pages
+        for index, text, elapsed in results:
+            if elapsed >= PDF_SLOW_PAGE_SEC:
+                slow_pages += 1
+                logger.info("PDF page %d of %s took %.2fs", index + 1, path, elapsed)
+            if text:
+                yield text
+
+    if num_pages < PDF_PARALLEL_MIN_PAGES:
+        workers = 1     # 小さな PDF は並列化しないが、呼び出し元のプロセスでは抽出しない
+    ranges = [(s, min(s + PDF_PAGES_PER_TASK, num_pages)) for s in range(0, num_pages, PDF_PAGES_PER_TASK)]
+    # Celery (threads pool) 内から fork すると危険なので spawn で起動する。
+    # with を抜けると (締め切り超過・呼び出し側の中断を含め) プールは terminate される
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(processes=min(workers, len(ranges))) as pool:
+        pending = []
+        next_range = 0
+        while next_range < len(ranges) or pending:
+            while next_range < len(ranges) and len(pending) < workers * 2:
+                start, end = ranges[next_range]
+                pending.append((start, end, pool.apply_async(_extract_range, (path, backend, start, end))))
+                next_range += 1
+            start, end, result = pending.pop(0)
+            # 前の範囲を待っている間もこの範囲は進んでいるので、取り出した時点から数えれば十分
+            deadline = PDF_PAGE_TIMEOUT_SEC * (end - start) + PDF_RANGE_GRACE_SEC
+            try:
+                results = result.get(timeout=deadline)
+            except multiprocessing.TimeoutError:
+                raise PdfRangeTimeout(f"pages {start + 1}-{end} of {path} did not finish within {deadline:.0f}s") from None
+            yield from emit(results)
+    logger.info("Extracted %d PDF pages from %s with %s in %.2fs (%d slow pages)",
+                num_pages, path, backend, time.perf_counter() - t0, slow_pages)
@@ -0,0 +1,176 @@
+# backend/services/prompt_builder.py
+"""
+Token-budgeted prompt assembly for the chat service.
+
+Retrieved chunks and conversation turns are measured with the chat model's
+tiktoken encoding and packed into CHAT_PROMPT_TOKEN_BUDGET: context first (in
+retrieval rank order, with the text shared by overlapping chunks removed),
+then as many of the most recent history turns as fit.  Turns that do not fit
+are returned to the caller, which may summarise them.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+CHAT_PROMPT_TOKEN_BUDGET = int(os.getenv("CHAT_PROMPT_TOKEN_BUDGET", "12000"))     # system + context + history + question
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "6000"))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "4000"))
+MESSAGE_OVERHEAD_TOKENS = 4          # role・区切りなど 1 メッセージあたりの固定分
+MIN_TRUNCATED_CHUNK_TOKENS = 100     # 予算に収まらないチャンクは残りがこれ以上ある場合だけ切り詰めて入れる
+MIN_OVERLAP_CHARS = 20               # これより短い一致は重なりとみなさない
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding(model: str):
+    """チャットモデルのエンコーダ (不明なモデルは o200k_base / tiktoken が使えなければ False)"""
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+                    try:
+                        _encoding = tiktoken.encoding_for_model(model)
+                    except KeyError:
+                        _encoding = tiktoken.get_encoding("o200k_base")
+                except Exception as e:
+                    logger.warning("tiktoken unavailable, approximating prompt token counts: %s", e)
+                    _encoding = False
+    return _encoding
+
+
+def count_tokens(text: str, model: str) -> int:
+    encoding = _get_encoding(model)
+    if encoding is False:
+        return len(text)                # 日本語中心の文書では文字数 ≒ トークン数
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str) -> str:
+    encoding = _get_encoding(model)
+    if encoding is False:
+        return text[:max_tokens]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+# ---------------------------------------------------------------------------
+# 重複除去: 隣接チャンクはオーバーラップ分 (既定 50 tokens) の本文を共有している
+# ---------------------------------------------------------------------------
+def _overlap(head: str, tail: str) -> int:
+    """head の末尾と tail の先頭が一致する最長の文字数 (MIN_OVERLAP_CHARS 未満なら 0)"""
+    if len(head) < MIN_OVERLAP_CHARS or len(tail) < MIN_OVERLAP_CHARS:
+        return 0
+    probe = tail[:MIN_OVERLAP_CHARS]
+    start = max(0, len(head) - len(tail))
+    pos = head.find(probe, start)
+    while pos != -1:
+        if tail.startswith(head[pos:]):
+            return len(head) - pos
+        pos = head.find(probe, pos + 1)
+    return 0
+
+
+def dedupe_chunks(docs: list[str]) -> list[tuple[int, str]]:
+    """
+    順位順のチャンクから、既に採用したチャンクと重なる部分を取り除く。
+    丸ごと含まれるチャンクは捨て、前後のオーバーラップは後から来た側を削る。
+    戻り値は (元のインデックス, 残った本文) のリスト。
+    """
+    kept: list[tuple[int, str]] = []
+    for index, doc in enumerate(docs):
+        text = (doc or "").strip()
+        for _, prev in kept:
+            if not text:
+                break
+            if text in prev:
+                text = ""
+                break
+            n = _overlap(prev, text)          # prev の直後に続くチャンク
+            if n:
+                text = text[n:].lstrip()
+            n = _overlap(text, prev)          # prev の直前にあるチャンク
+            if n:
+                text = text[:len(text) - n].rstrip()
+        if text:
+            kept.append((index, text))
+    return kept
+
+
+# ---------------------------------------------------------------------------
+# packing
+# ---------------------------------------------------------------------------
+def pack_context(docs: list[str], budget: int, model: str) -> tuple[list[str], int]:
+    """順位の高いチャンクから予算内に詰める。戻り値は (採用したチャンク, 使用トークン数)"""
+    packed: list[str] = []
+    used = 0
+    sep_tokens = count_tokens(CONTEXT_SEPARATOR, model)
+    for doc in docs:
+        sep = sep_tokens if packed else 0
+        cost = count_tokens(doc, model) + sep
+        if used + cost <= budget:
+            packed.append(doc)
+            used += cost
+            continue
+        remaining = budget - used - sep
+        if remaining >= MIN_TRUNCATED_CHUNK_TOKENS:
+            packed.append(truncate_tokens(doc, remaining, model))
+            used = budget
+        break
+    return packed, used
+
+
+def pack_history(history: list[dict], budget: int, model: str) -> tuple[list[dict], list[dict], int]:
+    """
+    新しい発言から予算内に詰める。戻り値は (採用した発言, 入りきらなかった古い発言, 使用トークン数)。
+    採用分は元の時系列順のまま返す。
+    """
+    used = 0
+    start = len(history)
+    for message in reversed(history):
+        cost = count_tokens(message["content"], model) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    # assistant の発言から始まると文脈が欠けるので、その場合は古い側に回す
+    if start < len(history) and history[start]["role"] == "assistant":
+        used -= count_tokens(history[start]["content"], model) + MESSAGE_OVERHEAD_TOKENS
+        start += 1
+    return history[start:], history[:start], used
+
+
+@dataclass
+class PromptBudget:
+    """1 回のプロンプトで各要素に割り当てたトークン数 (ログ用)"""
+    total: int = CHAT_PROMPT_TOKEN_BUDGET
+    base: int = 0
+    context: int = 0
+    history: int = 0
+    chunks_in: int = 0
+    chunks_kept: int = 0
+    turns_in: int = 0
+    turns_kept: int = 0
+
+    @property
+    def used(self) -> int:
+        return self.base + self.context + self.history
+
+    def context_budget(self) -> int:
+        return max(0, min(CHAT_CONTEXT_TOKEN_BUDGET, self.total - self.base))
+
+    def history_budget(self) -> int:
+        return max(0, min(CHAT_HISTORY_TOKEN_BUDGET, self.total - self.base - self.context))
+
+    def summary(self) -> str:
+        return (f"prompt tokens ≈ {self.used}/{self.total} (base={self.base}, context={self.context} "
+                f"[{self.chunks_kept}/{self.chunks_in} chunks], history={self.history} [{self.turns_kept}/{self.turns_in} turns])")
@@ -0,0 +1,48 @@
+# backend/services/redis_client.py
+"""
+Shared Redis client for caches and cross-process state (REDIS_URL, the same
+instance Celery uses as its broker).
+
+Callers treat Redis as optional: `get_redis()` returns None while Redis is
+unreachable and they fall back to process-local state.  A failed connection
+is retried at most every REDIS_RETRY_SEC seconds so an outage does not add a
+connect timeout to every request.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_SOCKET_TIMEOUT_SEC = float(os.getenv("REDIS_SOCKET_TIMEOUT_SEC", "0.5"))
+REDIS_RETRY_SEC = 30.0
+
+_redis = None
+_redis_lock = threading.Lock()
+_failed_at: float | None = None
+
+
+def get_redis():
+    """Process-wide redis.Redis client, or None when Redis is not reachable."""
+    global _redis, _failed_at
+    if _redis is not None:
+        return _redis
+    if _failed_at is not None and time.monotonic() - _failed_at < REDIS_RETRY_SEC:
+        return None
+    with _redis_lock:
+        if _redis is None and (_failed_at is None or time.monotonic() - _failed_at >= REDIS_RETRY_SEC):
+            try:
+                import redis
+                client = redis.Redis.from_url(REDIS_URL, socket_timeout=REDIS_SOCKET_TIMEOUT_SEC,
+                                              socket_connect_timeout=REDIS_SOCKET_TIMEOUT_SEC)
+                client.ping()
+                _redis, _failed_at = client, None
+            except Exception as e:
+                _failed_at = time.monotonic()
+                logger.warning("Redis unavailable (%s), using in-process state: %s", REDIS_URL, e)
+    return _redis
@@ -1,12 +1,17 @@
 # backend/services/retriever.py (where句修正 + ログ追加版)
 
 import chromadb
-from backend.services.embedding import get_embedding
+from backend.services.embedding import get_embedding, get_embeddings, get_query_embedding
+from backend.services import lexical_index
 import os
 import traceback
 from chromadb import HttpClient
 import hashlib
+import threading
+import time
 import urllib.parse as _urlparse
+from collections.abc import Iterable
+from dataclasses import dataclass
 
 
 # --------------------------------------------------------------------
@@ -39,25 +44,74 @@ client = HttpClient(host=CHROMA_HOST, port=CHROMA_PORT, ssl=False)
 # --------------------------------------------------------------------
 
 
+# --------------------------------------------------------------------
+# Collection handle cache (user_id → (collection, expires_at))
+# get_or_create_collection は毎回 HTTP 往復になるため、取得済みのハンドルを
+# TTL 付きでプロセス内に保持する (gthread / Celery threads からの同時アクセス可)
+# --------------------------------------------------------------------
+COLLECTION_CACHE_TTL_SEC = float(os.getenv("CHROMA_COLLECTION_CACHE_TTL", "300"))
+_collection_cache: dict[int, tuple[object, float]] = {}
+_collection_cache_lock = threading.Lock()
+
+
+def invalidate_collection(user_id: int) -> None:
+    """キャッシュ済みのコレクションハンドルを破棄する (削除・エラー時に呼ぶ)"""
+    with _collection_cache_lock:
+        _collection_cache.pop(user_id, None)
+
+
 # コレクション取得または新規作成関数
 def get_collection(user_id: int):
     """
     ユーザーごとに独立した Chroma Collection を取得/作成する。
     コレクション名: user_<user_id>_documents
     """
+    now = time.monotonic()
+    with _collection_cache_lock:
+        cached = _collection_cache.get(user_id)
+        if cached and cached[1] > now:
+            return cached[0]
     name = f"user_{user_id}_documents"
     try:
         coll = client.get_or_create_collection(
             name=name,
             metadata={"hnsw:space": "cosine"}
         )
+        with _collection_cache_lock:
+            _collection_cache[user_id] = (coll, now + COLLECTION_CACHE_TTL_SEC)
         return coll
     except Exception as e:
         print(f"CRITICAL: Failed to get/create collection '{name}': {e}")
         traceback.print_exc()
         return None
 
-# ドキュメント追加関数 (変更なし)
+
+def _chunk_hash(chunk: str) -> str:
+    """ドキュメントIDの末尾に付く、チャンク内容 (見出しパスがあれば含む) の短縮 sha1"""
+    heading_path = getattr(chunk, "heading_path", "")
+    key = f"{heading_path}\n{chunk}" if heading_path else chunk
+    return hashlib.sha1(key.encode()).hexdigest()[:10]
+
+
+def _build_records(indexed_chunks: list[tuple[int, str]], source_name: str, user_id: int):
+    """(index, chunk) のリストを Embedding し、upsert 用の (ids, embeddings, metadatas, documents) を返す"""
+    embeddings, ids, metadatas, documents_to_add = [], [], [], []
+    # 全チャンクを一括で Embedding (内部でモデル上限ごとのバッチに分割される)
+    chunk_embeddings = get_embeddings([chunk for _, chunk in indexed_chunks])
+    safe_source_name = "".join(c if c.isalnum() or c in ['-','_','.'] else '_' for c in source_name)
+    for (i, chunk), embedding in zip(indexed_chunks, chunk_embeddings):
+        if embedding:
+            embeddings.append(embedding)
+            doc_id = f"user{user_id}_{safe_source_name[:40]}_{i}_{_chunk_hash(chunk)}"
+            ids.append(doc_id)
+            metadata = {"source": source_name, "user_id": user_id} # source名とuser_idをメタデータに
+            heading_path = getattr(chunk, "heading_path", "")
+            if heading_path: metadata["heading_path"] = heading_path  # 構造化チャンク (ingestion.Chunk) の見出し
+            metadatas.append(metadata)
+            documents_to_add.append(str(chunk))
+    return ids, embeddings, metadatas, documents_to_add
+
+# ドキュメント追加関数 (Embedding はバッチ取得)
 def add_documents(chunks: list[str], source_name: str, user_id: int) -> bool:
     collection = get_collection(user_id)
     if collection is None:
@@ -65,44 +119,242 @@ def add_documents(chunks: list[str], source_name: str, user_id: int) -> bool:
         return False
     if not chunks: print(f"No chunks for {source_name}"); return False
     if user_id is None: print("Error: user_id is required."); return False
-    embeddings, ids, metadatas, documents_to_add = [], [], [], []
-    for i, chunk in enumerate(chunks):
-        if not chunk or not chunk.strip(): continue
-        embedding = get_embedding(chunk)
-        if embedding:
-            embeddings.append(embedding)
-            safe_source_name = "".join(c if c.isalnum() or c in ['-','_','.'] else '_' for c in source_name)
-            hashed_id_part = hashlib.sha1(chunk.encode()).hexdigest()[:10]
-            doc_id = f"user{user_id}_{safe_source_name[:40]}_{i}_{hashed_id_part}"
-            ids.append(doc_id)
-            metadatas.append({"source": source_name, "user_id": user_id}) # source名とuser_idをメタデータに
-            documents_to_add.append(chunk)
+    indexed_chunks = [(i, chunk) for i, chunk in enumerate(chunks) if chunk and chunk.strip()]
+    ids, embeddings, metadatas, documents_to_add = _build_records(indexed_chunks, source_name, user_id)
     if not documents_to_add: print(f"No valid embeddings for {source_name}."); return False
     try:
         print(f"Upserting {len(documents_to_add)} docs for user {user_id}, source {source_name}...")
         collection.upsert(embeddings=embeddings, documents=documents_to_add, metadatas=metadatas, ids=ids)
+        lexical_index.apply_changes(user_id, upserted=list(zip(ids, documents_to_add)))
         print(f"Success upsert for user {user_id}, source {source_name}")
         return True
-    except Exception as e: print(f"Error upserting docs user {user_id}, source {source_name}: {e}"); traceback.print_exc(); return False
+    except Exception as e: print(f"Error upserting docs user {user_id}, source {source_name}: {e}"); traceback.print_exc(); invalidate_collection(user_id); return False
+
+# 差分同期関数 (既存チャンクと比較し、追加・削除が必要な分だけ反映)
+SYNC_BATCH_CHUNKS = int(os.getenv("SYNC_BATCH_CHUNKS", "256"))   # 新チャンクをこの件数ごとに Embedding → upsert
+
+
+@dataclass
+class SyncResult:
+    """sync_documents の結果。真偽値としては成功/失敗を表す"""
+    ok: bool
+    chunks: int = 0      # 入力チャンク数 (空白のみのものを除く)
+    kept: int = 0
+    added: int = 0
+    deleted: int = 0
+    empty: bool = False  # chunks が空だった (登録するものが無い)
+
+    def __bool__(self) -> bool:
+        return self.ok
+
+
+def sync_documents(chunks: Iterable[str], source_name: str, user_id: int, progress_cb=None) -> SyncResult:
+    """
+    ソースのチャンク集合を差分で置き換える。
+    既存ドキュメントIDの末尾ハッシュと新チャンクのハッシュを突き合わせ、
+    新しいチャンクだけを Embedding して upsert し、消えたチャンクだけを削除する。
+    chunks はジェネレータでもよい: 1 件ずつ消費し、既存と同じチャンクはハッシュだけ見て捨て、
+    新しいチャンクは SYNC_BATCH_CHUNKS 件ごとに登録するので、全チャンクを同時にメモリに載せない。
+    途中で失敗した場合は追加済みのチャンクを削除し、既存のチャンクはそのまま残す
+    (chunks の生成中に起きた例外は巻き戻した上でそのまま送出する)。
+    progress_cb が渡された場合は "embedding" / "upserting" の各段階で呼び出す。
+    """
+    result = SyncResult(ok=False)
+    collection = get_collection(user_id)
+    if collection is None: print("Error syncing docs: ChromaDB unavailable."); return result
+    if user_id is None: print("Error: user_id is required."); return result
+    where_clause = {
+        "$and": [
+            {"source": {"$eq": source_name}},
+            {"user_id": {"$eq": user_id}}
+        ]
+    }
+    try:
+        existing_ids = collection.get(where=where_clause, include=[]).get('ids', [])
+    except Exception as e:
+        print(f"Error reading existing docs user {user_id}, source '{source_name}': {e}"); traceback.print_exc()
+        invalidate_collection(user_id)
+        return result
+
+    # ハッシュ → 既存ID (同一内容のチャンクが複数ある場合に備えてリストで保持)
+    existing_by_hash: dict[str, list[str]] = {}
+    for doc_id in existing_ids:
+        existing_by_hash.setdefault(doc_id.rsplit("_", 1)[-1], []).append(doc_id)
+
+    pending: list[tuple[int, str]] = []
+    added_ids: list[str] = []
+
+    def flush() -> bool:
+        """溜まった新チャンクを Embedding して upsert する (1 件でも失敗すれば False)"""
+        if progress_cb: progress_cb("embedding", f"{result.added + len(pending)} 件のチャンクを Embedding 中 ({result.chunks} 件処理済み)")
+        ids, embeddings, metadatas, documents_to_add = _build_records(pending, source_name, user_id)
+        if len(documents_to_add) < len(pending):
+            print(f"Error: failed to embed {len(pending) - len(documents_to_add)} chunks for {source_name}; keeping existing docs.")
+            return False
+        try:
+            collection.upsert(embeddings=embeddings, documents=documents_to_add, metadatas=metadatas, ids=ids)
+        except Exception as e:
+            print(f"Error upserting docs user {user_id}, source '{source_name}': {e}"); traceback.print_exc()
+            invalidate_collection(user_id)
+            return False
+        added_ids.extend(ids)
+        lexical_index.apply_changes(user_id, upserted=list(zip(ids, documents_to_add)))
+        result.added += len(pending)
+        pending.clear()
+        return True
+
+    def rollback() -> None:
+        """途中まで追加したチャンクを消す (古いチャンクはまだ削除していない)"""
+        if not added_ids: return
+        try:
+            collection.delete(ids=added_ids)
+            lexical_index.apply_changes(user_id, deleted_ids=added_ids)
+            result.added = 0
+        except Exception as e:
+            print(f"Error rolling back {len(added_ids)} docs user {user_id}, source '{source_name}': {e}")
+            invalidate_collection(user_id)
+
+    try:
+        for i, chunk in enumerate(chunks):
+            if not chunk or not chunk.strip(): continue
+            result.chunks += 1
+            bucket = existing_by_hash.get(_chunk_hash(chunk))
+            if bucket:
+                bucket.pop(); result.kept += 1
+                continue
+            pending.append((i, chunk))
+            if len(pending) >= SYNC_BATCH_CHUNKS and not flush():
+                rollback(); return result
+    except BaseException:
+        rollback()       # 抽出・チャンク分割の失敗やタイムアウトはジョブ側で失敗として扱う
+        raise
+    if not result.chunks:
+        print(f"No chunks for {source_name}"); result.empty = True; return result
+
+    if pending and not flush():
+        rollback(); return result
+    stale_ids = [doc_id for bucket in existing_by_hash.values() for doc_id in bucket]
+    try:
+        print(f"Sync user {user_id}, source '{source_name}': keep={result.kept}, add={result.added}, delete={len(stale_ids)}")
+        if progress_cb: progress_cb("upserting", f"追加 {result.added} 件 / 削除 {len(stale_ids)} 件")
+        # 新チャンクの反映が済んでから古いチャンクを削除 (途中失敗でも検索対象が空にならない)
+        if stale_ids:
+            collection.delete(ids=stale_ids)
+            lexical_index.apply_changes(user_id, deleted_ids=stale_ids)
+        result.deleted = len(stale_ids)
+        result.ok = True
+        return result
+    except Exception as e:
+        print(f"Error deleting stale docs user {user_id}, source '{source_name}': {e}"); traceback.print_exc()
+        invalidate_collection(user_id)
+        return result
+
+# --------------------------------------------------------------------
+# 検索 (ベクトル検索 + BM25 のハイブリッド / RRF で統合)
+# --------------------------------------------------------------------
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")             # "hybrid" | "vector"
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", "1.0"))
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", "1.0"))
+HYBRID_CANDIDATES_PER_K = int(os.getenv("HYBRID_CANDIDATES_PER_K", "4"))   # 各検索で top_k × この数の候補を取る
+RRF_K = 60
+_LOAD_PAGE_SIZE = 5000
+
 
-# 類似ドキュメント検索関数 (where句は単一条件なので変更なし)
-def retrieve_similar_docs(query: str, user_id: int, top_k=3) -> dict:
+def _load_all_documents(user_id: int):
+    """BM25 索引の構築用にユーザーの全チャンク (id, 本文) をページ単位で読み出す"""
+    collection = get_collection(user_id)
+    if collection is None:
+        raise RuntimeError("ChromaDB collection unavailable")
+    offset = 0
+    while True:
+        page = collection.get(where={"user_id": user_id}, include=['documents'], limit=_LOAD_PAGE_SIZE, offset=offset)
+        ids = page.get('ids') or []
+        yield from zip(ids, page.get('documents') or [])
+        if len(ids) < _LOAD_PAGE_SIZE:
+            return
+        offset += len(ids)
+
+
+def _fetch_documents(user_id: int, ids: list[str]):
+    """BM25 索引の追いつき用に、指定 ID のチャンク (id, 本文) を読み出す (削除済みの ID は返らない)"""
+    collection = get_collection(user_id)
+    if collection is None:
+        raise RuntimeError("ChromaDB collection unavailable")
+    for start in range(0, len(ids), _LOAD_PAGE_SIZE):
+        page = collection.get(ids=ids[start:start + _LOAD_PAGE_SIZE], include=['documents'])
+        yield from zip(page.get('ids') or [], page.get('documents') or [])
+
+
+def reciprocal_rank_fusion(rankings: list[tuple[list[str], float]], k: int = RRF_K) -> list[tuple[str, float]]:
+    """[(ranked ids, weight), ...] を weight / (k + 順位) の合計で統合し、スコア順に返す"""
+    fused: dict[str, float] = {}
+    for ranked_ids, weight in rankings:
+        for rank, doc_id in enumerate(ranked_ids, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight / (k + rank)
+    return sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
+
+
+def _vector_query(collection, query: str, user_id: int, n_results: int) -> dict | None:
+    query_embedding = get_query_embedding(query)
+    if not query_embedding: return None
+    # user_idでフィルタリング (単一条件なので $eq は必須ではないことが多い)
+    return collection.query(
+        query_embeddings=[query_embedding],
+        n_results=n_results,
+        where={"user_id": user_id},
+        include=['documents', 'distances', 'metadatas']
+    )
+
+
+# 類似ドキュメント検索関数
+def retrieve_similar_docs(query: str, user_id: int, top_k=3, mode: str | None = None) -> dict:
+    """
+    質問に関連するチャンクを top_k 件返す (戻り値は Chroma の query と同じ形式)。
+    mode="hybrid" ではベクトル検索と BM25 (日本語は文字 bigram) の候補を RRF で統合するため、
+    製品コードや固有名詞・表のセルなど意味検索だけでは拾えない一致も上位に入る。
+    BM25 由来でベクトル検索の候補に無いチャンクの distance は None。
+    """
     collection = get_collection(user_id)
     default_result = {"documents": [[]], "distances": [[]], "ids": [[]], "metadatas": [[]]}
     if collection is None: print("Error retrieving docs: ChromaDB unavailable."); return default_result
     if user_id is None: print("Error: user_id required."); return default_result
-    query_embedding = get_embedding(query)
-    if not query_embedding: return default_result
+    mode = mode or RETRIEVAL_MODE
     try:
-        # user_idでフィルタリング (単一条件なので $eq は必須ではないことが多い)
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=top_k,
-            where={"user_id": user_id},
-            include=['documents', 'distances', 'metadatas']
-        )
-        return results
-    except Exception as e: print(f"Error querying Chroma user {user_id}: {e}"); traceback.print_exc(); return default_result
+        if mode != "hybrid":
+            return _vector_query(collection, query, user_id, top_k) or default_result
+        n_candidates = top_k * HYBRID_CANDIDATES_PER_K
+        vector = _vector_query(collection, query, user_id, n_candidates)
+        index = lexical_index.get_index(user_id, lambda: _load_all_documents(user_id),
+                                        lambda ids: _fetch_documents(user_id, ids))
+        lexical_hits = index.search(query, n_candidates) if index is not None else []
+        vector_ids = vector['ids'][0] if vector and vector.get('ids') else []
+        if not lexical_hits:
+            if vector is None: return default_result
+            return {key: [values[0][:top_k]] for key, values in vector.items() if key in default_result and values}
+        fused = reciprocal_rank_fusion([
+            (vector_ids, HYBRID_VECTOR_WEIGHT),
+            ([doc_id for doc_id, _ in lexical_hits], HYBRID_LEXICAL_WEIGHT),
+        ])[:top_k]
+
+        # ベクトル検索の結果に含まれないチャンクは本文・メタデータを取り寄せる
+        found: dict[str, tuple] = {}
+        if vector_ids:
+            for doc_id, doc, dist, meta in zip(vector_ids, vector['documents'][0], vector['distances'][0], vector['metadatas'][0]):
+                found[doc_id] = (doc, dist, meta)
+        missing = [doc_id for doc_id, _ in fused if doc_id not in found]
+        if missing:
+            fetched = collection.get(ids=missing, include=['documents', 'metadatas'])
+            for doc_id, doc, meta in zip(fetched.get('ids', []), fetched.get('documents', []), fetched.get('metadatas', [])):
+                found[doc_id] = (doc, None, meta)
+        ids = [doc_id for doc_id, _ in fused if doc_id in found]
+        print(f"[Retriever] hybrid user {user_id}: vector={len(vector_ids)} lexical={len(lexical_hits)} → {len(ids)} (lexical-only {len(missing)})")
+        return {
+            "ids": [ids],
+            "documents": [[found[doc_id][0] for doc_id in ids]],
+            "distances": [[found[doc_id][1] for doc_id in ids]],
+            "metadatas": [[found[doc_id][2] for doc_id in ids]],
+        }
+    except Exception as e: print(f"Error querying Chroma user {user_id}: {e}"); traceback.print_exc(); invalidate_collection(user_id); return default_result
 
 # 登録ソース一覧取得関数 (where句は単一条件なので変更なし)
 def get_registered_sources(user_id: int) -> dict[str, int]:
@@ -121,7 +373,7 @@ def get_registered_sources(user_id: int) -> dict[str, int]:
                     if source_name: sources_count[source_name] = sources_count.get(source_name, 0) + 1
         print(f"Found sources for user {user_id}: {sources_count}")
         return sources_count
-    except Exception as e: print(f"Error getting sources user {user_id}: {e}"); traceback.print_exc(); return {}
+    except Exception as e: print(f"Error getting sources user {user_id}: {e}"); traceback.print_exc(); invalidate_collection(user_id); return {}
 
 # ▼▼▼ get_documents_by_source の where句を修正 ▼▼▼
 def get_documents_by_source(source_name: str, user_id: int, limit: int = 50) -> list[str]:
@@ -167,6 +419,7 @@ def get_documents_by_source(source_name: str, user_id: int, limit: int = 50) ->
     except Exception as e:
         print(f"[Retriever ERROR] Error in get_documents_by_source for user {user_id}, source '{source_name}': {e}")
         traceback.print_exc()
+        invalidate_collection(user_id)
         return []
 # ▲▲▲ get_documents_by_source の where句を修正 ▲▲▲
 
@@ -197,6 +450,8 @@ def delete_documents_by_source(source_name: str, user_id: int) -> bool:
         print(f"Deleting {len(ids_to_delete)} docs for user {user_id}, source: '{source_name}'...")
         # deleteメソッドはIDリストで指定するため、where句の修正は不要
         collection.delete(ids=ids_to_delete)
+        lexical_index.apply_changes(user_id, deleted_ids=ids_to_delete)
+        invalidate_collection(user_id)   # 次回アクセス時にハンドルを取り直す
 
         # 削除確認 (削除後にもう一度getしてみる) - こちらの get の where も修正
         print(f"[Retriever DELETE] Verifying deletion using where clause: {where_clause_for_get}")
@@ -210,4 +465,5 @@ def delete_documents_by_source(source_name: str, user_id: int) -> bool:
     except Exception as e:
         print(f"Error deleting docs user {user_id}, source '{source_name}': {e}");
         traceback.print_exc();
+        invalidate_collection(user_id)
         return False
\ No newline at end of file
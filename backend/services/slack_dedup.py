@@ -0,0 +1,131 @@
+# backend/services/slack_dedup.py
+"""
+Idempotency guards for Slack events.
+
+Slack re-delivers an event when our 200 is slow (X-Slack-Retry-Num), and the
+Celery task itself may run again (acks_late redelivery, self.retry).  Two
+guards keyed by `event_id` keep one event from producing several LLM calls
+and replies:
+
+* ingress — `claim_event` is a Redis SET NX with a TTL, checked in
+  /slack/events before the task is enqueued;
+* reply — `begin_reply` / `finish_reply` / `abort_reply` mark an event as
+  being answered and then as answered, so a second task run for the same
+  event does not post again.
+
+Without Redis both fall back to a process-local table (which only protects a
+single process).
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+
+from backend.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+SLACK_EVENT_DEDUP_TTL_SEC = int(os.getenv("SLACK_EVENT_DEDUP_TTL_SEC", "3600"))   # Slack の再送は最長でも数分以内
+SLACK_REPLY_LOCK_SEC = int(os.getenv("SLACK_REPLY_LOCK_SEC", "200"))              # 処理中マーカーの寿命 (task の time_limit 以上)
+SLACK_REPLY_DONE_TTL_SEC = 24 * 3600
+
+_EVENT_KEY = "aiqly:slack:event:{event_id}"
+_REPLY_KEY = "aiqly:slack:reply:{event_id}"
+
+_local: dict[str, tuple[float, str]] = {}     # key → (期限, 値)
+_local_lock = threading.Lock()
+
+
+def _set_nx(key: str, value: str, ttl: int) -> bool:
+    client = get_redis()
+    if client is not None:
+        try:
+            return bool(client.set(key, value, nx=True, ex=ttl))
+        except Exception as e:
+            logger.warning("Slack dedup Redis SET failed for %s: %s", key, e)
+    now = time.monotonic()
+    with _local_lock:
+        if len(_local) > 10000:
+            for k in [k for k, (expires, _) in _local.items() if expires <= now]:
+                del _local[k]
+        entry = _local.get(key)
+        if entry is not None and entry[0] > now:
+            return False
+        _local[key] = (now + ttl, value)
+        return True
+
+
+def _get(key: str) -> str | None:
+    client = get_redis()
+    if client is not None:
+        try:
+            value = client.get(key)
+            return value.decode() if isinstance(value, bytes) else value
+        except Exception as e:
+            logger.warning("Slack dedup Redis GET failed for %s: %s", key, e)
+    with _local_lock:
+        entry = _local.get(key)
+        return entry[1] if entry is not None and entry[0] > time.monotonic() else None
+
+
+def _set(key: str, value: str, ttl: int) -> None:
+    client = get_redis()
+    if client is not None:
+        try:
+            client.set(key, value, ex=ttl)
+            return
+        except Exception as e:
+            logger.warning("Slack dedup Redis SET failed for %s: %s", key, e)
+    with _local_lock:
+        _local[key] = (time.monotonic() + ttl, value)
+
+
+def _delete(key: str) -> None:
+    client = get_redis()
+    if client is not None:
+        try:
+            client.delete(key)
+            return
+        except Exception as e:
+            logger.warning("Slack dedup Redis DEL failed for %s: %s", key, e)
+    with _local_lock:
+        _local.pop(key, None)
+
+
+# ---------------------------------------------------------------------------
+# ingress (/slack/events)
+# ---------------------------------------------------------------------------
+def claim_event(event_id: str) -> bool:
+    """初めて受け取った event_id なら True。再送・重複なら False"""
+    return _set_nx(_EVENT_KEY.format(event_id=event_id), "1", SLACK_EVENT_DEDUP_TTL_SEC)
+
+
+def release_event(event_id: str) -> None:
+    """キュー投入に失敗した場合に呼ぶ (Slack の再送で処理できるようにする)"""
+    _delete(_EVENT_KEY.format(event_id=event_id))
+
+
+# ---------------------------------------------------------------------------
+# reply guard (handle_slack_event)
+# ---------------------------------------------------------------------------
+def begin_reply(event_id: str) -> tuple[bool, str | None]:
+    """
+    返信処理を始めてよければ (True, None)。
+    既に返信済み ("done:<ts>") または別の実行が処理中 ("pending") なら (False, その状態)。
+    """
+    key = _REPLY_KEY.format(event_id=event_id)
+    if _set_nx(key, "pending", SLACK_REPLY_LOCK_SEC):
+        return True, None
+    return False, _get(key) or "pending"
+
+
+def finish_reply(event_id: str, ts: str | None) -> None:
+    _set(_REPLY_KEY.format(event_id=event_id), f"done:{ts or ''}", SLACK_REPLY_DONE_TTL_SEC)
+
+
+def abort_reply(event_id: str) -> None:
+    """投稿に失敗してリトライする前に呼ぶ (次の実行が返信できるようにする)"""
+    _delete(_REPLY_KEY.format(event_id=event_id))
@@ -0,0 +1,53 @@
+# backend/services/slack_rate_limit.py
+"""
+Per-workspace budget for Slack's chat.update.
+
+chat.update is a Tier 3 method (about 50 calls per minute per workspace), and
+every concurrent streamed reply in the same workspace draws from that one
+limit.  `take` counts calls in a fixed one-minute window per team — a Redis
+INCR shared by all Celery workers — and reports whether the caller is still
+under the given limit.  Streaming uses a lower limit for intermediate updates
+so the final updates, which are always attempted, keep some headroom.
+Without Redis the count is process-local.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+
+from backend.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+SLACK_CHAT_UPDATE_PER_MIN = int(os.getenv("SLACK_CHAT_UPDATE_PER_MIN", "50"))          # Tier 3
+SLACK_STREAM_UPDATES_PER_MIN = int(os.getenv("SLACK_STREAM_UPDATES_PER_MIN", "40"))    # 途中経過の更新に使う分
+
+_KEY = "aiqly:slack:chat_update:{team_id}:{window}"
+
+_local: dict[tuple[str, int], int] = {}     # (team_id, 分) → 回数
+_local_lock = threading.Lock()
+
+
+def take(team_id: str, limit: int = SLACK_CHAT_UPDATE_PER_MIN) -> bool:
+    """chat.update を 1 回分数え、この 1 分間の回数が limit 以内なら True"""
+    window = int(time.time() // 60)
+    client = get_redis()
+    if client is not None:
+        try:
+            key = _KEY.format(team_id=team_id, window=window)
+            pipe = client.pipeline()
+            pipe.incr(key)
+            pipe.expire(key, 120)
+            count, _ = pipe.execute()
+            return int(count) <= limit
+        except Exception as e:
+            logger.warning("Slack rate limit Redis INCR failed for team %s: %s", team_id, e)
+    with _local_lock:
+        for stale in [k for k in _local if k[1] < window]:
+            del _local[stale]
+        count = _local.get((team_id, window), 0) + 1
+        _local[(team_id, window)] = count
+        return count <= limit
@@ -0,0 +1,119 @@
+# backend/services/source_version.py
+"""
+Per-user "knowledge version" counter.
+
+Every write to a user's Chroma collection (add / sync / delete) bumps the
+counter.  Per-process derived state — the lexical index, answer caches —
+records the version it was built from and is discarded once the counter has
+moved on.  The counter lives in Redis (REDIS_URL) so that a write in a Celery
+worker invalidates state held by the web containers; when Redis is not
+configured at all it falls back to a process-local counter.  The two counters
+are never mixed: if a configured Redis fails, `get_version` / `bump_version`
+return None ("unknown") and callers drop or bypass their derived state.
+
+A bump may carry a small change record (opaque bytes, e.g. the changed
+document ids).  The records of the last SOURCE_CHANGELOG_KEEP versions, at
+most SOURCE_CHANGELOG_MAX_BYTES in total, are kept in Redis next to the
+counter, written atomically with the increment, so other processes can catch
+up by replaying them (`changes_since`) instead of rebuilding from Chroma.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+
+from backend.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+SOURCE_CHANGELOG_KEEP = int(os.getenv("SOURCE_CHANGELOG_KEEP", "32"))
+SOURCE_CHANGELOG_TTL_SEC = int(os.getenv("SOURCE_CHANGELOG_TTL_SEC", "3600"))
+SOURCE_CHANGELOG_MAX_BYTES = int(os.getenv("SOURCE_CHANGELOG_MAX_BYTES", str(64 * 1024)))   # ユーザーあたりの記録の合計
+
+_KEY = "aiqly:sources_version:{user_id}"
+_LOG_KEY = "aiqly:sources_changelog:{user_id}"
+
+# INCR と変更記録の追加を 1 つの操作で行う (記録には新しいバージョン番号を前置する)。
+# 記録は件数 (ARGV[2]) と合計バイト数 (ARGV[4]) の両方で古いものから捨てる
+_BUMP_SCRIPT = """
+local v = redis.call('INCR', KEYS[1])
+redis.call('RPUSH', KEYS[2], v .. ':' .. ARGV[1])
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+local entries = redis.call('LRANGE', KEYS[2], 0, -1)
+local total = 0
+for i = #entries, 1, -1 do
+  total = total + #entries[i]
+  if total > tonumber(ARGV[4]) then
+    redis.call('LTRIM', KEYS[2], i, -1)
+    break
+  end
+end
+redis.call('EXPIRE', KEYS[2], tonumber(ARGV[3]))
+return v
+"""
+
+_local_versions: dict[int, int] = {}
+_local_lock = threading.Lock()
+
+
+def get_version(user_id: int) -> int | None:
+    """Current knowledge version for the user (0 if never written, None if Redis failed)."""
+    client = get_redis()
+    if client is not None:
+        try:
+            value = client.get(_KEY.format(user_id=user_id))
+            return int(value) if value is not None else 0
+        except Exception as e:
+            logger.warning("Failed to read source version for user %s: %s", user_id, e)
+            return None
+    with _local_lock:
+        return _local_versions.get(user_id, 0)
+
+
+def bump_version(user_id: int, change: bytes | None = None) -> int | None:
+    """
+    Mark the user's sources as changed and return the new version.
+    `change` is stored as this version's change record (an empty record means
+    "not replayable": readers must rebuild).  Returns None when Redis failed:
+    the write is then not replayable and the caller must drop its own state.
+    """
+    client = get_redis()
+    if client is not None:
+        try:
+            return int(client.eval(_BUMP_SCRIPT, 2, _KEY.format(user_id=user_id), _LOG_KEY.format(user_id=user_id),
+                                   change or b"", SOURCE_CHANGELOG_KEEP, SOURCE_CHANGELOG_TTL_SEC,
+                                   SOURCE_CHANGELOG_MAX_BYTES))
+        except Exception as e:
+            logger.warning("Failed to bump source version for user %s: %s", user_id, e)
+            return None
+    with _local_lock:
+        _local_versions[user_id] = _local_versions.get(user_id, 0) + 1
+        return _local_versions[user_id]
+
+
+def changes_since(user_id: int, version: int, until: int) -> list[bytes] | None:
+    """
+    Change records for versions version+1 … until, oldest first.  None when any
+    of them is missing or empty (trimmed, expired, not replayable) or Redis is
+    unavailable — the caller then has to rebuild its state.
+    """
+    if until <= version:
+        return []
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        entries = client.lrange(_LOG_KEY.format(user_id=user_id), 0, -1)
+    except Exception as e:
+        logger.warning("Failed to read source changelog for user %s: %s", user_id, e)
+        return None
+    records: dict[int, bytes] = {}
+    for entry in entries:
+        head, _, body = bytes(entry).partition(b":")
+        records[int(head)] = body
+    wanted = range(version + 1, until + 1)
+    if any(not records.get(v) for v in wanted):
+        return None
+    return [records[v] for v in wanted]
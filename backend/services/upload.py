@@ -0,0 +1,105 @@
+# backend/services/upload.py
+"""
+Streaming upload reader for /api/upload.
+
+The request body is consumed in fixed-size blocks: each block updates the
+content hash and (for text files) an incremental encoding detector, and the
+size limit is enforced as soon as it is crossed, so oversized or undecodable
+files are rejected without a second pass over the data.  Blocks are written
+straight to a file in UPLOAD_STAGING_DIR, so the web process never holds the
+upload in memory; the ingestion job records the file's path and the worker
+extracts from it directly.  UPLOAD_STAGING_DIR must therefore be storage
+shared by the web and worker containers (e.g. an EFS / NFS volume).
+"""
+
+from __future__ import annotations
+
+import codecs
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass
+
+UPLOAD_READ_BLOCK = 64 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "50")) * 1024 * 1024
+# アップロードの一時置き場 (Web と Worker の両方から同じパスで見える共有ストレージにする)
+UPLOAD_STAGING_DIR = os.getenv("UPLOAD_STAGING_DIR") or os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads")
+# 従来の extract_text_from_txt と同じ優先順位 (cp932 は Windows の「Shift_JIS」保存向け)
+TEXT_ENCODINGS = ("utf-8", "shift-jis", "cp932", "euc-jp")
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class EncodingSniffer:
+    """候補エンコーディングごとのインクリメンタルデコーダに順次バイト列を与え、失敗した候補を除外する"""
+
+    def __init__(self, encodings=TEXT_ENCODINGS):
+        self._decoders = {enc: codecs.getincrementaldecoder(enc)(errors="strict") for enc in encodings}
+
+    def feed(self, data: bytes, final: bool = False) -> None:
+        for enc in list(self._decoders):
+            try:
+                self._decoders[enc].decode(data, final=final)
+            except UnicodeDecodeError:
+                del self._decoders[enc]
+
+    def result(self) -> str | None:
+        """全データを与え終えた後に呼ぶ。最優先で残っている候補 (無ければ None)"""
+        self.feed(b"", final=True)
+        return next(iter(self._decoders), None)
+
+
+@dataclass
+class ReceivedUpload:
+    path: str                        # UPLOAD_STAGING_DIR 内のファイル (IngestionJob.upload_path に渡す)
+    size: int
+    sha256: str
+    encoding: str | None = None      # テキストファイルの場合のみ
+
+
+def receive_upload(stream, max_bytes: int = MAX_UPLOAD_BYTES, detect_encoding: bool = False,
+                   suffix: str = "", staging_dir: str | None = None) -> ReceivedUpload:
+    """
+    アップロードストリームをブロック単位で読んで staging_dir (既定は UPLOAD_STAGING_DIR) の
+    ファイルに書き出し、sha256 とエンコーディングを同時に求める。
+    max_bytes を超えた時点で UploadTooLarge を送出する (書きかけのファイルは削除する)。
+    受け取ったファイルが不要になったら discard_upload で削除すること。
+    """
+    digest = hashlib.sha256()
+    sniffer = EncodingSniffer() if detect_encoding else None
+    size = 0
+    fd, path = tempfile.mkstemp(prefix="upload-", suffix=suffix, dir=staging_dir or UPLOAD_STAGING_DIR)
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            while True:
+                block = stream.read(UPLOAD_READ_BLOCK)
+                if not block:
+                    break
+                size += len(block)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"File exceeds the {max_bytes // (1024 * 1024)} MB limit")
+                digest.update(block)
+                if sniffer is not None:
+                    sniffer.feed(block)
+                fh.write(block)
+    except BaseException:
+        discard_upload(path)
+        raise
+    return ReceivedUpload(
+        path=path,
+        size=size,
+        sha256=digest.hexdigest(),
+        encoding=sniffer.result() if sniffer is not None else None,
+    )
+
+
+def discard_upload(path: str | None) -> None:
+    """receive_upload が書き出したファイルを削除する (既に無ければ何もしない)"""
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
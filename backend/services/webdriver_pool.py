@@ -0,0 +1,216 @@
+# backend/services/webdriver_pool.py
+"""
+Bounded pool of warm headless Chrome drivers for URL ingestion.
+
+Starting Chrome costs seconds and hundreds of MB, so drivers are launched
+once and shared by worker threads.  Each checkout runs in a throwaway CDP
+browser context (Target.createBrowserContext) that is disposed on release, so
+cookies, cache, localStorage, IndexedDB etc. of every origin the fetch visited
+are discarded together.  Drivers are health-checked before reuse and recycled
+after `max_uses` checkouts.
+"""
+
+from __future__ import annotations
+
+import atexit
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service as ChromeService
+
+logger = logging.getLogger(__name__)
+
+CHROMEDRIVER_PATH = os.getenv("CHROMEDRIVER_PATH", "/usr/local/bin/chromedriver")  # Dockerfileで配置したパス
+SELENIUM_POOL_SIZE = int(os.getenv("SELENIUM_POOL_SIZE", "2"))
+SELENIUM_POOL_MAX_USES = int(os.getenv("SELENIUM_POOL_MAX_USES", "50"))
+SELENIUM_POOL_ACQUIRE_TIMEOUT = float(os.getenv("SELENIUM_POOL_ACQUIRE_TIMEOUT", "120"))
+
+
+def build_chrome_options() -> webdriver.ChromeOptions:
+    """fetch_text_from_url 用の headless Chrome オプション"""
+    options = webdriver.ChromeOptions()
+    options.add_argument('--headless=new')  # use modern headless mode – improves cookie support
+    options.add_argument('--no-sandbox'); options.add_argument('--disable-dev-shm-usage'); options.add_argument('--disable-gpu'); options.add_argument('--log-level=3'); options.add_argument('--disable-blink-features=AutomationControlled'); options.add_experimental_option('excludeSwitches', ['enable-automation']); options.add_experimental_option('useAutomationExtension', False); options.add_argument('user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36')
+    # --- Ensure cookies (incl. SameSite=None and third‑party) are accepted ---
+    options.add_argument("--disable-features=SameSiteByDefaultCookies,CookiesWithoutSameSiteMustBeSecure,BlockThirdPartyCookies")
+    options.add_argument("--disable-features=ImprovedCookieControls,ChromeCookieCrumbs")
+    # --- CDP Network イベントを performance ログで受け取る (読み込み完了の検知用) ---
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": True, "enablePage": False})
+    options.add_experimental_option(
+        "prefs",
+        {
+            "profile.default_content_settings.cookies": 1,
+            "profile.block_third_party_cookies": False,
+            "profile.cookie_controls_mode": 0,  # Chrome 115+
+        },
+    )
+    return options
+
+
+class WebDriverPool:
+    """Thread-safe, size-bounded pool of reusable Chrome WebDriver instances."""
+
+    def __init__(self, max_size: int, max_uses: int, driver_path: str = CHROMEDRIVER_PATH):
+        self.max_size = max(1, max_size)
+        self.max_uses = max(1, max_uses)
+        self.driver_path = driver_path
+        self._idle: list = []                 # 待機中のドライバ (LIFO: 直近に使ったものを優先)
+        self._uses: dict[int, int] = {}       # id(driver) → checkout 回数
+        self._contexts: dict[int, tuple[str, str]] = {}   # id(driver) → (browserContextId, 既定ウィンドウ)
+        self._total = 0                       # 起動済み (idle + 貸出中) の数
+        self._cond = threading.Condition()
+        self._closed = False
+
+    # ------------------------------------------------------------------
+    def _create(self):
+        if not os.path.exists(self.driver_path):
+            raise RuntimeError(f"ChromeDriver not found at specified path: {self.driver_path}")
+        if not os.access(self.driver_path, os.X_OK):
+            raise RuntimeError(f"ChromeDriver at {self.driver_path} is not executable.")
+        logger.info("Launching pooled WebDriver (%s)...", self.driver_path)
+        driver = webdriver.Chrome(service=ChromeService(self.driver_path), options=build_chrome_options())
+        # --- Enable DevTools Network domain so we can batch‑set cookies with SameSite=None ---
+        try:
+            driver.execute_cdp_cmd("Network.enable", {})
+        except Exception as net_err:
+            logger.debug("CDP Network.enable failed (ignored): %s", net_err)
+        self._uses[id(driver)] = 0
+        return driver
+
+    @staticmethod
+    def _is_healthy(driver) -> bool:
+        try:
+            driver.execute_script("return 1")
+            return True
+        except Exception as e:
+            logger.warning("Pooled WebDriver failed health check: %s", e)
+            return False
+
+    def _open_context(self, driver) -> bool:
+        """この checkout 専用のブラウザコンテキストにタブを開いて切り替える"""
+        try:
+            default_handle = driver.current_window_handle
+            context_id = driver.execute_cdp_cmd("Target.createBrowserContext", {})["browserContextId"]
+            target = driver.execute_cdp_cmd("Target.createTarget", {"url": "about:blank", "browserContextId": context_id})
+            driver.switch_to.window(target["targetId"])
+        except Exception as e:
+            logger.warning("Failed to open a browser context on pooled WebDriver: %s", e)
+            return False
+        self._contexts[id(driver)] = (context_id, default_handle)
+        return True
+
+    def _destroy(self, driver) -> None:
+        self._uses.pop(id(driver), None)
+        self._contexts.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.debug("WebDriver quit failed (ignored): %s", e)
+
+    def _reset(self, driver) -> None:
+        """checkout 用のブラウザコンテキストを破棄する (訪問した全オリジンの Cookie・キャッシュ・ストレージが消える)"""
+        context_id, default_handle = self._contexts.pop(id(driver))
+        driver.switch_to.window(default_handle)
+        driver.execute_cdp_cmd("Target.disposeBrowserContext", {"browserContextId": context_id})
+
+    # ------------------------------------------------------------------
+    def acquire(self, timeout: float = SELENIUM_POOL_ACQUIRE_TIMEOUT):
+        """Return a healthy driver, launching one if the pool is below its bound."""
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("WebDriver pool is closed")
+                    if self._idle:
+                        driver = self._idle.pop()
+                        break
+                    if self._total < self.max_size:
+                        self._total += 1
+                        driver = None
+                        break
+                    if not self._cond.wait(timeout=timeout):
+                        raise RuntimeError(f"Timed out after {timeout}s waiting for a pooled WebDriver")
+            # ヘルスチェックと Chrome の起動はロック外で行う (他スレッドの返却を妨げない)
+            launched = driver is None
+            if launched:
+                try:
+                    driver = self._create()
+                except Exception:
+                    with self._cond:
+                        self._total -= 1
+                        self._cond.notify()
+                    raise
+            if (launched or self._is_healthy(driver)) and self._open_context(driver):
+                self._uses[id(driver)] = self._uses.get(id(driver), 0) + 1
+                return driver
+            self._destroy(driver)
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            if launched:
+                raise RuntimeError("Freshly launched WebDriver could not open a browser context")
+
+    def release(self, driver, broken: bool = False) -> None:
+        """Return a driver to the pool; broken or worn-out drivers are quit."""
+        if driver is None:
+            return
+        recycle = broken or self._closed or self._uses.get(id(driver), 0) >= self.max_uses
+        if not recycle:
+            try:
+                self._reset(driver)
+            except Exception as e:
+                logger.warning("Failed to reset pooled WebDriver, recycling it: %s", e)
+                recycle = True
+        if recycle:
+            logger.info("Recycling WebDriver (broken=%s, uses=%s).", broken, self._uses.get(id(driver)))
+            self._destroy(driver)
+        with self._cond:
+            if recycle:
+                self._total -= 1
+            else:
+                self._idle.append(driver)
+            self._cond.notify()
+
+    @contextmanager
+    def checkout(self):
+        """`with pool.checkout() as driver:` – WebDriverException marks the driver broken."""
+        from selenium.common.exceptions import WebDriverException
+        driver = self.acquire()
+        broken = False
+        try:
+            yield driver
+        except WebDriverException:
+            broken = True
+            raise
+        finally:
+            self.release(driver, broken=broken)
+
+    def prewarm(self, count: int | None = None) -> None:
+        """Launch up to `count` idle drivers ahead of the first fetch."""
+        count = min(self.max_size, count if count is not None else self.max_size)
+        drivers = []
+        try:
+            for _ in range(count):
+                drivers.append(self.acquire())
+        except Exception as e:
+            logger.warning("WebDriver pool prewarm stopped early: %s", e)
+        for driver in drivers:
+            self.release(driver)
+        logger.info("WebDriver pool prewarmed with %d drivers.", len(drivers))
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._total -= len(idle)
+            self._cond.notify_all()
+        for driver in idle:
+            self._destroy(driver)
+
+
+driver_pool = WebDriverPool(SELENIUM_POOL_SIZE, SELENIUM_POOL_MAX_USES)
+atexit.register(driver_pool.close)
@@ -7,10 +7,14 @@
 from __future__ import annotations
 
 import logging
+import os
 import re
+import tempfile
 import time
 import traceback
+from datetime import datetime, timezone
 from typing import Any
+from uuid import uuid4
 
 from celery.exceptions import SoftTimeLimitExceeded
 from slack_sdk import WebClient
@@ -54,9 +58,277 @@ def update_google_sheet_sources(file_id: str | None = None, user_id: int | None
         _lazy_ingest_google_sheet(fid, src.user_id)
 
 
+# ---------------------------------------------------------------------------
+# URL / file ingestion (fetch → extract → chunk → embed → upsert)
+# ---------------------------------------------------------------------------
+@celery_app.task(
+    bind=True,
+    acks_late=True,              # ワーカー停止時はジョブを再配送
+    soft_time_limit=900,
+    time_limit=960,
+)
+def ingest_source(self, job_id: str, options: dict[str, Any] | None = None) -> None:
+    """
+    Run the ingestion pipeline for one `IngestionJob` and record each stage
+    on the job row so that GET /api/jobs/<id> can report progress.
+
+    `options` carries crawl limits for kind="crawl" jobs
+    (max_depth / max_pages / same_domain).
+    """
+    t0 = time.time()
+    prefix = "[INGEST_SOURCE]"
+    logger.info("%s job=%s", prefix, job_id)
+
+    # --- lazy imports to avoid circular deps --------------------------------
+    from backend.main import app as flask_app          # noqa: WPS433
+    from backend.services import ingestion, retriever  # noqa: WPS433
+    from backend.services.upload import discard_upload  # noqa: WPS433
+
+    with flask_app.app_context():
+        job: models.IngestionJob | None = db.session.get(models.IngestionJob, job_id)
+        if job is None:
+            logger.error("%s job %s not found – skip.", prefix, job_id)
+            return
+
+        def set_stage(stage: str, message: str | None = None) -> None:
+            job.status = "running"
+            job.stage = stage
+            job.message = message
+            db.session.commit()
+            logger.info("%s job=%s stage=%s %s", prefix, job_id, stage, message or "")
+
+        def finish(status: str, message: str, error: str | None = None) -> None:
+            job.status = status
+            if status == "succeeded":
+                job.stage = "done"
+            job.message = message
+            job.error = error
+            discard_upload(job.upload_path)   # アップロード本体はもう不要
+            job.upload_path = None
+            job.payload = None
+            job.finished_at = datetime.now(timezone.utc)
+            db.session.commit()
+
+        try:
+            # --- crawl: ページごとに取得 → 抽出 → チャンク → 登録 ----------------
+            if job.kind == "crawl":
+                from backend.services.crawler import crawl_and_ingest  # noqa: WPS433
+                opts = options or {}
+                set_stage("fetching", f"crawl {job.source_name}")
+                result = crawl_and_ingest(
+                    job.source_name,
+                    job.user_id,
+                    max_depth=int(opts.get("max_depth", 2)),
+                    max_pages=int(opts.get("max_pages", 200)),
+                    same_domain=bool(opts.get("same_domain", True)),
+                    progress_cb=set_stage,
+                )
+                summary = (f"{result.pages_ingested} ページを登録しました。"
+                           f"(失敗 {result.pages_failed} / 重複 {result.duplicates} / {result.chunks} chunks)")
+                if result.pages_ingested:
+                    finish("succeeded", summary)
+                else:
+                    finish("failed", summary, "No pages ingested")
+                return
+
+            # --- fetch / extract → chunk → embed + upsert (差分のみ) --------------
+            # チャンクはジェネレータのまま sync_documents に渡し、1 件ずつ消費させる
+            validators = None
+            tmp_path = None
+            try:
+                if job.kind == "url":
+                    set_stage("fetching", job.source_name)
+                    # ユーザーがソースを削除済みなら、保存済みの検証子があっても取り込み直す
+                    indexed = bool(retriever.get_documents_by_source(job.source_name, job.user_id, limit=1))
+                    fetched = ingestion.fetch_text_if_changed(job.source_name, job.user_id, use_stored_validators=indexed)
+                    if fetched.unchanged:
+                        finish("succeeded", f"'{job.source_name}' は前回から変更がありません。")
+                        return
+                    text, validators = fetched.text, fetched.validators
+                    if not text or not text.strip():
+                        finish("failed", "テキストを取得できませんでした。", "Fetch/extract failed or no text")
+                        return
+                    set_stage("chunking", f"{len(text)} chars")
+                    chunks = ingestion.iter_text_chunks(text)
+                else:
+                    # PDF はページ単位で抽出しながらチャンク分割する (全文をメモリに載せない)
+                    set_stage("extracting", job.source_name)
+                    file_ext = job.source_name.rsplit(".", 1)[-1].lower()
+                    if job.upload_path:
+                        # Web が共有ストレージに書き出したファイルから直接抽出する
+                        if not os.path.exists(job.upload_path):
+                            finish("failed", "アップロードされたファイルが見つかりません。",
+                                   f"Upload not found: {job.upload_path} (UPLOAD_STAGING_DIR must be shared with the worker)")
+                            return
+                        file_path = job.upload_path
+                    else:
+                        # upload_path 導入前に登録されたジョブは DB の payload を一時ファイルに書き出す
+                        fd, tmp_path = tempfile.mkstemp(suffix=f".{file_ext}")
+                        with os.fdopen(fd, "wb") as fh:
+                            fh.write(job.payload or b"")
+                        file_path = tmp_path
+                    chunks = ingestion.iter_text_chunks(ingestion.iter_text_from_file(file_path, file_ext, job.encoding))
+                synced = retriever.sync_documents(chunks, job.source_name, job.user_id, progress_cb=set_stage)
+            finally:
+                if tmp_path is not None:
+                    os.remove(tmp_path)
+            if not synced:
+                if synced.empty:
+                    finish("failed", "テキストを取得できませんでした。", "Fetch/extract failed or no chunks generated")
+                else:
+                    finish("failed", "ナレッジへの登録に失敗しました。", f"Failed add chunks from '{job.source_name}'")
+                return
+
+            if validators is not None:
+                # 登録に成功した時だけ保存 (失敗時に保存すると次回の再取得がスキップされる)
+                ingestion.save_url_validators(job.user_id, job.source_name, validators)
+            finish("succeeded", f"'{job.source_name}' を登録しました。({synced.chunks} chunks)")
+        except SoftTimeLimitExceeded:
+            db.session.rollback()
+            finish("failed", "処理がタイムアウトしました。", "Soft time limit exceeded")
+            raise
+        except Exception as exc:                                               # pylint: disable=broad-except
+            logger.error("%s job=%s failed: %s\n%s", prefix, job_id, exc, traceback.format_exc())
+            db.session.rollback()
+            finish("failed", "取り込み中にエラーが発生しました。", str(exc))
+        finally:
+            logger.info("%s job=%s done (%.2fs)", prefix, job_id, time.time() - t0)
+
+
+# ---------------------------------------------------------------------------
+# URL sources refresh (beat) – 未変更ページは条件付きリクエスト 1 回で終わる
+# ---------------------------------------------------------------------------
+@celery_app.task
+def refresh_url_sources(user_id: int | None = None) -> None:
+    """Enqueue a re‑fetch job for every URL source that has stored validators."""
+    from backend.main import app as flask_app  # noqa: WPS433
+
+    with flask_app.app_context():
+        query = db.select(models.UrlValidator)
+        if user_id is not None:
+            query = query.filter_by(user_id=user_id)
+        targets = [(v.user_id, v.url) for v in db.session.scalars(query)]
+        jobs = []
+        for uid, url in targets:
+            job = models.IngestionJob(id=str(uuid4()), user_id=uid, kind="url", source_name=url,
+                                      status="queued", stage="queued")
+            db.session.add(job)
+            jobs.append(job)
+        db.session.commit()
+        for job in jobs:
+            ingest_source.delay(job.id)
+        logger.info("REFRESH_URL_SOURCES – enqueued %d jobs (user_id=%s)", len(jobs), user_id)
+
+
 # ---------------------------------------------------------------------------
 # Slack event handler
 # ---------------------------------------------------------------------------
+# 回答をトークン単位で受け取り、placeholder メッセージを chat.update で書き換えていく。
+# chat.update は Tier 3 (ワークスペースあたり毎分 50 回程度) なので更新間隔を空け、
+# ワークスペース単位の回数 (slack_rate_limit) が尽きればその分が終わるまで、
+# ratelimited が返れば Retry-After の間は途中経過の更新を止める。
+SLACK_STREAM_REPLIES = os.getenv("SLACK_STREAM_REPLIES", "1") not in ("0", "false", "False")
+SLACK_STREAM_UPDATE_SEC = float(os.getenv("SLACK_STREAM_UPDATE_SEC", "1.5"))
+SLACK_PLACEHOLDER_TEXT = "回答を作成しています… :hourglass_flowing_sand:"
+SLACK_STREAM_CURSOR = " ▍"
+SLACK_ERROR_TEXT = "申し訳ありません。現在応答できませんでした。"
+SLACK_FINAL_UPDATE_ATTEMPTS = 3
+SLACK_REPLACED_TEXT = "（回答は下に投稿しました）"
+
+
+def _retry_after(api_err: SlackApiError) -> float:
+    """ratelimited エラーの Retry-After 秒数 (それ以外は 0)"""
+    if api_err.response.get("error") != "ratelimited":
+        return 0.0
+    try:
+        return float(api_err.response.headers.get("Retry-After", 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def _stream_reply(client: WebClient, team_id: str, channel_id: str, thread_ts: str, reply_ts: str, deltas, prefix: str) -> tuple[str, bool]:
+    """
+    deltas (回答の差分) を受け取りながら reply_ts のメッセージを更新し、最後に全文で書き換える。
+    戻り値は (最終的な回答, 正常に生成できたか)。
+    """
+    from backend.services.chat import ChatError  # noqa: WPS433
+    from backend.services import slack_rate_limit  # noqa: WPS433
+    parts: list[str] = []
+    last_sent = ""
+    next_update = time.monotonic() + SLACK_STREAM_UPDATE_SEC
+    updates = 0
+    answer_ok = True
+    try:
+        for delta in deltas:
+            parts.append(delta)
+            if time.monotonic() < next_update:
+                continue
+            text = "".join(parts)
+            if not text.strip() or text == last_sent:
+                continue
+            if not slack_rate_limit.take(team_id, slack_rate_limit.SLACK_STREAM_UPDATES_PER_MIN):
+                # このワークスペースの今の 1 分間の枠を使い切った: 次の分まで途中経過は送らない
+                next_update = time.monotonic() + max(SLACK_STREAM_UPDATE_SEC, 60 - time.time() % 60)
+                logger.info("%s chat.update budget for team %s exhausted – pausing updates", prefix, team_id)
+                continue
+            try:
+                client.chat_update(channel=channel_id, ts=reply_ts, text=text + SLACK_STREAM_CURSOR)
+                last_sent = text
+                updates += 1
+                next_update = time.monotonic() + SLACK_STREAM_UPDATE_SEC
+            except SlackApiError as api_err:
+                wait = _retry_after(api_err)
+                logger.warning("%s chat.update failed (%s) – pausing updates for %.1fs",
+                               prefix, api_err.response.get("error"), wait or SLACK_STREAM_UPDATE_SEC)
+                next_update = time.monotonic() + max(wait, SLACK_STREAM_UPDATE_SEC)
+        answer = "".join(parts).strip() or SLACK_ERROR_TEXT
+    except SoftTimeLimitExceeded:
+        partial = "".join(parts).strip()
+        _final_update(client, team_id, channel_id, thread_ts, reply_ts,
+                      (partial + "\n\n" if partial else "") + "（時間内に回答を完了できませんでした）", prefix)
+        raise
+    except ChatError as chat_err:
+        logger.warning("%s stream_answer failed: %s", prefix, chat_err)
+        partial = "".join(parts).strip()
+        answer, answer_ok = (partial + "\n\n" if partial else "") + str(chat_err), False
+    except Exception as llm_err:                                               # pylint: disable=broad-except
+        logger.error("%s stream_answer failed: %s\n%s", prefix, llm_err, traceback.format_exc())
+        answer, answer_ok = SLACK_ERROR_TEXT, False
+    logger.info("%s streamed %d chars with %d intermediate updates", prefix, len(answer), updates)
+    _final_update(client, team_id, channel_id, thread_ts, reply_ts, answer, prefix)
+    return answer, answer_ok
+
+
+def _final_update(client: WebClient, team_id: str, channel_id: str, thread_ts: str, reply_ts: str, text: str, prefix: str) -> None:
+    """
+    placeholder を最終テキストで書き換える。更新できなければ新しいメッセージとして投稿し、
+    placeholder は削除する (削除できなければ空に近い文言に書き換える)。
+    """
+    from backend.services import slack_rate_limit  # noqa: WPS433
+    for attempt in range(1, SLACK_FINAL_UPDATE_ATTEMPTS + 1):
+        slack_rate_limit.take(team_id)   # 最終更新は必ず試みるが、ワークスペースの回数には数える
+        try:
+            client.chat_update(channel=channel_id, ts=reply_ts, text=text)
+            return
+        except SlackApiError as api_err:
+            logger.warning("%s final chat.update failed (attempt %d): %s",
+                           prefix, attempt, api_err.response.get("error"))
+            if attempt < SLACK_FINAL_UPDATE_ATTEMPTS:
+                time.sleep(max(_retry_after(api_err), 1.0))
+    resp = client.chat_postMessage(channel=channel_id, text=text, thread_ts=thread_ts)
+    logger.info("%s final text posted as a new message (ts=%s)", prefix, resp.data.get("ts"))
+    # 途中経過 (カーソル付き) の placeholder が回答の上に残らないようにする
+    try:
+        client.chat_delete(channel=channel_id, ts=reply_ts)
+        return
+    except SlackApiError as api_err:
+        logger.warning("%s placeholder chat.delete failed: %s", prefix, api_err.response.get("error"))
+    try:
+        client.chat_update(channel=channel_id, ts=reply_ts, text=SLACK_REPLACED_TEXT)
+    except SlackApiError as api_err:
+        logger.warning("%s placeholder could not be blanked: %s", prefix, api_err.response.get("error"))
+
+
 @celery_app.task(
     bind=True,
     acks_late=True,              # ★ 失敗時にタスクをキューへ戻す
@@ -69,18 +341,26 @@ def handle_slack_event(self, body: dict[str, Any]) -> None:
     Process an `app_mention` or DM event from Slack.
 
     1. Validate payload & extract user text
-    2. Call LLM (backend.services.chat.answer_question)
-    3. Post reply back to Slack
+    2. Load the thread's earlier turns (keyed by team / channel / thread_ts)
+    3. Call LLM (backend.services.chat.answer_question) and post the reply —
+       or, with SLACK_STREAM_REPLIES, post a placeholder and chat.update it
+       with the streamed answer (backend.services.chat.stream_answer)
+    4. Remember the turn for follow-ups
     """
     t0 = time.time()
     prefix = "[HANDLE_SLACK_EVENT]"
     logger.info("%s received %s", prefix, str(body)[:120])
+    event_id = body.get("event_id")
+    reply_claimed = False     # このイベントの返信権を取得したか (未投稿で終わる場合は finally で手放す)
+    replied = False
 
     try:
         # --- lazy imports to avoid circular deps --------------------------------
         from backend.main import app as flask_app        # noqa: WPS433
         from backend.models import SlackIntegration      # noqa: WPS433
-        from backend.services.chat import answer_question  # noqa: WPS433
+        from backend.services.chat import ChatError, answer_question, stream_answer  # noqa: WPS433
+        from backend.services import conversation         # noqa: WPS433
+        from backend.services import slack_dedup          # noqa: WPS433
 
         event = body.get("event", {})
         event_type = event.get("type")
@@ -97,6 +377,13 @@ def handle_slack_event(self, body: dict[str, Any]) -> None:
                            prefix, team_id, channel_id, len(user_text))
             return
 
+        # --- idempotency: 同じ event_id のタスクが再実行されても返信は 1 回だけ ------
+        if event_id:
+            reply_claimed, state = slack_dedup.begin_reply(event_id)
+            if not reply_claimed:
+                logger.info("%s event %s already handled (%s) – skip.", prefix, event_id, state)
+                return
+
         with flask_app.app_context():
             integ: SlackIntegration | None = db.session.scalars(
                 db.select(SlackIntegration).filter_by(team_id=team_id)
@@ -109,30 +396,70 @@ def handle_slack_event(self, body: dict[str, Any]) -> None:
             logger.debug("%s Using bot token **%s…%s** (len=%d)",
                          prefix, integ.bot_token[:5], integ.bot_token[-5:], len(integ.bot_token))
 
-            # --- LLM call -------------------------------------------------------
-            try:
-                answer = answer_question(user_text, integ.user_id, [])
-                logger.info("%s answer_question OK (%.2fs)", prefix, time.time() - t0)
-            except Exception as llm_err:                                      # pylint: disable=broad-except
-                logger.error("%s answer_question failed: %s\n%s",
-                             prefix, llm_err, traceback.format_exc())
-                answer = "申し訳ありません。現在応答できませんでした。"
-
-            # --- Slack post -----------------------------------------------------
-            client = WebClient(token=integ.bot_token)
+            # --- thread memory (返信はスレッド内に投稿するので、スレッドの親 ts で会話を識別) ---
             thread_ts = event.get("thread_ts") or event.get("ts")
+            thread_id = conversation.slack_thread_id(team_id, channel_id, thread_ts)
+            history = conversation.load_history(integ.user_id, thread_id, db_fallback=False)
+            logger.info("%s thread=%s history=%d messages", prefix, thread_id, len(history))
 
-            try:
-                resp = client.chat_postMessage(channel=channel_id, text=answer, thread_ts=thread_ts)
-                logger.info("%s Slack reply sent (ts=%s)", prefix, resp.data.get("ts"))
-            except SlackApiError as api_err:
-                logger.error("%s Slack API error: %s – %s",
-                             prefix, api_err.response.status_code, api_err.response.get("error"))
-                raise self.retry(exc=api_err, countdown=30)
-            except Exception as post_err:                                      # pylint: disable=broad-except
-                logger.error("%s Unexpected error posting message: %s\n%s",
-                             prefix, post_err, traceback.format_exc())
-                raise self.retry(exc=post_err, countdown=30)
+            client = WebClient(token=integ.bot_token)
+            answer_ok = False
+
+            if SLACK_STREAM_REPLIES:
+                # --- placeholder を即座に投稿し、生成中の回答で chat.update していく ---------
+                try:
+                    placeholder = client.chat_postMessage(channel=channel_id, text=SLACK_PLACEHOLDER_TEXT, thread_ts=thread_ts)
+                except SlackApiError as api_err:
+                    logger.error("%s Slack API error: %s – %s",
+                                 prefix, api_err.response.status_code, api_err.response.get("error"))
+                    raise self.retry(exc=api_err, countdown=30)
+                reply_ts = placeholder.data.get("ts")
+                logger.info("%s placeholder posted (ts=%s, %.2fs)", prefix, reply_ts, time.time() - t0)
+                # placeholder を投稿した後はリトライしない (二重投稿になるため)。最終更新の失敗は新規投稿で補う
+                replied = True
+                answer, answer_ok = _stream_reply(
+                    client, team_id, channel_id, thread_ts, reply_ts,
+                    stream_answer(user_text, integ.user_id, history), prefix,
+                )
+                logger.info("%s streamed reply finished (%.2fs)", prefix, time.time() - t0)
+                if event_id:
+                    slack_dedup.finish_reply(event_id, reply_ts)
+            else:
+                # --- LLM call ---------------------------------------------------
+                try:
+                    answer = answer_question(user_text, integ.user_id, history)
+                    answer_ok = True
+                    logger.info("%s answer_question OK (%.2fs)", prefix, time.time() - t0)
+                except ChatError as chat_err:
+                    logger.warning("%s answer_question failed: %s", prefix, chat_err)
+                    answer = str(chat_err)
+                except Exception as llm_err:                                      # pylint: disable=broad-except
+                    logger.error("%s answer_question failed: %s\n%s",
+                                 prefix, llm_err, traceback.format_exc())
+                    answer = SLACK_ERROR_TEXT
+
+                # --- Slack post -------------------------------------------------
+                try:
+                    resp = client.chat_postMessage(channel=channel_id, text=answer, thread_ts=thread_ts)
+                    logger.info("%s Slack reply sent (ts=%s)", prefix, resp.data.get("ts"))
+                    replied = True
+                    if event_id:
+                        slack_dedup.finish_reply(event_id, resp.data.get("ts"))
+                except SlackApiError as api_err:
+                    logger.error("%s Slack API error: %s – %s",
+                                 prefix, api_err.response.status_code, api_err.response.get("error"))
+                    raise self.retry(exc=api_err, countdown=30)
+                except Exception as post_err:                                      # pylint: disable=broad-except
+                    logger.error("%s Unexpected error posting message: %s\n%s",
+                                 prefix, post_err, traceback.format_exc())
+                    raise self.retry(exc=post_err, countdown=30)
+
+            if answer_ok:
+                # 投稿できた往復だけを記憶する (リトライで同じ発言が重複しないように)
+                conversation.append_turns(integ.user_id, thread_id, [
+                    {"role": "user", "content": user_text},
+                    {"role": "assistant", "content": answer},
+                ])
 
     except SoftTimeLimitExceeded:
         logger.error("%s Soft time‑limit exceeded – task aborted.", prefix)
@@ -141,4 +468,6 @@ def handle_slack_event(self, body: dict[str, Any]) -> None:
         logger.error("%s Unhandled exception: %s\n%s", prefix, exc, traceback.format_exc())
         raise
     finally:
+        if reply_claimed and not replied:
+            slack_dedup.abort_reply(event_id)   # リトライ (self.retry / 再配送) で返信できるように
         logger.info("%s done (%.2fs)", prefix, time.time() - t0)
\ No newline at end of file
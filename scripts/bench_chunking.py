@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Benchmark chunking on Japanese-heavy text.
+
+Compares the previous chunk_text (encoder loaded per call, Python list of
+tokens, one decode per window, all chunks returned as a list) with the current
+chunkers, both collected into a list and consumed lazily the way the ingest
+job feeds retriever.sync_documents.  Reports wall time and peak traced memory.
+
+    FERNET_KEY=... python scripts/bench_chunking.py --mb 20
+    FERNET_KEY=... python scripts/bench_chunking.py --file manual.txt
+    FERNET_KEY=... python scripts/bench_chunking.py --table-rows 200000 --skip-legacy
+
+--table-rows also chunks one Excel-like sheet (the line iterator that
+iter_text_from_excel yields) with that many rows; peak memory should not grow
+with the row count.
+
+tiktoken must be able to load cl100k_base (network access or TIKTOKEN_CACHE_DIR).
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import tiktoken
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from backend.services import ingestion  # noqa: E402
+
+_SENTENCES = [
+    "本システムは社内ナレッジを検索し、質問に対して根拠となる文書を提示します。",
+    "設定画面から「プロンプト」を変更すると、次回の回答から反映されます。",
+    "アップロードできるファイルは PDF・Word (docx)・Excel (xlsx)・テキストです。",
+    "エラーコード E-1024 が表示された場合は、管理者に連絡してください。",
+    "申請は原則として 3 営業日以内に承認され、承認後にメールで通知されます。",
+    "経費精算の締め日は毎月 25 日で、それ以降の申請は翌月扱いとなります。",
+    "ログインには SSO (Google Workspace) を利用し、二段階認証を必須とします。",
+    "詳細な手順については、下記の表およびマニュアル第 4 章を参照してください。",
+    "The API returns HTTP 429 when the rate limit is exceeded; retry after a short delay.",
+    "ＶＰＮ接続時は、社外ネットワークからも社内システムへアクセスできます。",
+]
+
+
+def build_text(target_bytes: int, seed: int = 0) -> str:
+    """見出し・段落・表を含む、extract_structured_text 形式に近い日本語中心のテキスト"""
+    rnd = random.Random(seed)
+    parts: list[str] = []
+    size = 0
+    section = 0
+    while size < target_bytes:
+        section += 1
+        block = [f"# 第 {section} 章 業務手順", ""]
+        for sub in range(1, 4):
+            block.append(f"## {section}.{sub} 概要と注意事項")
+            for _ in range(rnd.randint(2, 5)):
+                block.append("".join(rnd.choice(_SENTENCES) for _ in range(rnd.randint(3, 8))))
+                block.append("")
+        block += ["---", "項目 | 内容 | 備考"]
+        block += [f"申請{j} | {rnd.choice(_SENTENCES)} | 第{section}章" for j in range(rnd.randint(3, 8))]
+        block += ["---", ""]
+        piece = "\n".join(block)
+        parts.append(piece)
+        size += len(piece.encode())
+    return "\n".join(parts)
+
+
+def iter_sheet_lines(rows: int, seed: int = 0):
+    """iter_text_from_excel と同じ形式 (## シート名 + --- で囲んだ表) の行を 1 行ずつ返す"""
+    rnd = random.Random(seed)
+    yield "## 申請一覧"
+    yield "---"
+    yield "申請番号 | 申請者 | 内容 | 金額 | 備考"
+    for i in range(rows):
+        yield f"A-{i:07d} | 社員{rnd.randint(1, 999)} | {rnd.choice(_SENTENCES)} | {rnd.randint(100, 99999)} | 第{i % 12 + 1}期"
+    yield "---"
+
+
+def legacy_chunk_text(text: str, chunk_size_tokens=500, overlap_tokens=50) -> list[str]:
+    """置き換え前の chunk_text (比較用)"""
+    if not text: return []
+    encoding = tiktoken.get_encoding("cl100k_base")
+    tokens = encoding.encode(text); chunks, current_position, total_tokens = [], 0, len(tokens)
+    while current_position < total_tokens:
+        end_position = min(current_position + chunk_size_tokens, total_tokens)
+        chunk_tokens = tokens[current_position:end_position]; chunk_text = encoding.decode(chunk_tokens).strip()
+        if chunk_text: chunks.append(chunk_text)
+        next_start = current_position + chunk_size_tokens - overlap_tokens; current_position = max(next_start, current_position + 1)
+        if end_position == total_tokens: break
+    return chunks
+
+
+def consume(chunks) -> tuple[int, int]:
+    """sync_documents と同様に 1 件ずつ消費する (保持するのは件数と文字数だけ)"""
+    n = chars = 0
+    for chunk in chunks:
+        n += 1
+        chars += len(chunk)
+    return n, chars
+
+
+def measure(label: str, fn) -> None:
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = fn()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    n = len(out) if isinstance(out, list) else out[0]
+    print(f"{label:<34} {elapsed:8.2f} s   peak {peak / 2**20:8.1f} MiB   {n:>7} chunks")
+    del out
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mb", type=float, default=10.0, help="size of the generated corpus (UTF-8 MiB)")
+    parser.add_argument("--file", type=Path, help="benchmark this text file instead of the generated corpus")
+    parser.add_argument("--table-rows", type=int, default=0, help="also chunk an Excel-like sheet with this many rows")
+    parser.add_argument("--skip-legacy", action="store_true", help="skip the previous implementation (slow on large inputs)")
+    args = parser.parse_args()
+
+    if args.file:
+        text = args.file.read_text(encoding="utf-8")
+    else:
+        text = build_text(int(args.mb * 2**20))
+    ascii_ratio = sum(1 for c in text[:200_000] if c.isascii()) / max(1, min(len(text), 200_000))
+    print(f"corpus: {len(text):,} chars, {len(text.encode()) / 2**20:.1f} MiB UTF-8, ASCII {ascii_ratio:.0%}")
+    ingestion.get_chunk_encoding()                          # エンコーダの読み込みは計測に含めない
+
+    if not args.skip_legacy:
+        measure("legacy chunk_text (list)", lambda: legacy_chunk_text(text))
+    measure("chunk_text fixed (list)", lambda: ingestion.chunk_text(text, strategy="fixed"))
+    measure("iter_text_chunks fixed (lazy)", lambda: consume(ingestion.iter_text_chunks(text, strategy="fixed")))
+    measure("chunk_text structured (list)", lambda: ingestion.chunk_text(text, strategy="structured"))
+    measure("iter_text_chunks structured (lazy)", lambda: consume(ingestion.iter_text_chunks(text, strategy="structured")))
+
+    if args.table_rows:
+        measure(f"sheet {args.table_rows} rows structured (lazy)",
+                lambda: consume(ingestion.iter_text_chunks(iter_sheet_lines(args.table_rows), strategy="structured")))
+
+    if not args.skip_legacy and len(text) <= ingestion.CHUNK_ENCODE_SEGMENT_CHARS:
+        same = legacy_chunk_text(text) == ingestion.chunk_text(text, strategy="fixed")
+        print(f"fixed windows identical to legacy: {same}")
+        return 0 if same else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Benchmark extract_structured_text against the previous recursive extractor.
+
+Builds a synthetic wiki-like page (sections with paragraphs, links, lists and
+tables, wrapped in `--wrap` layout divs, plus a deeply nested block), checks
+that both implementations give the same text on it and on the golden corpus in
+tests/fixtures/structured_text, and prints the best-of-N timings.
+
+    FERNET_KEY=... python scripts/bench_extract_structured_text.py --sections 2000 --repeat 3
+"""
+
+from __future__ import annotations
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup, Comment, Declaration, Doctype, NavigableString, ProcessingInstruction, Tag
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from backend.services.ingestion import extract_structured_text  # noqa: E402
+
+CORPUS_DIR = ROOT / "tests" / "fixtures" / "structured_text"
+BASE_URL = "https://wiki.example.com/page/index.html"
+
+
+def legacy_extract_structured_text(element, base_url):
+    """
+    置き換え前の再帰実装 (比較用)。
+    出力を揃えるため、現行版で直した 2 点 (td/th の中身が常に空になる・コメントが本文に混ざる) だけ修正してある。
+    """
+    text = ''
+    if element is None: return ''
+    if isinstance(element, NavigableString):
+        if isinstance(element, (Comment, Declaration, Doctype, ProcessingInstruction)): return ''   # 修正点
+        parent_tag = getattr(element, 'parent', None); parent_name = getattr(parent_tag, 'name', None)
+        if parent_name in ['script', 'style', 'noscript']: return ''
+        stripped_string = element.string.strip(); return stripped_string if stripped_string else ''
+    elif isinstance(element, Tag):
+        tag_name = element.name.lower()
+        if tag_name in ['script', 'style', 'header', 'footer', 'nav', 'aside', 'form', 'button', 'iframe', 'noscript', 'svg', 'meta', 'link', 'head']: return ''
+        prefix, suffix = '\n', '\n'; content = ''
+        if tag_name in ['a', 'span', 'strong', 'b', 'em', 'i', 'img', 'code', 'td', 'th']: prefix, suffix = '', ''
+        if tag_name == 'li': prefix, suffix = "\n- ", "\n"
+        if tag_name == 'br': return "\n"
+        if tag_name.startswith('h') and tag_name[1:].isdigit(): level = int(tag_name[1:]); content = '#' * level + ' ' + element.get_text(strip=True)
+        elif tag_name == 'a':
+            href = element.get('href'); anchor_text = "".join(legacy_extract_structured_text(child, base_url).strip() for child in element.children)
+            if not anchor_text: anchor_text = "link"
+            if href and not href.strip().lower().startswith('javascript:'): full_url = urljoin(base_url, href.strip()); content = f"[{anchor_text}]({full_url})"
+            else: content = anchor_text
+        elif tag_name == 'img':
+            alt = element.get('alt', '').strip(); src = element.get('src', ''); full_src = urljoin(base_url, src.strip()) if src else ''
+            alt_text = f": {alt}" if alt else ""
+            if full_src and full_src.lower().startswith('http'): content = f"[画像{alt_text}]({full_src})"
+            elif alt: content = f"[画像{alt_text}]"
+            else: content = "[画像]"
+            prefix, suffix = ' ', ' '
+        elif tag_name in ['strong', 'b']: content = f"**{''.join(legacy_extract_structured_text(child, base_url).strip() for child in element.children)}**"
+        elif tag_name in ['em', 'i']: content = f"*{''.join(legacy_extract_structured_text(child, base_url).strip() for child in element.children)}*"
+        elif tag_name == 'table':
+            table_text = "\n---\n"; rows = element.find_all('tr')
+            for row in rows: cells = [legacy_extract_structured_text(cell, base_url).strip() for cell in row.find_all(['th', 'td'])]; table_text += " | ".join(cells) + "\n"
+            table_text += "---\n"; content = table_text; return content
+        elif tag_name == 'pre': content = element.get_text(); prefix = '\n```\n'; suffix = '\n```\n'
+        elif tag_name == 'code': content = f"`{element.get_text(strip=True)}`"; prefix, suffix = '', ''
+        elif tag_name == 'blockquote': prefix = '\n> '; content = "".join(legacy_extract_structured_text(child, base_url) for child in element.children); suffix = '\n'
+        else: content = "".join(legacy_extract_structured_text(child, base_url) for child in element.children)   # td/th もここ (修正点)
+        if content.strip(): text = prefix + content + suffix
+        else: text = ''
+    text = re.sub(r'[ \t]+', ' ', text); return text
+
+
+def build_page(sections: int, depth: int, wrap: int = 0) -> str:
+    parts = ["<html><body>" + "<div class='layout'>" * wrap + "<article>"]
+    for i in range(sections):
+        parts.append(f"<section><h2>第 {i} 節 概要</h2>"
+                     f"<p>これは段落 {i} の本文です。 詳細は <a href='/wiki/{i}'>関連ページ {i}</a> と "
+                     f"<strong>重要な <em>注記</em></strong> を参照してください。</p>")
+        parts.append("<ul>" + "".join(f"<li>項目 {i}-{j} <code>key_{j}</code></li>" for j in range(5)) + "</ul>")
+        parts.append("<table><tr><th>名前</th><th>値</th><th>備考</th></tr>"
+                     + "".join(f"<tr><td>row{j}</td><td>{i * j}</td><td><a href='#r{j}'>#{j}</a></td></tr>" for j in range(4))
+                     + "</table></section>")
+    parts.append("<div>" * depth + "<p>深い入れ子の <b>本文</b></p>" + "</div>" * depth)
+    parts.append("</article>" + "</div>" * wrap + "</body></html>")
+    return "\n".join(parts)
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=200, help="nesting depth of the deep block (legacy recursion limit ≈ 450)")
+    parser.add_argument("--wrap", type=int, default=12, help="layout divs around the article (skins nest content this deep)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--parser", default="html.parser")
+    args = parser.parse_args()
+
+    mismatches = 0
+    for path in sorted(CORPUS_DIR.glob("*.html")):
+        soup = BeautifulSoup(path.read_text(encoding="utf-8"), args.parser)
+        if extract_structured_text(soup.body, BASE_URL) != legacy_extract_structured_text(soup.body, BASE_URL):
+            print(f"MISMATCH {path.name}")
+            mismatches += 1
+
+    html = build_page(args.sections, args.depth, args.wrap)
+    soup = BeautifulSoup(html, args.parser)
+    new_text = extract_structured_text(soup.body, BASE_URL)
+    try:
+        same = new_text == legacy_extract_structured_text(soup.body, BASE_URL)
+    except RecursionError:
+        same = None
+    print(f"page: {len(html) / 1024:.0f} KiB html, {len(new_text) / 1024:.0f} KiB text, "
+          f"{sum(1 for _ in soup.body.descendants)} nodes, depth {args.depth}, wrap {args.wrap}")
+    print(f"same output: {same if same is not None else 'legacy hit the recursion limit'}")
+
+    t_new = best_of(lambda: extract_structured_text(soup.body, BASE_URL), args.repeat)
+    print(f"extract_structured_text (iterative): {t_new * 1000:8.1f} ms")
+    if same is not None:
+        t_old = best_of(lambda: legacy_extract_structured_text(soup.body, BASE_URL), args.repeat)
+        print(f"legacy (recursive):                  {t_old * 1000:8.1f} ms  ({t_old / t_new:.1f}x)")
+    return 1 if mismatches or same is False else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+from cryptography.fernet import Fernet
+
+# backend パッケージをリポジトリ直下から import できるようにする
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# backend.utils.crypto が import 時に要求する (テストでは暗号化した値を扱わない)
+os.environ.setdefault("FERNET_KEY", Fernet.generate_key().decode())
@@ -0,0 +1,54 @@
+"""
+Golden-output tests for extract_structured_text.
+
+Each tests/fixtures/structured_text/<name>.html is converted and compared with
+<name>.txt.  After an intentional change to the output contract, regenerate the
+.txt files and review the diff:
+
+    python tests/test_extract_structured_text.py --regenerate
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+from bs4 import BeautifulSoup
+
+CORPUS_DIR = Path(__file__).resolve().parent / "fixtures" / "structured_text"
+BASE_URL = "https://wiki.example.com/page/index.html"
+CASES = sorted(p.stem for p in CORPUS_DIR.glob("*.html"))
+
+
+def _extract(name: str) -> str:
+    from backend.services.ingestion import extract_structured_text
+    soup = BeautifulSoup((CORPUS_DIR / f"{name}.html").read_text(encoding="utf-8"), "html.parser")
+    return extract_structured_text(soup.body, BASE_URL)
+
+
+@pytest.mark.parametrize("name", CASES)
+def test_matches_golden_output(name):
+    expected = (CORPUS_DIR / f"{name}.txt").read_text(encoding="utf-8")
+    assert _extract(name) == expected
+
+
+def test_deep_nesting_does_not_recurse():
+    from backend.services.ingestion import extract_structured_text
+    depth = sys.getrecursionlimit() * 2
+    soup = BeautifulSoup("<div>" * depth + "<p>deep <b>text</b></p>" + "</div>" * depth, "html.parser")
+    assert extract_structured_text(soup, BASE_URL).strip() == "deep**text**"
+
+
+def test_navigable_string_and_none():
+    from backend.services.ingestion import extract_structured_text
+    soup = BeautifulSoup("<p>  hello  </p><script>x()</script>", "html.parser")
+    assert extract_structured_text(soup.p.string, BASE_URL) == "hello"
+    assert extract_structured_text(soup.script.string, BASE_URL) == ""
+    assert extract_structured_text(None, BASE_URL) == ""
+
+
+if __name__ == "__main__" and "--regenerate" in sys.argv:
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import conftest  # noqa: F401  (FERNET_KEY / sys.path)
+    for case in CASES:
+        (CORPUS_DIR / f"{case}.txt").write_text(_extract(case), encoding="utf-8")
+        print(f"wrote {case}.txt")